@@ -0,0 +1,80 @@
+"""Job import throughput benchmark.
+
+Compares the per-line import path (import_job and the ORM unit of
+work) with the batched import path (parse_job and import_jobs).
+
+usage: PYTHONPATH=source/packages python benchmarks/bench_import.py [jobs]
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+import sqlalchemy
+
+from cbank.model import metadata, Session, import_job, import_jobs
+from cbank.model.entities import parse_job
+
+from pbslog import generate
+
+
+def per_line (entries, batch=100):
+    """Import each entry with import_job, committing every batch."""
+    s = Session()
+    counter = 0
+    for entry in entries:
+        s.add(import_job(entry))
+        counter += 1
+        if counter >= batch:
+            s.commit()
+            counter = 0
+    s.commit()
+
+
+def batched (entries, batch=100):
+    """Import entries with import_jobs, committing every batch."""
+    s = Session()
+    records = []
+    for entry in entries:
+        records.append(parse_job(entry))
+        if len(records) >= batch:
+            import_jobs(records)
+            s.commit()
+            records = []
+    import_jobs(records)
+    s.commit()
+
+
+def run (import_func, entries):
+    """Time an import into a fresh database."""
+    fd, path = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        metadata.bind = sqlalchemy.create_engine("sqlite:///%s" % path)
+        metadata.create_all()
+        start = time.time()
+        import_func(entries)
+        elapsed = time.time() - start
+        Session.remove()
+    finally:
+        metadata.bind = None
+        os.unlink(path)
+    return elapsed
+
+
+def main ():
+    try:
+        jobs = int(sys.argv[1])
+    except IndexError:
+        jobs = 5000
+    entries = list(generate(jobs))
+    print "%i jobs, %i records" % (jobs, len(entries))
+    for import_func in (per_line, batched):
+        elapsed = run(import_func, entries)
+        print "%-10s %8.2f s %10.0f records/s" % (
+            import_func.__name__, elapsed, len(entries) / elapsed)
+
+
+if __name__ == "__main__":
+    main()
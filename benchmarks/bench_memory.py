@@ -0,0 +1,84 @@
+"""Job import memory benchmark.
+
+Imports synthetic logs of increasing size with "import jobs", each in
+a new process, and reports the peak resident set size of each
+import. Memory use should not grow with the size of the log.
+
+usage: PYTHONPATH=source/packages python benchmarks/bench_memory.py [jobs]
+"""
+
+import os
+import sys
+import pwd
+import shutil
+import resource
+import tempfile
+import subprocess
+
+from pbslog import generate
+
+
+def write_log (path, jobs):
+    """Write a synthetic log of a number of jobs.
+
+    The number of users and accounts grows with the number of jobs,
+    as it does over a long period of logs.
+    """
+    f = open(path, "w")
+    try:
+        for line in generate(jobs, users=jobs // 2, accounts=jobs // 10):
+            print >> f, line
+    finally:
+        f.close()
+
+
+def import_log (database, log):
+    """Import a log (in this process) and return the peak RSS in KiB."""
+    import sqlalchemy
+    import cbank
+    from cbank.model import metadata
+    from cbank.cli.controllers import import_jobs_main
+    metadata.bind = sqlalchemy.create_engine("sqlite:///%s" % database)
+    metadata.create_all()
+    if not cbank.config.has_section("cli"):
+        cbank.config.add_section("cli")
+    cbank.config.set("cli", "admins", pwd.getpwuid(os.getuid())[0])
+    sys.argv = ["cbank-import-jobs", log]
+    import_jobs_main()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run (directory, jobs):
+    """Import a log of a number of jobs in a new process."""
+    log = os.path.join(directory, "%i.log" % jobs)
+    database = os.path.join(directory, "%i.sqlite" % jobs)
+    write_log(log, jobs)
+    child = subprocess.Popen(
+        [sys.executable, __file__, "--import", database, log],
+        stdout=subprocess.PIPE)
+    stdout, stderr = child.communicate()
+    if child.returncode:
+        raise RuntimeError("import failed: %s" % child.returncode)
+    return int(stdout)
+
+
+def main ():
+    if sys.argv[1:2] == ["--import"]:
+        print import_log(*sys.argv[2:4])
+        return
+    try:
+        jobs = int(sys.argv[1])
+    except IndexError:
+        jobs = 5000
+    directory = tempfile.mkdtemp()
+    try:
+        for factor in (1, 2, 4, 8):
+            maxrss = run(directory, jobs * factor)
+            print "%8i jobs %8i records %10i KiB peak RSS" % (
+                jobs * factor, jobs * factor * 3, maxrss)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
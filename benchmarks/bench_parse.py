@@ -0,0 +1,77 @@
+"""PBS record parsing benchmark.
+
+Compares parse_job with a parser built on the generic parse_pbs
+attribute dict (the way jobs were parsed before parse_job was
+table-driven), on a synthetic log.
+
+usage: PYTHONPATH=source/packages python benchmarks/bench_parse.py [jobs]
+"""
+
+import sys
+import time
+from datetime import datetime
+
+from cbank.model.entities import (User, Project, parse_job, parse_pbs,
+    parse_timedelta, dict_parser, subdict)
+
+from pbslog import generate
+
+
+def generic_parse_job (entry):
+    """Parse an entry from the generic parse_pbs attribute dict."""
+    _, id_, attributes = parse_pbs(entry)
+    values = {}
+    if "user" in attributes:
+        values['user_id'] = User.fetch(attributes['user']).id
+    if "account" in attributes:
+        values['account_id'] = Project.fetch(attributes['account']).id
+    for attribute in ("queue", "group", "exec_host"):
+        if attribute in attributes:
+            values[attribute] = attributes[attribute]
+    for attribute in ("ctime", "qtime", "etime", "start", "end"):
+        if attribute in attributes:
+            values[attribute] = datetime.fromtimestamp(
+                float(attributes[attribute]))
+    if "jobname" in attributes:
+        values['name'] = attributes["jobname"]
+    if "Exit_status" in attributes:
+        values['exit_status'] = int(attributes["Exit_status"])
+    if "session" in attributes:
+        values['session'] = int(attributes['session'])
+    values['resource_list'] = dict_parser(dict_parser(
+            subdict(attributes, "Resource_List."),
+        int), parse_timedelta)
+    values['resources_used'] = dict_parser(dict_parser(
+            subdict(attributes, "resources_used."),
+        int), parse_timedelta)
+    return id_, values
+
+
+def run (parse_func, entries, repeat=3):
+    """The best time of several runs parsing all entries."""
+    times = []
+    for each in xrange(repeat):
+        start = time.time()
+        for entry in entries:
+            parse_func(entry)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main ():
+    try:
+        jobs = int(sys.argv[1])
+    except IndexError:
+        jobs = 20000
+    entries = list(generate(jobs))
+    for entry in entries:
+        assert parse_job(entry) == generic_parse_job(entry), entry
+    print "%i jobs, %i records" % (jobs, len(entries))
+    for parse_func in (generic_parse_job, parse_job):
+        elapsed = run(parse_func, entries)
+        print "%-18s %8.3f s %10.0f records/s" % (
+            parse_func.__name__, elapsed, len(entries) / elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""Summary query benchmark.
+
+Populates a database with a synthetic ledger (allocations, jobs,
+charges, refunds, and holds), and times the summaries behind the
+list commands and allocation balances: first without the ledger
+indexes, stored balances, and daily usage (summing every charge in
+range), and then after migrating the database to add them.
+
+populate -- write a synthetic ledger
+reports -- the timed summaries
+
+usage: PYTHONPATH=source/packages python benchmarks/bench_summary.py [jobs]
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+from datetime import datetime, timedelta
+
+import sqlalchemy
+
+import cbank.model.queries
+from cbank.model import (
+    Session, User, Project, Resource, Allocation,
+    user_summary, project_summary, allocation_summary,
+    hold_summary, charge_summary)
+from cbank.model.database import (
+    metadata, allocations, holds, jobs, charges, refunds)
+from cbank.model.migrations import migrate
+
+
+__all__ = ["populate", "reports"]
+
+
+def populate (jobs_count, seed=0, users=500, projects=50, resources=2,
+              start=datetime(2008, 1, 1)):
+
+    """Write a synthetic ledger to the bound database.
+
+    Each project has an expired and an active allocation on each
+    resource. Each job is charged to an allocation of its account;
+    one charge in ten is partly refunded, and one job in twenty
+    has an active hold.
+    """
+
+    rand = random.Random(seed)
+    now = datetime.now()
+    rows = []
+    for project in xrange(1, projects + 1):
+        for resource in xrange(1, resources + 1):
+            for (start_, end) in ((start, start + timedelta(days=365)),
+                                  (start + timedelta(days=365),
+                                   now + timedelta(days=365))):
+                rows.append({'project_id':str(project),
+                    'resource_id':str(resource), 'datetime':start_,
+                    'amount':10 ** 9, 'start':start_, 'end':end})
+    metadata.bind.execute(allocations.insert(), rows)
+    allocations_ = [(id_, project_id) for (id_, project_id) in
+        metadata.bind.execute(sqlalchemy.select(
+            [allocations.c.id, allocations.c.project_id]))]
+    by_project = {}
+    for (id_, project_id) in allocations_:
+        by_project.setdefault(project_id, []).append(id_)
+    span = (now - start).days * 86400
+    job_rows, charge_rows, refund_rows, hold_rows = [], [], [], []
+    for index in xrange(jobs_count):
+        id_ = "%i.pbs.example.com" % index
+        ctime = start + timedelta(seconds=span * index // jobs_count)
+        account = str(rand.randint(1, projects))
+        job_rows.append({'key':index + 1, 'id':id_,
+            'user_id':str(rand.randint(1, users)), 'account_id':account,
+            'queue':"shared", 'ctime':ctime, 'start':ctime,
+            'end':ctime + timedelta(hours=1)})
+        allocation = rand.choice(by_project[account])
+        charge_rows.append({'id':index + 1, 'allocation_id':allocation,
+            'datetime':ctime, 'amount':rand.randint(1, 10000),
+            'job_key':index + 1})
+        if index % 10 == 0:
+            refund_rows.append({'charge_id':index + 1, 'datetime':ctime,
+                'amount':1})
+        if index % 20 == 0:
+            hold_rows.append({'allocation_id':allocation, 'datetime':ctime,
+                'amount':100, 'active':True, 'job_key':index + 1})
+    for (table, rows) in ((jobs, job_rows), (charges, charge_rows),
+                          (refunds, refund_rows), (holds, hold_rows)):
+        for offset in xrange(0, len(rows), 10000):
+            metadata.bind.execute(table.insert(), rows[offset:offset+10000])
+
+
+def reports (users=500, projects=50):
+    """(name, function) pairs for the timed summaries."""
+    user = User.cached("1")
+    all_users = [User.cached(str(id_)) for id_ in xrange(1, users + 1)]
+    project = Project.cached("1")
+    all_projects = [Project.cached(str(id_))
+                    for id_ in xrange(1, projects + 1)]
+    after = datetime.now() - timedelta(days=30)
+    year = datetime.now() - timedelta(days=365)
+    def project_allocations ():
+        return Session.query(Allocation).filter_by(project_id="1").all()
+    return [
+        ("list users (one)", lambda: user_summary([user]).all()),
+        ("list users (all)", lambda: user_summary(all_users).all()),
+        ("list users (30 days)",
+            lambda: user_summary(all_users, after=after).all()),
+        ("list users (365 days)",
+            lambda: user_summary(all_users, after=year).all()),
+        ("list projects (one)", lambda: project_summary([project]).all()),
+        ("list projects (all)",
+            lambda: project_summary(all_projects).all()),
+        ("list projects (365 days)",
+            lambda: project_summary(all_projects, after=year).all()),
+        ("list allocations (one)",
+            lambda: allocation_summary(project_allocations()).all()),
+        ("amount available (one)",
+            lambda: [allocation.amount_available()
+                     for allocation in project_allocations()]),
+        ("list holds (one)", lambda: hold_summary(users=[user]).all()),
+        ("list charges (one)", lambda: charge_summary(users=[user]).all()),
+        ("list charges (30 days)",
+            lambda: charge_summary(after=after).all())]
+
+
+def time_reports (repeat=3):
+    """The best time of each report, in seconds."""
+    times = []
+    for (name, report) in reports():
+        best = None
+        for each in xrange(repeat):
+            start = time.time()
+            report()
+            elapsed = time.time() - start
+            Session.remove()
+            if best is None or elapsed < best:
+                best = elapsed
+        times.append((name, best))
+    return times
+
+
+def raw_days (after=None, before=None):
+    """Split no whole days from a range, to sum every charge in it."""
+    return None, [(after or datetime(1900, 1, 1),
+                   before or datetime(2100, 1, 1))]
+
+
+def drop_indexes ():
+    """Drop the ledger indexes, as in a database from before them."""
+    for table in (allocations, holds, jobs, charges, refunds):
+        for index in table.indexes:
+            index.drop(metadata.bind)
+
+
+def main ():
+    try:
+        jobs_count = int(sys.argv[1])
+    except IndexError:
+        jobs_count = 100000
+    fd, path = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    try:
+        metadata.bind = sqlalchemy.create_engine("sqlite:///%s" % path)
+        metadata.create_all()
+        drop_indexes()
+        populate(jobs_count)
+        metadata.bind.execute("ANALYZE")
+        split_days = cbank.model.queries.split_days
+        cbank.model.queries.split_days = raw_days
+        try:
+            before = time_reports()
+        finally:
+            cbank.model.queries.split_days = split_days
+        start = time.time()
+        migrate()
+        metadata.bind.execute("ANALYZE")
+        print "%i jobs; migrated in %.2f s" % (
+            jobs_count, time.time() - start)
+        after = time_reports()
+    finally:
+        metadata.bind = None
+        os.unlink(path)
+    print "%-24s %10s %10s" % ("summary", "before", "after")
+    for ((name, before_), (name, after_)) in zip(before, after):
+        print "%-24s %9.4fs %9.4fs" % (name, before_, after_)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Synthetic PBS accounting logs for benchmarks.
+
+generate -- generate the Q, S, and E records for a number of jobs
+
+Run as a script to write a log to stdout.
+
+usage: python benchmarks/pbslog.py [jobs [seed]]
+"""
+
+import sys
+import random
+import time
+
+
+__all__ = ["generate"]
+
+
+def generate (jobs, seed=0, server="pbs.example.com", users=100,
+              accounts=20, start=1208502612):
+    
+    """Generate the Q, S, and E records for a number of jobs.
+    
+    Records are yielded in timestamp order. The same arguments always
+    generate the same records.
+    
+    Arguments:
+    jobs -- the number of jobs to generate
+    
+    Keyword arguments:
+    seed -- random seed
+    server -- the pbs server name in job ids
+    users -- the number of distinct users
+    accounts -- the number of distinct accounts
+    start -- the timestamp of the first job
+    """
+    
+    rand = random.Random(seed)
+    events = []
+    for index in xrange(jobs):
+        id_ = "%i.%s" % (index, server)
+        ctime = start + index * 10
+        begin = ctime + rand.randint(0, 3600)
+        end = begin + rand.randint(60, 36 * 3600)
+        nodes = rand.choice([1, 1, 2, 4, 8, 32])
+        common = " ".join([
+            "user=user%i" % rand.randint(1, users),
+            "group=group%i" % rand.randint(1, accounts),
+            "account=project%i" % rand.randint(1, accounts),
+            "jobname=job%i" % index,
+            "queue=%s" % rand.choice(["shared", "exclusive", "debug"]),
+            "ctime=%i qtime=%i etime=%i" % (ctime, ctime, ctime)])
+        resource_list = " ".join([
+            "Resource_List.ncpus=%i" % (nodes * 8),
+            "Resource_List.nodect=%i" % nodes,
+            "Resource_List.nodes=%i" % nodes,
+            "Resource_List.walltime=%.2i:00:00" % rand.randint(1, 48)])
+        exec_host = "+".join(
+            "n%i/0" % rand.randint(0, 1023) for each in xrange(nodes))
+        events.append((ctime, "Q", id_, "queue=shared"))
+        events.append((begin, "S", id_, " ".join([
+            common, "start=%i" % begin, "exec_host=%s" % exec_host,
+            resource_list])))
+        used = end - begin
+        events.append((end, "E", id_, " ".join([
+            common, "start=%i" % begin, "exec_host=%s" % exec_host,
+            resource_list, "session=%i" % rand.randint(1000, 65535),
+            "end=%i" % end, "Exit_status=%i" % rand.choice([0, 0, 0, 1]),
+            "resources_used.cput=%s" % hms(used * nodes),
+            "resources_used.mem=%ikb" % rand.randint(1024, 1048576),
+            "resources_used.vmem=%ikb" % rand.randint(1024, 1048576),
+            "resources_used.walltime=%s" % hms(used)])))
+    events.sort()
+    for (timestamp, type_, id_, message) in events:
+        yield "%s;%s;%s;%s" % (
+            time.strftime("%m/%d/%Y %H:%M:%S", time.localtime(timestamp)),
+            type_, id_, message)
+
+
+def hms (seconds):
+    """Format a number of seconds as HH:MM:SS."""
+    return "%.2i:%.2i:%.2i" % (
+        seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+
+def main ():
+    args = [int(arg) for arg in sys.argv[1:3]]
+    jobs = (args + [5000])[0]
+    seed = (args[1:] + [0])[0]
+    for line in generate(jobs, seed):
+        print line
+
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,9 @@ Modules:
 common -- common utility functions
 controllers -- command-line parsers and controllers
 exceptions -- exceptions with associated exit codes
+imports -- reading pbs accounting logs for import
 views -- lists and detail views
 """
 
-__all__ = ["common", "controllers", "exceptions", "views"]
+__all__ = ["common", "controllers", "exceptions", "imports", "views"]
 
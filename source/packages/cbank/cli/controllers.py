@@ -4,12 +4,18 @@ main -- metacontroller that dispatches to list_main and new_main
 new_main -- metacontroller that dispatches to creation controllers
 list_main -- metacontroller that dispatches to list controllers
 import_main -- metacontroller that dispatches to import controllers
+admin_main -- metacontroller that dispatches to admin controllers
 edit_main -- metacontroller that dispatches to edit controllers
 new_allocation_main -- creates new allocations
 new_hold_main -- creates new holds
 new_charge_main -- creates new charges
 new_refund_main -- creates new refunds
 import_jobs_main -- imports pbs jobs
+admin_migrate_main -- migrates the database schema
+admin_balances_main -- verifies and rebuilds balances and daily usage
+admin_close_main -- closes the ledger before a date
+admin_archive_main -- archives the ledger before a date
+admin_backfill_main -- stores the resource values of existing jobs
 list_users_main -- users list
 list_projects_main -- projects list
 list_allocations_main -- allocations list
@@ -28,14 +34,16 @@ import os
 import sys
 import pwd
 import time
+import signal
 import ConfigParser
 from datetime import datetime, timedelta
 from textwrap import dedent
 import decorator
 
 from sqlalchemy import and_, or_
-from sqlalchemy.exceptions import InvalidRequestError, IntegrityError
-from sqlalchemy.orm import joinedload, undefer
+from sqlalchemy.exceptions import (InvalidRequestError, IntegrityError,
+    SQLAlchemyError)
+from sqlalchemy.orm import joinedload, undefer, undefer_group
 
 import cbank
 from cbank import config
@@ -43,24 +51,32 @@ from cbank.model import (
     User, Project, Resource,
     Allocation, Hold, Job, Charge, Refund,
     distribute_amount,
-    Session, get_projects, get_users, import_job,
-    hold_summary, charge_summary)
+    Session, get_projects, get_users, import_jobs,
+    hold_summary, charge_summary,
+    migrations, pending_migrations, migrate, describe_migration,
+    verify_balances, rebuild_balances, verify_usage, rebuild_usage,
+    close_period, archive_ledger, archived_jobs_by_id,
+    rebuild_resource_values, node_job_keys, listed_ids, job_keys, page)
 from cbank.cli.views import (print_allocation, print_charge,
     print_charges, print_hold, print_holds, print_refund, print_users_list,
     print_projects_list, print_allocations_list, print_holds_list,
     print_jobs_list, print_charges_list, print_allocations, print_refunds,
     print_jobs)
 from cbank.cli.common import get_unit_factor
+from cbank.cli.imports import (read_logs, follow_logs, parse_entries,
+    resume_offset, save_checkpoints, Quarantine, ImportStats)
 from cbank.exceptions import NotFound
 from cbank.cli.exceptions import (CbankException, NotPermitted,
     UnknownCommand, MissingArgument, UnexpectedArguments, MissingResource,
     UnknownAllocation, UnknownCharge, UnknownProject, ValueError_,
-    UnknownUser, MissingCommand, HasChildren)
+    UnknownUser, MissingCommand, HasChildren, UnbalancedAllocations)
 
 
-__all__ = ["main", "new_main", "import_main", "list_main",
+__all__ = ["main", "new_main", "import_main", "admin_main", "list_main",
     "new_allocation_main", "new_charge_main", "new_refund_main",
-    "import_jobs_main", "list_users_main", "list_projects_main",
+    "import_jobs_main", "admin_migrate_main", "admin_balances_main",
+    "admin_close_main", "admin_archive_main", "admin_backfill_main",
+    "list_users_main", "list_projects_main",
     "list_allocations_main", "list_holds_main", "list_charges_main"]
 
 
@@ -107,10 +123,11 @@ def main ():
     detail -- detail_main
     edit -- edit_main
     import -- import-main
+    admin -- admin_main
     """
     try:
         command = normalize(sys.argv[1],
-            ["new", "import", "list", "detail", "edit"])
+            ["new", "import", "admin", "list", "detail", "edit"])
     except (IndexError, UnknownCommand):
         if help_requested():
             print_main_help()
@@ -122,6 +139,8 @@ def main ():
         return new_main()
     elif command == "import":
         return import_main()
+    elif command == "admin":
+        return admin_main()
     elif command == "list":
         return list_main()
     elif command == "detail":
@@ -358,33 +377,369 @@ def import_jobs_main ():
     """Import jobs from pbs accounting logs."""
     parser = import_jobs_parser()
     options, args = parser.parse_args()
+    if options.workers < 0:
+        raise ValueError_("workers: %s" % options.workers)
+    if options.chunk_size < 1:
+        raise ValueError_("chunk size: %s" % options.chunk_size)
+    if options.interval <= 0:
+        raise ValueError_("interval: %s" % options.interval)
+    if options.batch_size < 1:
+        raise ValueError_("batch size: %s" % options.batch_size)
+    if options.stats is not None and options.stats <= 0:
+        raise ValueError_("stats interval: %s" % options.stats)
+    if options.resume:
+        resume = resume_offset
+    else:
+        resume = None
+    paths = args or ["-"]
+    if options.follow:
+        if "-" in paths:
+            raise ValueError_("cannot follow stdin")
+        lines = follow_logs(paths, resume, options.interval)
+    else:
+        lines = read_logs(paths, resume)
+    if options.quarantine:
+        try:
+            quarantine = Quarantine(open(options.quarantine, "a"))
+        except IOError, ex:
+            raise ValueError_("%s: %s" % (ex.filename, ex.strerror))
+    else:
+        quarantine = None
+    if options.stats_file:
+        try:
+            stats_file = open(options.stats_file, "a")
+        except IOError, ex:
+            raise ValueError_("%s: %s" % (ex.filename, ex.strerror))
+        stats = ImportStats(stats_file, options.stats, format="json")
+    elif options.stats:
+        stats_file = None
+        stats = ImportStats(sys.stderr, options.stats)
+    else:
+        stats_file = None
+        stats = ImportStats()
+    def reject (line, error):
+        print >> sys.stderr, error
+        stats.rejected += 1
+        if quarantine is not None:
+            quarantine.reject(line, error)
+    def commit (batch, offsets):
+        start = time.time()
+        inserted, updated = commit_jobs(batch, offsets, reject, quarantine,
+                                        options.resource)
+        stats.committed(time.time() - start, inserted, updated)
+    entries = parse_entries(lines, options.workers, options.chunk_size)
+    stopping = []
+    handlers = {}
+    if options.follow:
+        def stop (signum, frame):
+            stopping.append(signum)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            handlers[signum] = signal.signal(signum, stop)
+    batch = []
+    offsets = {}
+    started = None
+    # jobs are written with bulk statements, and never read back
+    s = Session()
+    expire_on_commit = s.expire_on_commit
+    s.expire_on_commit = False
+    try:
+        try:
+            for entry in stats.timed(entries):
+                stats.poll()
+                if stopping:
+                    break
+                if entry is None:
+                    if offsets:
+                        commit(batch, offsets)
+                        batch = []
+                        offsets = {}
+                    continue
+                (line, log, offset, record, error) = entry
+                offsets[log] = offset
+                if error is not None:
+                    reject(line, error)
+                    continue
+                if options.verbose:
+                    print >> sys.stderr, record[0]
+                if not batch:
+                    started = time.time()
+                batch.append((line, record))
+                if len(batch) >= options.batch_size or (options.follow
+                        and time.time() - started >= options.interval):
+                    commit(batch, offsets)
+                    batch = []
+                    offsets = {}
+        except IOError, ex:
+            raise ValueError_("%s: %s" % (ex.filename, ex.strerror))
+        commit(batch, offsets)
+        stats.report(final=True)
+    finally:
+        entries.close()
+        for (signum, handler) in handlers.iteritems():
+            signal.signal(signum, handler)
+        s.expire_on_commit = expire_on_commit
+        if quarantine is not None:
+            quarantine.close()
+        if stats_file is not None:
+            stats_file.close()
+
+
+def admin_main ():
+    """Secondary cli metacommand for administering the database.
+    
+    Commands:
+    migrate -- admin_migrate_main
+    balances -- admin_balances_main
+    close -- admin_close_main
+    archive -- admin_archive_main
+    backfill -- admin_backfill_main
+    """
+    commands = ["migrate", "balances", "close", "archive", "backfill"]
+    try:
+        command = normalize(sys.argv[1], commands)
+    except UnknownCommand:
+        if help_requested():
+            print_admin_main_help()
+            sys.exit()
+        else:
+            raise
+    except IndexError:
+        if help_requested():
+            print_admin_main_help()
+            sys.exit()
+        else:
+            raise MissingCommand(", ".join(commands))
+    replace_command()
+    if command == "migrate":
+        return admin_migrate_main()
+    elif command == "balances":
+        return admin_balances_main()
+    elif command == "close":
+        return admin_close_main()
+    elif command == "archive":
+        return admin_archive_main()
+    elif command == "backfill":
+        return admin_backfill_main()
+
+
+def print_admin_main_help ():
+    """Print help for the 'cbank admin' metacommand."""
+    command = os.path.basename(sys.argv[0])
+    message = """\
+        usage: %(command)s <command>
+        
+        Administer the cbank database:
+          migrate, balances, close, archive, backfill
+        
+        Each command has its own set of options. For help with a specific
+        command, run
+          %(command)s <command> -h"""
+    print dedent(message % {'command':command})
+
+
+@handle_exceptions
+@require_admin
+def admin_migrate_main ():
+    """Apply pending schema migrations to the database."""
+    parser = admin_migrate_parser()
+    options, args = parser.parse_args()
     if args:
         raise UnexpectedArguments(args)
-    s = Session()
-    counter = 0
-    for line in read(sys.stdin):
+    if options.to_version is not None and not (
+            0 <= options.to_version <= len(migrations)):
+        raise ValueError_("version: %s" % options.to_version)
+    if options.dry_run:
+        pending = [(version, migration) for (version, migration)
+                   in pending_migrations()
+                   if options.to_version is None
+                   or version <= options.to_version]
+    else:
         try:
-            job = import_job(line)
-        except ValueError, e:
-            print >> sys.stderr, e
-            continue
-        if options.verbose:
-            print >> sys.stderr, job
-        Session.add(job)
-        counter += 1
-        if counter >= 100:
-            s.commit()
-            counter = 0
-    if counter != 0:
+            pending = migrate(version=options.to_version)
+        except SQLAlchemyError, ex:
+            raise ValueError_("migration failed: %s" % database_error(ex))
+    for (version, migration) in pending:
+        print "%i %s" % (version, describe_migration(migration))
+
+
+@handle_exceptions
+@require_admin
+def admin_balances_main ():
+    """Verify (or rebuild) stored allocation balances and daily usage."""
+    parser = admin_balances_parser()
+    options, args = parser.parse_args()
+    if args:
+        raise UnexpectedArguments(args)
+    s = Session()
+    unbalanced = verify_balances(s)
+    for (allocation_id, stored, computed) in unbalanced:
+        print "%i %s %s" % (allocation_id,
+            format_sums(stored), format_sums(computed))
+    unbalanced_usage = verify_usage(s)
+    for ((day, user_id, project_id, resource_id), stored, computed) \
+            in unbalanced_usage:
+        print "%s %s %s %s %s %s" % (day, user_id or "-", project_id,
+            resource_id, format_sums(stored), format_sums(computed))
+    if options.rebuild:
+        rebuild_balances(s)
+        rebuild_usage(s)
+        s.commit()
+    elif unbalanced or unbalanced_usage:
+        raise UnbalancedAllocations(
+            len(unbalanced) + len(unbalanced_usage))
+
+
+@handle_exceptions
+@require_admin
+def admin_close_main ():
+    """Close the ledger before a date."""
+    parser = admin_close_parser()
+    options, args = parser.parse_args()
+    if args:
+        raise UnexpectedArguments(args)
+    if options.before is None:
+        raise MissingArgument("before")
+    s = Session()
+    try:
+        count = close_period(s, options.before)
+    except ValueError, ex:
+        raise ValueError_(ex)
+    s.commit()
+    print "closed before %s (%i allocations)" % (options.before, count)
+
+
+@handle_exceptions
+@require_admin
+def admin_archive_main ():
+    """Archive the ledger before a date."""
+    parser = admin_archive_parser()
+    options, args = parser.parse_args()
+    if args:
+        raise UnexpectedArguments(args)
+    if options.before is None:
+        raise MissingArgument("before")
+    s = Session()
+    try:
+        counts = archive_ledger(s, options.before)
+    except ValueError, ex:
+        raise ValueError_(ex)
+    s.commit()
+    print "archived before %s (%i jobs, %i holds, %i charges, %i refunds)" % (
+        (options.before, ) + counts)
+
+
+@handle_exceptions
+@require_admin
+def admin_backfill_main ():
+    """Store the resource values of existing jobs."""
+    parser = admin_backfill_parser()
+    options, args = parser.parse_args()
+    if args:
+        raise UnexpectedArguments(args)
+    if options.batch_size < 1:
+        raise ValueError_("batch size: %s" % options.batch_size)
+    s = Session()
+    count = rebuild_resource_values(s, options.batch_size)
+    s.commit()
+    print "%i resource values stored" % count
+
+
+def format_sums (sums):
+    """Format stored or computed sums as a/b/c (or missing)."""
+    if sums is None:
+        return "missing"
+    return "/".join(str(sum_) for sum_ in sums)
+
+
+def commit_jobs (batch, offsets, reject, quarantine=None, resource=None):
+    
+    """Import a batch of jobs, and commit them with import checkpoints.
+    
+    The jobs that cannot be imported are isolated in savepoints (see
+    import_bisected), and the jobs that can be are committed with the
+    checkpoints in a single transaction. The lines of the jobs that
+    cannot be imported are rejected, and the checkpoints are committed
+    past them. If none of the jobs can be imported, nothing is
+    committed and the error is raised instead, as it is unlikely to be
+    caused by the jobs themselves.
+    
+    Arguments:
+    batch -- (line, record) pairs, as parsed from the logs
+    offsets -- offsets to save with save_checkpoints
+    reject -- a function called with each rejected line and its error
+    
+    Keyword arguments:
+    quarantine -- a Quarantine to flush before committing checkpoints,
+        so that no rejected line is lost
+    resource -- the resource the jobs ran on (see import_jobs)
+    
+    The session is cleared once the batch is committed, so that no
+    state is kept from one batch to the next.
+    
+    Returns the number of jobs inserted and updated.
+    """
+    
+    s = Session()
+    groups = {}
+    for (line, record) in batch:
+        groups.setdefault(record[0], []).append((line, record))
+    rejected, inserted, updated = import_bisected(groups.values(), resource)
+    if len(rejected) == len(groups) > 1:
+        s.rollback()
+        raise ValueError_(database_error(rejected[0][1]))
+    for (group, error) in rejected:
+        for (line, record) in group:
+            reject(line, "%s: %s" % (record[0], database_error(error)))
+    if quarantine is not None:
+        quarantine.flush()
+    save_checkpoints(offsets)
+    s.commit()
+    s.expunge_all()
+    return inserted, updated
+
+
+def import_bisected (groups, resource=None):
+    
+    """Import groups of jobs, isolating the groups that cannot be.
+    
+    The groups are imported together in a savepoint. If that fails,
+    the savepoint is rolled back, and each half is imported in a
+    savepoint of its own, down to single groups. Nothing is committed.
+    
+    Arguments:
+    groups -- lists of the (line, record) pairs for each job
+    
+    Keyword arguments:
+    resource -- the resource the jobs ran on (see import_jobs)
+    
+    Returns the (group, error) pairs that could not be imported, and
+    the number of jobs inserted and updated.
+    """
+    
+    s = Session()
+    s.begin_nested()
+    try:
+        inserted, updated = import_jobs(
+            [record for group in groups for (line, record) in group],
+            resource)
         s.commit()
+    except SQLAlchemyError, ex:
+        s.rollback()
+        if len(groups) == 1:
+            return [(groups[0], ex)], 0, 0
+        middle = len(groups) // 2
+        rejected_1, inserted_1, updated_1 = import_bisected(
+            groups[:middle], resource)
+        rejected_2, inserted_2, updated_2 = import_bisected(
+            groups[middle:], resource)
+        return (rejected_1 + rejected_2, inserted_1 + inserted_2,
+                updated_1 + updated_2)
+    return [], inserted, updated
 
 
-def read (f):
-    for line in f:
-        line = line.strip()
-        if not line or line.startswith("#"):
-            continue
-        yield line
+def database_error (ex):
+    """The message of a database error, on a single line."""
+    return " ".join(str(getattr(ex, "orig", ex)).split())
 
 
 def pop_project (args, index):
@@ -644,13 +999,9 @@ def list_allocations_main ():
     projects = options.projects
     users = options.users
     if current_user in configured_admins():
-        if not projects:
-            if users:
-                projects = user_projects_all(users)
-            else:
-                projects = [
-                    Project.cached(project_id)
-                    for (project_id, ) in Session.query(Allocation.project_id)]
+        # without projects or users, all allocations are listed
+        if not projects and users:
+            projects = user_projects_all(users)
     else:
         if not projects:
             projects = get_projects(member=current_user)
@@ -665,11 +1016,13 @@ def list_allocations_main ():
     comments = options.comments
     allocations = Session.query(Allocation)
     if resources:
-        allocations = allocations.filter(
-            Allocation.resource_id.in_(resource.id for resource in resources))
+        allocations = allocations.filter(Allocation.resource_id.in_(
+            listed_ids("resources",
+                (resource.id for resource in resources), Session())))
     if projects:
-        allocations = allocations.filter(
-            Allocation.project_id.in_(project.id for project in projects))
+        allocations = allocations.filter(Allocation.project_id.in_(
+            listed_ids("projects",
+                (project.id for project in projects), Session())))
     if not (options.after or options.before):
         now = datetime.now()
         allocations = allocations.filter(and_(
@@ -682,7 +1035,9 @@ def list_allocations_main ():
         if options.before:
             allocations = allocations.filter(
                 Allocation.start <= options.before)
-    print_allocations_list(allocations.all(), users=users,
+    # the query itself is summarized, so that the allocations are
+    # selected in the same statement as their balances
+    print_allocations_list(allocations, users=users,
         after=options.after, before=options.before, comments=comments,
         truncate=(not options.long))
 
@@ -708,11 +1063,21 @@ def list_holds_main ():
             elif set(users) != set([current_user]):
                 raise NotPermitted(current_user)
     resources = options.resources or configured_resources()
-    holds = hold_summary(
-        users=users, projects=projects,
-        resources=resources, jobs=options.jobs,
-        after=options.after, before=options.before)
-    print_holds_list(holds, comments=options.comments, truncate=(not options.long))
+    if options.batch_size < 1:
+        raise ValueError_("batch size: %s" % options.batch_size)
+    if options.limit is not None and options.limit < 1:
+        raise ValueError_("limit: %s" % options.limit)
+    try:
+        holds = hold_summary(
+            users=users, projects=projects,
+            resources=resources, jobs=options.jobs,
+            after=options.after, before=options.before,
+            batch_size=options.batch_size,
+            cursor=options.after_cursor, limit=options.limit)
+    except ValueError, ex:
+        raise ValueError_(ex)
+    print_holds_list(holds, comments=options.comments,
+        truncate=(not options.long), limit=options.limit)
 
 
 @handle_exceptions
@@ -739,10 +1104,10 @@ def list_jobs_main ():
         joinedload(Job.charges, Charge.refunds))
     if users:
         jobs = jobs.filter(Job.user_id.in_(
-            user.id for user in users))
+            listed_ids("users", (user.id for user in users), Session())))
     if projects:
-        jobs = jobs.filter(Job.account_id.in_(
-            project_.id for project_ in projects))
+        jobs = jobs.filter(Job.account_id.in_(listed_ids("projects",
+            (project_.id for project_ in projects), Session())))
     if options.after:
         jobs = jobs.filter(or_(Job.start >= options.after,
             Job.end > options.after))
@@ -750,9 +1115,18 @@ def list_jobs_main ():
         jobs = jobs.filter(or_(Job.start < options.before,
             Job.end <= options.before))
     if resources:
-        jobs = jobs.filter(Job.charges.any(Charge.allocation.has(
-            Allocation.resource_id.in_(resource.id for resource in resources))))
-    print_jobs_list(jobs, truncate=(not options.long))
+        jobs = jobs.filter(Job.resource_id.in_(listed_ids("resources",
+            (resource.id for resource in resources), Session())))
+    if options.nodes:
+        jobs = jobs.filter(Job.key.in_(node_job_keys(options.nodes)))
+    if options.limit is not None and options.limit < 1:
+        raise ValueError_("limit: %s" % options.limit)
+    if options.after_cursor is not None or options.limit is not None:
+        try:
+            jobs = page(jobs, job_keys, options.after_cursor, options.limit)
+        except ValueError, ex:
+            raise ValueError_(ex)
+    print_jobs_list(jobs, truncate=(not options.long), limit=options.limit)
 
 
 @handle_exceptions
@@ -777,13 +1151,22 @@ def list_charges_main ():
                 raise NotPermitted(current_user)
     resources = options.resources or configured_resources()
     comments = options.comments
+    if options.batch_size < 1:
+        raise ValueError_("batch size: %s" % options.batch_size)
+    if options.limit is not None and options.limit < 1:
+        raise ValueError_("limit: %s" % options.limit)
 
-    charges = charge_summary(
-        users=users, projects=projects,
-        resources=resources, jobs=options.jobs,
-        after=options.after, before=options.before)
+    try:
+        charges = charge_summary(
+            users=users, projects=projects,
+            resources=resources, jobs=options.jobs,
+            after=options.after, before=options.before,
+            batch_size=options.batch_size,
+            cursor=options.after_cursor, limit=options.limit)
+    except ValueError, ex:
+        raise ValueError_(ex)
     print_charges_list(charges, comments=comments,
-        truncate=(not options.long))
+        truncate=(not options.long), limit=options.limit)
 
 
 @handle_exceptions
@@ -883,6 +1266,10 @@ def detail_jobs_main ():
     current_user = get_current_user()
     s = Session()
     jobs = s.query(Job).filter(Job.id.in_(sys.argv[1:]))
+    jobs = jobs.options(undefer_group("details")).all()
+    found = set(job.id for job in jobs)
+    jobs.extend(archived_jobs_by_id(s,
+        [id_ for id_ in sys.argv[1:] if id_ not in found]))
     if not current_user in configured_admins():
         admin_projects = get_projects(manager=current_user)
         permitted_jobs = []
@@ -1061,13 +1448,20 @@ def edit_charge_main ():
             except IntegrityError:
                 Session.rollback()
                 raise HasChildren("%s has child entities" % charge)
+            except ValueError, ex:
+                Session.rollback()
+                raise ValueError_(ex)
     else:
         if options.allocation:
             charge.allocation = options.allocation
         if options.comment is not None:
             charge.comment = options.comment
         if options.commit:
-            Session.commit()
+            try:
+                Session.commit()
+            except ValueError, ex:
+                Session.rollback()
+                raise ValueError_(ex)
     print_charge(charge)
 
 
@@ -1086,7 +1480,11 @@ def edit_refund_main ():
         if options.comment is not None:
             refund.comment = options.comment
     if options.commit:
-        Session.commit()
+        try:
+            Session.commit()
+        except ValueError, ex:
+            Session.rollback()
+            raise ValueError_(ex)
     print_refund(refund)
 
 
@@ -1271,8 +1669,18 @@ def list_holds_parser ():
     parser.add_option(Option("-j", "--job",
         dest="jobs", type="job", action="append",
         help="list charges related to JOB", metavar="JOB"))
+    parser.add_option(Option("--batch-size", dest="batch_size",
+        type="int", metavar="N",
+        help="fetch holds N at a time"))
+    parser.add_option(Option("--limit", dest="limit",
+        type="int", metavar="N",
+        help="list at most N holds"))
+    parser.add_option(Option("--after-cursor", dest="after_cursor",
+        metavar="CURSOR",
+        help="list the holds after CURSOR (from a previous list)"))
     parser.set_defaults(projects=[], users=[], resources=[], jobs=[],
-        comments=False, long=False)
+        comments=False, long=False, batch_size=1000,
+        limit=None, after_cursor=None)
     return parser
 
 
@@ -1288,6 +1696,9 @@ def list_jobs_parser ():
     parser.add_option(Option("-r", "--resource",
         dest="resources", type="resource", action="append",
         help="list charges for RESOURCE", metavar="RESOURCE"))
+    parser.add_option(Option("-n", "--node",
+        dest="nodes", action="append",
+        help="list jobs that ran on NODE", metavar="NODE"))
     parser.add_option(Option("-a", "--after",
         dest="after", type="date",
         help="list jobs after (and including) DATE", metavar="DATE"))
@@ -1297,7 +1708,13 @@ def list_jobs_parser ():
     parser.add_option(Option("-l", "--long",
         dest="long", action="store_true",
         help="do not truncate long strings"))
-    parser.set_defaults(long=False)
+    parser.add_option(Option("--limit", dest="limit",
+        type="int", metavar="N",
+        help="list at most N jobs"))
+    parser.add_option(Option("--after-cursor", dest="after_cursor",
+        metavar="CURSOR",
+        help="list the jobs after CURSOR (from a previous list)"))
+    parser.set_defaults(long=False, limit=None, after_cursor=None)
     return parser
 
 
@@ -1328,8 +1745,18 @@ def list_charges_parser ():
     parser.add_option(Option("-j", "--job",
         dest="jobs", type="job", action="append",
         help="list charges related to JOB", metavar="JOB"))
+    parser.add_option(Option("--batch-size", dest="batch_size",
+        type="int", metavar="N",
+        help="fetch charges N at a time"))
+    parser.add_option(Option("--limit", dest="limit",
+        type="int", metavar="N",
+        help="list at most N charges"))
+    parser.add_option(Option("--after-cursor", dest="after_cursor",
+        metavar="CURSOR",
+        help="list the charges after CURSOR (from a previous list)"))
     parser.set_defaults(projects=[], users=[], resources=[], jobs=[],
-        comments=False, long=False)
+        comments=False, long=False, batch_size=1000,
+        limit=None, after_cursor=None)
     return parser
 
 
@@ -1463,10 +1890,105 @@ def edit_refund_parser ():
 
 def import_jobs_parser ():
     """An optparse parser for importing jobs."""
-    parser = optparse.OptionParser(version=cbank.__version__)
+    parser = optparse.OptionParser(version=cbank.__version__,
+        usage="%prog [options] [log ...]")
     parser.add_option(Option("-v", "--verbose", dest="verbose",
         action="store_true", help="display each imported job"))
-    parser.set_defaults(verbose=False)
+    parser.add_option(Option("--no-resume", dest="resume",
+        action="store_false",
+        help="read logs from the beginning, ignoring import checkpoints"))
+    parser.add_option(Option("-w", "--workers", dest="workers",
+        type="int", metavar="N",
+        help="parse records in N worker processes"))
+    parser.add_option(Option("--chunk-size", dest="chunk_size",
+        type="int", metavar="N",
+        help="send N records to a worker at a time"))
+    parser.add_option(Option("-f", "--follow", dest="follow",
+        action="store_true",
+        help="follow logs as they are written, until terminated"))
+    parser.add_option(Option("-i", "--interval", dest="interval",
+        type="float", metavar="SECONDS",
+        help="check followed logs and commit jobs every SECONDS"))
+    parser.add_option(Option("-b", "--batch-size", dest="batch_size",
+        type="int", metavar="N",
+        help="commit jobs N records at a time"))
+    parser.add_option(Option("-q", "--quarantine", dest="quarantine",
+        metavar="FILE",
+        help="append rejected records, and their errors, to FILE"))
+    parser.add_option(Option("-s", "--stats", dest="stats",
+        type="float", metavar="SECONDS",
+        help="report import statistics every SECONDS"))
+    parser.add_option(Option("--stats-file", dest="stats_file",
+        metavar="FILE",
+        help="append import statistics to FILE, as JSON"))
+    parser.add_option(Option("-r", "--resource", dest="resource",
+        type="resource",
+        help="record the jobs as run on RESOURCE", metavar="RESOURCE"))
+    parser.set_defaults(verbose=False, resume=True, workers=0,
+        chunk_size=1000, follow=False, interval=1.0, batch_size=100,
+        quarantine=None, stats=None, stats_file=None,
+        resource=configured_resource())
+    return parser
+
+
+def admin_migrate_parser ():
+    """An optparse parser for migrating the database."""
+    parser = optparse.OptionParser(version=cbank.__version__,
+        usage="%prog [options]")
+    parser.add_option(Option("-n", "--dry-run", dest="dry_run",
+        action="store_true",
+        help="list pending migrations without applying them"))
+    parser.add_option(Option("-t", "--to", dest="to_version",
+        type="int", metavar="VERSION",
+        help="migrate up to schema VERSION"))
+    parser.set_defaults(dry_run=False, to_version=None)
+    return parser
+
+
+def admin_balances_parser ():
+    """An optparse parser for verifying balances and daily usage."""
+    parser = optparse.OptionParser(version=cbank.__version__,
+        usage="%prog [options]")
+    parser.add_option(Option("-r", "--rebuild", dest="rebuild",
+        action="store_true",
+        help="recompute the stored balances and usage from the ledger"))
+    parser.set_defaults(rebuild=False)
+    return parser
+
+
+def admin_close_parser ():
+    """An optparse parser for closing the ledger."""
+    parser = optparse.OptionParser(version=cbank.__version__,
+        usage="%prog -b DATE")
+    parser.add_option(Option("-b", "--before",
+        dest="before", type="date",
+        help="close charges and refunds before (and excluding) DATE",
+        metavar="DATE"))
+    parser.set_defaults(before=None)
+    return parser
+
+
+def admin_archive_parser ():
+    """An optparse parser for archiving the ledger."""
+    parser = optparse.OptionParser(version=cbank.__version__,
+        usage="%prog -b DATE")
+    parser.add_option(Option("-b", "--before",
+        dest="before", type="date",
+        help="archive jobs, holds, charges, and refunds before "
+             "(and excluding) DATE",
+        metavar="DATE"))
+    parser.set_defaults(before=None)
+    return parser
+
+
+def admin_backfill_parser ():
+    """An optparse parser for storing the resource values of jobs."""
+    parser = optparse.OptionParser(version=cbank.__version__,
+        usage="%prog [options]")
+    parser.add_option(Option("-b", "--batch-size", dest="batch_size",
+        type="int", metavar="N",
+        help="read jobs N at a time"))
+    parser.set_defaults(batch_size=1000)
     return parser
 
 
@@ -18,12 +18,14 @@ MissingResource -- no resource was specified (-7)
 ValueError_ -- wrapper for the ValueError builtin (-8)
 MissingCommand -- a required dispatch command was not specified (-9)
 HasChildren -- an entity has dependent child entities (-10)
+UnbalancedAllocations -- stored balances differ from the ledger (-11)
 """
 
 __all__ = ["CbankException", "CbankError", "UnknownEntity", "UnknownUser",
     "UnknownProject", "UnknownAllocation", "UnknownCharge", "MissingArgument",
     "UnexpectedArguments", "UnknownCommand", "NotPermitted",
-    "MissingResource", "ValueError_", "MissingCommand", "HasChildren"]
+    "MissingResource", "ValueError_", "MissingCommand", "HasChildren",
+    "UnbalancedAllocations"]
 
 
 class CbankException (Exception):
@@ -209,3 +211,16 @@ class HasChildren (CbankError):
             return "cbank: dependent children: %s" % self.args[0]
         else:
             return "cbank: dependent children"
+
+
+class UnbalancedAllocations (CbankError):
+    
+    """Stored allocation balances or daily usage differ from the ledger."""
+    
+    exit_code = -11
+    
+    def __str__ (self):
+        if self.args:
+            return "cbank: unbalanced allocations: %s" % self.args[0]
+        else:
+            return "cbank: unbalanced allocations"
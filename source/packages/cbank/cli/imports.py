@@ -0,0 +1,710 @@
+"""Reading PBS accounting logs for import.
+
+FollowedLog -- a log that is followed as it grows and rotates
+ImportStats -- throughput and latency of an import
+LogFile -- a log file that can be read from a checkpoint
+Quarantine -- a file of rejected log lines
+follow_logs -- read logs as they are written
+log_streams -- expand files, directories, and globs into log streams
+open_log -- open a (possibly compressed) log file
+parse_entries -- parse log entries as jobs, in worker processes
+parse_lines -- parse a chunk of lines as jobs
+percentile -- a percentile of a sorted list of values
+read_logs -- merge lines from multiple logs in timestamp order
+resume_offset -- the offset at which a previous import of a log stopped
+save_checkpoints -- record how far logs have been imported
+timestamp -- a sortable key for the timestamp of a log line
+"""
+
+import os
+import sys
+import glob
+import gzip
+import bz2
+import errno
+import heapq
+import json
+import math
+import multiprocessing
+import signal
+import time
+from collections import deque
+
+from hashlib import sha1
+
+from cbank.model import get_import_checkpoint, set_import_checkpoint
+from cbank.model.entities import parse_job
+
+
+__all__ = ["FollowedLog", "ImportStats", "LogFile", "Quarantine",
+    "follow_logs", "log_streams", "open_log", "parse_entries",
+    "parse_lines", "percentile", "read_logs", "resume_offset",
+    "save_checkpoints", "timestamp"]
+
+
+GZIP_MAGIC = "\x1f\x8b"
+BZIP2_MAGIC = "BZh"
+
+HEAD_SIZE = 1024
+
+
+class LogFile (object):
+
+    """A log file that can be read from a checkpoint.
+
+    Attributes:
+    path -- the path to the file ("-" for stdin)
+    inode -- the inode of the file
+    size -- the size of the file when it was opened
+    head -- a hash of the beginning of the file
+    """
+
+    def __init__ (self, path):
+        """Initialize a log file.
+
+        Arguments:
+        path -- the path to the file ("-" for stdin)
+        """
+        if path == "-":
+            self.path = path
+        else:
+            self.path = os.path.abspath(path)
+        self.inode = None
+        self.size = None
+        self.head = None
+
+    def __repr__ (self):
+        return "<%s path=%r>" % (self.__class__.__name__, self.path)
+
+    def identify (self):
+        """Record the identity (inode, size, and head) of the file."""
+        stat = os.stat(self.path)
+        self.inode = stat.st_ino
+        self.size = stat.st_size
+        self.head = head_hash(self.path, self.size)
+
+    def refresh (self):
+        """Update the size and head of the file, as it is written.
+
+        Returns False (and leaves the identity alone) if the file has
+        been replaced or removed.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        if stat.st_ino != self.inode:
+            return False
+        if self.size < HEAD_SIZE:
+            self.head = head_hash(self.path, stat.st_size)
+        self.size = stat.st_size
+        return True
+
+    def lines (self, offset=0):
+
+        """Significant lines of the file, with the offset after each.
+
+        Offsets are in the decompressed file. A final line that is not
+        yet terminated is yielded with the offset before it, so that
+        it is read again once it is complete.
+
+        Arguments:
+        offset -- where to start reading
+        """
+
+        f = open_log(self.path)
+        try:
+            if offset:
+                f.seek(offset)
+            for line in iter(f.readline, ""):
+                if line.endswith("\n"):
+                    offset += len(line)
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    yield line, offset
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+class Quarantine (object):
+
+    """A file of rejected log lines.
+
+    Each line is preceded by a comment giving the error that rejected
+    it, so that the file can itself be imported once the errors have
+    been corrected.
+    """
+
+    def __init__ (self, file_):
+        """Initialize a quarantine.
+
+        Arguments:
+        file_ -- the file to write rejected lines to
+        """
+        self.file = file_
+
+    def reject (self, line, error):
+        """Write a rejected line, and the error that rejected it."""
+        print >> self.file, "# %s" % error
+        print >> self.file, line
+
+    def flush (self):
+        """Write rejected lines through to disk."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close (self):
+        self.file.close()
+
+
+class ImportStats (object):
+
+    """Throughput and latency of an import, reported periodically.
+
+    Counts and times are kept for the whole import. Commit latency
+    percentiles, and the current rate, are of the period since the
+    previous report, so that nothing grows with the size of the
+    import.
+
+    Attributes:
+    records -- the number of records read
+    rejected -- the number of records rejected
+    inserted -- the number of jobs inserted
+    updated -- the number of jobs updated
+    parse_time -- seconds spent reading and parsing records
+    database_time -- seconds spent importing and committing jobs
+    idle_time -- seconds spent waiting for followed logs to be written
+    commits -- the number of batches committed
+    """
+
+    def __init__ (self, file_=None, interval=None, format="text"):
+        """Initialize import stats.
+
+        Keyword arguments:
+        file_ -- the file to write reports to (None writes no reports)
+        interval -- seconds between reports (None reports at the end)
+        format -- "text", or "json" for a JSON object per line
+        """
+        self.file = file_
+        self.interval = interval
+        self.format = format
+        self.started = time.time()
+        self.records = 0
+        self.rejected = 0
+        self.inserted = 0
+        self.updated = 0
+        self.parse_time = 0.0
+        self.database_time = 0.0
+        self.idle_time = 0.0
+        self.commits = 0
+        self.latencies = []
+        self.reported = self.started
+        self.reported_records = 0
+
+    def timed (self, entries):
+        """Count entries, and time reading them as parsing.
+
+        The wait for the entry after a None (as from follow_logs) is
+        counted as idle time instead.
+        """
+        entries = iter(entries)
+        idle = False
+        while True:
+            start = time.time()
+            try:
+                entry = entries.next()
+            except StopIteration:
+                return
+            seconds = time.time() - start
+            if idle:
+                self.idle_time += seconds
+            else:
+                self.parse_time += seconds
+            idle = entry is None
+            if entry is not None:
+                self.records += 1
+            yield entry
+
+    def committed (self, seconds, inserted, updated):
+        """Record a committed batch."""
+        self.database_time += seconds
+        self.commits += 1
+        self.latencies.append(seconds)
+        self.inserted += inserted
+        self.updated += updated
+
+    def poll (self):
+        """Report, if the interval has passed since the last report."""
+        if (self.interval is not None
+                and time.time() - self.reported >= self.interval):
+            self.report()
+
+    def report (self, final=False):
+        """Write a report, and start a new period."""
+        now = time.time()
+        latencies = sorted(self.latencies)
+        elapsed = now - self.started
+        period = now - self.reported
+        stats = {
+            'time':now,
+            'final':final,
+            'elapsed':elapsed,
+            'records':self.records,
+            'rejected':self.rejected,
+            'inserted':self.inserted,
+            'updated':self.updated,
+            'records_per_second':rate(self.records, elapsed),
+            'current_records_per_second':rate(
+                self.records - self.reported_records, period),
+            'parse_seconds':self.parse_time,
+            'database_seconds':self.database_time,
+            'idle_seconds':self.idle_time,
+            'commits':self.commits,
+            'commit_p50':percentile(latencies, 0.5),
+            'commit_p90':percentile(latencies, 0.9),
+            'commit_p99':percentile(latencies, 0.99),
+            'commit_max':percentile(latencies, 1.0)}
+        self.latencies = []
+        self.reported = now
+        self.reported_records = self.records
+        if self.file is None:
+            return stats
+        if self.format == "json":
+            print >> self.file, json.dumps(stats, sort_keys=True)
+        else:
+            print >> self.file, format_stats(stats)
+        self.file.flush()
+        return stats
+
+
+def rate (count, seconds):
+    """Count per second, or 0 if no time has passed."""
+    if seconds > 0:
+        return count / seconds
+    return 0.0
+
+
+def percentile (values, fraction):
+    """A percentile of a sorted list of values (nearest rank).
+
+    Returns None if there are no values.
+    """
+    if not values:
+        return None
+    index = int(math.ceil(fraction * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+def format_stats (stats):
+    """A line of text for an ImportStats report."""
+    line = ("%(elapsed).1f s: %(records)i records "
+            "(%(records_per_second).0f/s, %(current_records_per_second).0f/s "
+            "now), %(inserted)i inserted, %(updated)i updated, "
+            "%(rejected)i rejected; parse %(parse_seconds).2f s, "
+            "database %(database_seconds).2f s" % stats)
+    if stats['commit_p50'] is not None:
+        line += ("; commit p50 %(commit_p50).3f s, p90 %(commit_p90).3f s, "
+                 "p99 %(commit_p99).3f s, max %(commit_max).3f s" % stats)
+    return line
+
+
+def head_hash (path, size):
+    """A hash of (up to) the first HEAD_SIZE bytes of a file."""
+    f = open(path, "rb")
+    try:
+        return sha1(f.read(min(size, HEAD_SIZE))).hexdigest()
+    finally:
+        f.close()
+
+
+def log_streams (paths):
+
+    """Expand files, directories, and globs into log streams.
+
+    Each path becomes a list of files that are read one after
+    another: the files in a directory (or matching a glob) are read
+    in name order, as PBS names its daily logs by date.
+
+    Raises IOError if a path does not exist.
+    """
+
+    streams = []
+    for path in paths:
+        if path == "-" or os.path.isfile(path):
+            streams.append([path])
+        elif os.path.isdir(path):
+            streams.append(directory_files(path))
+        else:
+            matches = sorted(glob.glob(path))
+            if not matches:
+                raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            files = []
+            for match in matches:
+                if os.path.isdir(match):
+                    files.extend(directory_files(match))
+                else:
+                    files.append(match)
+            streams.append(files)
+    return streams
+
+
+def directory_files (path):
+    """The (non-hidden) files in a directory, in name order."""
+    return [
+        os.path.join(path, name) for name in sorted(os.listdir(path))
+        if not name.startswith(".")
+        and os.path.isfile(os.path.join(path, name))]
+
+
+def open_log (path):
+    """Open a log for reading, decompressing gzip and bzip2 files.
+
+    The path "-" is standard input.
+    """
+    if path == "-":
+        return sys.stdin
+    f = open(path, "rb")
+    try:
+        magic = f.read(len(BZIP2_MAGIC))
+    finally:
+        f.close()
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(path, "rb")
+    elif magic.startswith(BZIP2_MAGIC):
+        return bz2.BZ2File(path, "rb")
+    else:
+        return open(path, "rb")
+
+
+def resume_offset (log):
+
+    """The offset at which a previous import of a log stopped.
+
+    Logs that have not been imported, and logs that have been
+    replaced or truncated since they were imported, start at 0.
+    """
+
+    checkpoint = get_import_checkpoint(log.path)
+    if checkpoint is None:
+        return 0
+    elif checkpoint.inode != log.inode or log.size < checkpoint.size:
+        return 0
+    elif head_hash(log.path, checkpoint.size) != checkpoint.head:
+        return 0
+    else:
+        return checkpoint.offset
+
+
+def save_checkpoints (offsets):
+
+    """Record how far logs have been imported.
+
+    Arguments:
+    offsets -- a dict of log: offset after the last line imported
+    """
+
+    for (log, offset) in offsets.iteritems():
+        if log.path != "-":
+            set_import_checkpoint(
+                log.path, log.inode, log.size, log.head, offset)
+
+
+def read_stream (files, resume=None):
+    """Significant lines of a series of log files."""
+    for path in files:
+        log = LogFile(path)
+        if log.path == "-":
+            offset = 0
+        else:
+            log.identify()
+            if resume is None:
+                offset = 0
+            else:
+                offset = resume(log)
+        for (line, offset) in log.lines(offset):
+            yield line, log, offset
+
+
+class FollowedLog (object):
+
+    """A log that is followed as it grows and rotates.
+
+    The log is a file, a directory, or a glob (see log_streams). Its
+    files are read in name order, and the last file is followed as it
+    is written. When a file later in name order appears (as when PBS
+    starts the next day's log), or a file is replaced, the rest of the
+    current file is read before moving on.
+
+    Attributes:
+    path -- the file, directory, or glob followed
+    log -- the LogFile being read
+    offset -- the offset after the last complete line read
+    plain -- whether the file being read is uncompressed
+    """
+
+    def __init__ (self, path, resume=None):
+        """Initialize a followed log.
+
+        Arguments:
+        path -- the file, directory, or glob to follow
+
+        Keyword arguments:
+        resume -- a function giving the offset to start reading a file
+        """
+        self.path = path
+        self.resume = resume
+        self.log = None
+        self.offset = None
+        self.plain = None
+        self._file = None
+
+    def __repr__ (self):
+        return "<%s path=%r>" % (self.__class__.__name__, self.path)
+
+    def files (self):
+        """The files of the log, in name order."""
+        return [os.path.abspath(path)
+                for path in log_streams([self.path])[0]]
+
+    def next_file (self):
+
+        """The file to read after the current one, if there is one.
+
+        This is the next file in name order, or the current path
+        again if the file there has been replaced or truncated.
+        """
+
+        current = self.log.refresh()
+        try:
+            later = [path for path in self.files() if path > self.log.path]
+        except IOError:
+            later = []
+        if later:
+            return later[0]
+        elif not current and os.path.exists(self.log.path):
+            return self.log.path
+        elif current and self.plain and self.log.size < self.offset:
+            return self.log.path
+        else:
+            return None
+
+    def open (self, path):
+
+        """Start reading a file, from where a previous import stopped.
+
+        A file reopened at the same path (having been replaced or
+        truncated) is read from the beginning.
+        """
+
+        reopened = self.log is not None and self.log.path == path
+        self.close()
+        self.log = LogFile(path)
+        self.log.identify()
+        if self.resume is None or reopened:
+            self.offset = 0
+        else:
+            self.offset = self.resume(self.log)
+        self._file = open_log(path)
+        self.plain = isinstance(self._file, file)
+        if self.offset:
+            self._file.seek(self.offset)
+
+    def close (self):
+        """Stop reading the current file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def read (self):
+
+        """Significant lines written since the log was last read.
+
+        Yields (line, log, offset) tuples, as read_logs. A final line
+        that is not yet terminated is left to be read once it is.
+        """
+
+        if self.log is None:
+            files = self.files()
+            if not files:
+                return
+            self.open(files[0])
+        while True:
+            position = self._file.tell()
+            line = self._file.readline()
+            if line.endswith("\n"):
+                self.offset += len(line)
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    yield line, self.log, self.offset
+                continue
+            if line:
+                self._file.seek(position)
+            path = self.next_file()
+            if path is None:
+                return
+            self.open(path)
+
+
+def follow_logs (paths, resume=None, interval=1):
+
+    """Read logs as they are written.
+
+    Yields (line, log, offset) tuples, as read_logs, reading each of
+    the logs in turn (see FollowedLog). Lines from different logs are
+    not merged by timestamp. Once all lines written so far have been
+    read, yields None and waits interval seconds before reading
+    again. This never stops on its own.
+
+    Arguments:
+    paths -- log files, directories, and globs
+
+    Keyword arguments:
+    resume -- a function giving the offset to start reading a file
+    interval -- seconds to wait for more lines to be written
+    """
+
+    logs = [FollowedLog(path, resume) for path in paths]
+    try:
+        while True:
+            for log in logs:
+                for entry in log.read():
+                    yield entry
+            yield None
+            time.sleep(interval)
+    finally:
+        for log in logs:
+            log.close()
+
+
+def timestamp (line):
+    """A sortable key for the MM/DD/YYYY HH:MM:SS timestamp of a line."""
+    return (line[6:10], line[0:2], line[3:5], line[11:19])
+
+
+def read_logs (paths, resume=None):
+
+    """Merge the significant lines of logs in timestamp order.
+
+    Yields (line, log, offset) tuples, where log is the LogFile the
+    line was read from and offset is the position after the line.
+
+    Logs are decompressed as they are read, and only the next line of
+    each stream (see log_streams) is held in memory. Lines with the
+    same timestamp are taken from streams in the order given.
+
+    Arguments:
+    paths -- log files, directories, and globs
+
+    Keyword arguments:
+    resume -- a function giving the offset to start reading a log
+    """
+
+    def decorated (index, files):
+        for (line, log, offset) in read_stream(files, resume):
+            yield (timestamp(line), index, line, log, offset)
+
+    streams = [
+        decorated(index, files)
+        for (index, files) in enumerate(log_streams(paths))]
+    for (key, index, line, log, offset) in heapq.merge(*streams):
+        yield line, log, offset
+
+
+def parse_lines (lines):
+
+    """Parse a chunk of lines as jobs.
+
+    Returns a (record, error) pair for each line: the (id, values)
+    record from parse_job, or the error message if the line could not
+    be parsed.
+    """
+
+    results = []
+    for line in lines:
+        try:
+            results.append((parse_job(line), None))
+        except ValueError, ex:
+            results.append((None, str(ex)))
+    return results
+
+
+def parse_entries (entries, workers=0, chunk_size=1000):
+
+    """Parse log entries as jobs, in worker processes.
+
+    Lines are sent to the workers in chunks, and the results are
+    yielded in the order of the entries as (line, log, offset, record,
+    error) tuples (see read_logs and parse_lines). Entries are read in
+    the calling process, and only a few chunks per worker are parsed
+    ahead of the results being consumed. A None entry (as from
+    follow_logs) ends the current chunk, and is yielded once all the
+    entries before it have been.
+
+    Arguments:
+    entries -- (line, log, offset) tuples, as from read_logs
+
+    Keyword arguments:
+    workers -- the number of worker processes (0 parses in-process)
+    chunk_size -- the number of lines sent to a worker at a time
+    """
+
+    if not workers:
+        for chunk in chunk_entries(entries, chunk_size):
+            if chunk is None:
+                yield None
+                continue
+            results = parse_lines([line for (line, log, offset) in chunk])
+            for (entry, result) in zip(chunk, results):
+                yield entry + result
+        return
+    pool = multiprocessing.Pool(workers, init_worker)
+    try:
+        pending = deque()
+        for chunk in chunk_entries(entries, chunk_size):
+            if chunk is None:
+                while pending:
+                    chunk, results = pending.popleft()
+                    for (entry, result) in zip(chunk, results.get()):
+                        yield entry + result
+                yield None
+                continue
+            pending.append((chunk, pool.apply_async(parse_lines,
+                ([line for (line, log, offset) in chunk], ))))
+            if len(pending) > 2 * workers:
+                chunk, results = pending.popleft()
+                for (entry, result) in zip(chunk, results.get()):
+                    yield entry + result
+        while pending:
+            chunk, results = pending.popleft()
+            for (entry, result) in zip(chunk, results.get()):
+                yield entry + result
+    finally:
+        pool.terminate()
+
+
+def init_worker ():
+    """Leave signals to the importing process, which stops the workers."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def chunk_entries (entries, chunk_size):
+    """Group entries into lists of chunk_size, ending a list at None.
+
+    Each None in the entries (as from follow_logs) is passed through.
+    """
+    chunk = []
+    for entry in entries:
+        if entry is None:
+            if chunk:
+                yield chunk
+                chunk = []
+            yield None
+        else:
+            chunk.append(entry)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
@@ -12,7 +12,8 @@ from cbank import config
 from cbank.cli.common import get_unit_factor
 from cbank.model import (
     Session, User, Project, Resource,
-    Allocation, Hold, Job, Charge, Refund)
+    Allocation, Hold, Job, Charge, Refund,
+    hold_keys, charge_keys, job_keys, entry_cursor)
 import cbank.model.queries
 
 __all__ = [
@@ -169,7 +170,7 @@ def print_allocations_list (allocations, truncate=True, comments=False, **kwargs
     print >> sys.stderr, unit_definition()
 
 
-def print_holds_list (holds, comments=False, truncate=True):
+def print_holds_list (holds, comments=False, truncate=True, limit=None):
     
     """Holds list.
     
@@ -180,6 +181,7 @@ def print_holds_list (holds, comments=False, truncate=True):
     
     Keyword arguments:
     comments -- list hold comments
+    limit -- the size of a page of holds (see print_next_cursor)
     """
     
     fields = ["Hold", "Date", "Resource", "Project", "Held"]
@@ -196,7 +198,9 @@ def print_holds_list (holds, comments=False, truncate=True):
     print >> sys.stderr, format.separator()
     
     hold_sum = 0
+    count = 0
     for hold in holds:
+        count += 1
         hold_sum += hold.amount
         print format({
             'Hold':hold.id,
@@ -208,9 +212,11 @@ def print_holds_list (holds, comments=False, truncate=True):
     print >> sys.stderr, format.separator(["Held"])
     print >> sys.stderr, format({'Held':display_units(hold_sum)})
     print >> sys.stderr, unit_definition()
+    if limit is not None and count == limit:
+        print_next_cursor(hold_keys, hold)
 
 
-def print_jobs_list (jobs, truncate=True):
+def print_jobs_list (jobs, truncate=True, limit=None):
     
     """Jobs list.
     
@@ -218,6 +224,9 @@ def print_jobs_list (jobs, truncate=True):
     
     Arguments:
     jobs -- jobs to list
+    
+    Keyword arguments:
+    limit -- the size of a page of jobs (see print_next_cursor)
     """
     
     format = Formatter(["ID", "Name", "User", "Account", "Duration",
@@ -231,7 +240,9 @@ def print_jobs_list (jobs, truncate=True):
     print >> sys.stderr, format.separator()
     duration_sum = timedelta()
     charge_sum = 0
+    count = 0
     for job in jobs:
+        count += 1
         try:
             duration_td = job.end - job.start
         except TypeError:
@@ -252,6 +263,8 @@ def print_jobs_list (jobs, truncate=True):
     print >> sys.stderr, format({'Duration':format_timedelta(duration_sum),
         'Charged':display_units(charge_sum)})
     print >> sys.stderr, unit_definition()
+    if limit is not None and count == limit:
+        print_next_cursor(job_keys, job)
 
 
 def format_timedelta (td):
@@ -261,7 +274,8 @@ def format_timedelta (td):
     return "%i:%.2i:%.2i" % (hours, minutes, seconds)
 
 
-def print_charges_list (charges, comments=False, truncate=True):
+def print_charges_list (charges, comments=False, truncate=True,
+                        limit=None):
     
     """Charges list.
     
@@ -272,6 +286,7 @@ def print_charges_list (charges, comments=False, truncate=True):
     
     Keyword arguments:
     comments -- list charge comments
+    limit -- the size of a page of charges (see print_next_cursor)
     """
     
     fields = ["Charge", "Date", "Resource", "Project", "Charged"]
@@ -288,7 +303,9 @@ def print_charges_list (charges, comments=False, truncate=True):
     print >> sys.stderr, format.separator()
     
     total_charged = 0
+    count = 0
     for charge in charges:
+        count += 1
         charge_amount = charge.effective_amount()
         total_charged += charge_amount
         print format({
@@ -301,6 +318,17 @@ def print_charges_list (charges, comments=False, truncate=True):
     print >> sys.stderr, format.separator(["Charged"])
     print >> sys.stderr, format({'Charged':display_units(total_charged)})
     print >> sys.stderr, unit_definition()
+    if limit is not None and count == limit:
+        print_next_cursor(charge_keys, charge)
+
+
+def print_next_cursor (keys, entry):
+    """Print the cursor of the last entry of a full page.
+    
+    The entries after it are listed with --after-cursor. (A page
+    that is not full is the last, and has no next cursor.)
+    """
+    print >> sys.stderr, "next cursor: %s" % entry_cursor(keys, entry)
 
 
 def print_allocations (allocations):
@@ -2,7 +2,9 @@ import warnings
 import ConfigParser
 
 from sqlalchemy import create_engine
-from sqlalchemy.sql import select, and_, func, join
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.interfaces import PoolListener, ConnectionProxy
+from sqlalchemy.sql import select, func, join
 from sqlalchemy.orm import mapper, relation, column_property
 from sqlalchemy.exceptions import ArgumentError
 
@@ -12,20 +14,73 @@ from cbank.model.entities import (
     Allocation, Hold, Job, Charge, Refund,
     distribute_amount)
 from cbank.model.database import (
-    metadata, allocations, holds, jobs, charges, refunds)
+    metadata, allocations, holds, jobs, charges, refunds,
+    allocation_balances)
 from cbank.model.queries import (
-    Session, get_projects, get_users, import_job,
+    Session, get_projects, get_users, import_job, import_jobs,
+    get_import_checkpoint, set_import_checkpoint,
     user_summary, project_summary, allocation_summary,
     hold_summary, charge_summary)
+from cbank.model.balances import (
+    verify_balances, rebuild_balances, ledger_sum)
+from cbank.model.usage import verify_usage, rebuild_usage
+from cbank.model.periods import closed_before, close_period, balances_as_of
+from cbank.model.archive import (
+    archive_ledger, archived_before, archived_jobs_by_id)
+from cbank.model.resource_values import (
+    rebuild_resource_values, resource_summary)
+from cbank.model.job_nodes import rebuild_job_nodes, node_job_keys
+from cbank.model.id_sets import listed_ids
+from cbank.model.pages import (
+    hold_keys, charge_keys, job_keys, page, entry_cursor)
+from cbank.model.migrations import (
+    migrations, describe_migration, schema_version, pending_migrations,
+    migrate)
 
 
 __all__ = [
     "User", "Project", "Resource",
     "Allocation", "Hold", "Job", "Charge", "Refund",
     "distribute_amount",
-    "Session", "get_projects", "get_users", "import_job",
+    "Session", "get_projects", "get_users", "import_job", "import_jobs",
+    "get_import_checkpoint", "set_import_checkpoint",
     "user_summary", "project_summary", "allocation_summary",
-    "hold_summary", "charge_summary"]
+    "hold_summary", "charge_summary",
+    "verify_balances", "rebuild_balances", "verify_usage", "rebuild_usage",
+    "closed_before", "close_period", "balances_as_of",
+    "archive_ledger", "archived_before", "archived_jobs_by_id",
+    "rebuild_resource_values", "resource_summary",
+    "rebuild_job_nodes", "node_job_keys", "listed_ids",
+    "hold_keys", "charge_keys", "job_keys", "page", "entry_cursor",
+    "migrations", "describe_migration", "schema_version",
+    "pending_migrations", "migrate"]
+
+
+class SQLiteTransactions (PoolListener, ConnectionProxy):
+    
+    """Begin pysqlite transactions explicitly, so that savepoints work.
+    
+    pysqlite begins a transaction only before an insert, update, or
+    delete, and commits it before any other statement (SAVEPOINT
+    among them). Its connections are left in autocommit mode instead,
+    and each transaction is begun with BEGIN.
+    """
+    
+    def connect (self, dbapi_con, con_record):
+        dbapi_con.isolation_level = None
+    
+    def begin (self, conn, begin):
+        begin()
+        conn.connection.cursor().execute("BEGIN")
+
+
+def database_engine (uri):
+    """Build a SQLAlchemy engine for a database uri."""
+    if make_url(uri).drivername.startswith("sqlite"):
+        transactions = SQLiteTransactions()
+        return create_engine(uri, listeners=[transactions],
+                             proxy=transactions)
+    return create_engine(uri)
 
 
 def configured_engine ():
@@ -36,7 +91,7 @@ def configured_engine ():
         engine = None
     else:
         try:
-            engine = create_engine(uri)
+            engine = database_engine(uri)
         except (ImportError, ArgumentError), ex:
             warnings.warn(
                 "invalid database: %s (%s)" % (uri, ex), UserWarning)
@@ -64,25 +119,23 @@ def configured_upstream ():
     return module
 
 
-allocation_active_hold_sum_subquery = (
-    select([func.coalesce(func.sum(holds.c.amount), 0)]).where(
-        and_(
-            holds.c.allocation_id==allocations.c.id,
-            holds.c.active==True))).correlate(allocations)
+def stored_balance (column):
+    """A stored balance of an allocation, or else its computed value."""
+    stored = select([allocation_balances.c[column]]).where(
+        allocation_balances.c.allocation_id==allocations.c.id
+        ).correlate(allocations).as_scalar()
+    return func.coalesce(stored, ledger_sum(column))
+
+
+# allocations without a stored balance (if it is not yet rebuilt) are
+# summed from the live and archived ledger, as by computed_balances
+allocation_active_hold_sum_subquery = stored_balance("held")
 
 
-allocation_charge_sum_subquery = (
-    select([
-            func.coalesce(func.sum(charges.c.amount), 0)]).where(
-            charges.c.allocation_id==allocations.c.id)).correlate(allocations)
+allocation_charge_sum_subquery = stored_balance("charged")
 
 
-allocation_refund_sum_subquery = (
-    select([
-            func.coalesce(func.sum(refunds.c.amount), 0)]).where(
-            and_(
-                refunds.c.charge_id==charges.c.id,
-                charges.c.allocation_id==allocations.c.id))).correlate(allocations)
+allocation_refund_sum_subquery = stored_balance("refunded")
 
 
 charge_refund_sum_subquery = (
@@ -117,27 +170,41 @@ mapper(Hold, holds, properties={
     'job':relation(Job, backref="holds")})
 
 
+# the columns shown only in detail are deferred (in the "details"
+# group), so that listing jobs does not load or decode them (ctime,
+# by which jobs are listed and paged, is not)
 mapper(Job, jobs, properties={
+    'key':jobs.c.key,
     'id':jobs.c.id,
     'user_id':jobs.c.user_id,
-    'group':jobs.c.group,
+    'group':column_property(jobs.c.group, deferred=True, group="details"),
     'account_id':jobs.c.account_id,
     'name':jobs.c.name,
     'queue':jobs.c.queue,
-    'reservation_name':jobs.c.reservation_name,
-    'reservation_id':jobs.c.reservation_id,
+    'reservation_name':column_property(jobs.c.reservation_name,
+        deferred=True, group="details"),
+    'reservation_id':column_property(jobs.c.reservation_id,
+        deferred=True, group="details"),
     'ctime':jobs.c.ctime,
-    'qtime':jobs.c.qtime,
-    'etime':jobs.c.etime,
+    'qtime':column_property(jobs.c.qtime, deferred=True, group="details"),
+    'etime':column_property(jobs.c.etime, deferred=True, group="details"),
     'start':jobs.c.start,
-    'exec_host':jobs.c.exec_host,
-    'resource_list':jobs.c.resource_list,
-    'session':jobs.c.session,
-    'alternate_id':jobs.c.alternate_id,
+    'exec_host':column_property(jobs.c.exec_host,
+        deferred=True, group="details"),
+    'resource_list':column_property(jobs.c.resource_list,
+        deferred=True, group="details"),
+    'session':column_property(jobs.c.session,
+        deferred=True, group="details"),
+    'alternate_id':column_property(jobs.c.alternate_id,
+        deferred=True, group="details"),
     'end':jobs.c.end,
-    'exit_status':jobs.c.exit_status,
-    'resources_used':jobs.c.resources_used,
-    'accounting_id':jobs.c.accounting_id})
+    'exit_status':column_property(jobs.c.exit_status,
+        deferred=True, group="details"),
+    'resources_used':column_property(jobs.c.resources_used,
+        deferred=True, group="details"),
+    'accounting_id':column_property(jobs.c.accounting_id,
+        deferred=True, group="details"),
+    'resource_id':jobs.c.resource_id})
 
 
 mapper(Charge, charges, properties={
@@ -161,6 +228,7 @@ mapper(Refund, refunds, properties={
 
 def use_upstream (upstream):
     """untested"""
+    User.clear_ids()
     if upstream is None:
         User._in = None
         User._out = None
@@ -0,0 +1,289 @@
+"""Archived ledger history.
+
+Archiving the ledger before a horizon moves the jobs, inactive holds,
+charges, and refunds of allocations that ended before it from the
+live tables to archive tables with the same columns (except that
+archived entries refer to jobs by id, as the keys of jobs are not
+kept), so that the live tables (and their indexes) hold only the
+history still in use. The resource values and nodes of archived jobs
+are moved with them (to archived_resource_values and
+archived_job_nodes). The stored balances, daily usage, and
+checkpoints are kept, so the balances and whole days of usage read
+from them are unchanged; what is still read from the entries
+themselves reads the archive tables as well.
+
+Entries are archived together: a job with all of its charges and
+holds, and a charge with all of its refunds. A job that is still
+charged or held after the horizon (or against an allocation that has
+not ended) stays live, along with all of its entries.
+
+archive_ledger -- move the ledger before a horizon to the archive tables
+archived_before -- the horizon of the latest archive
+archived_jobs_by_id -- jobs from the archive
+archived_job_counts -- a subquery counting archived jobs
+archived_charge_sums -- subqueries summing archived charges and refunds
+"""
+
+
+from datetime import datetime
+
+from sqlalchemy.sql import select, func, and_, or_, not_, exists
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from sqlalchemy.ext.compiler import compiles
+
+from cbank.model.entities import Job
+from cbank.model.database import (
+    allocations, holds, jobs, charges, refunds, ledger_archives,
+    archived_jobs, archived_holds, archived_charges, archived_refunds,
+    resource_values, archived_resource_values,
+    job_nodes, archived_job_nodes)
+from cbank.model.periods import closed_before
+from cbank.model.id_sets import listed_ids
+
+
+__all__ = [
+    "archive_ledger", "archived_before", "archived_jobs_by_id",
+    "archived_job_counts", "archived_charge_sums"]
+
+
+class InsertFromSelect (Executable, ClauseElement):
+
+    """An INSERT of the rows of a SELECT (into all columns, by default)."""
+
+    def __init__ (self, table, select_, columns=None):
+        self.table = table
+        self.select = select_
+        if columns is None:
+            columns = list(table.c)
+        self.columns = columns
+
+    @property
+    def bind (self):
+        return self.table.bind
+
+
+@compiles(InsertFromSelect)
+def visit_insert_from_select (element, compiler, **kw):
+    return "INSERT INTO %s (%s) %s" % (
+        compiler.process(element.table, asfrom=True),
+        ", ".join(compiler.preparer.format_column(column)
+                  for column in element.columns),
+        compiler.process(element.select))
+
+
+def archive_rows (bind, table, archive, whereclause):
+    """Copy the rows of a table to its archive.
+
+    The job_key of holds and charges is archived as the job_id of
+    their job, which is selected as jobs.
+    """
+    columns = dict((column.name, column) for column in table.c)
+    from_obj = table
+    if "job_key" in table.c:
+        columns['job_id'] = jobs.c.id
+        from_obj = table.outerjoin(jobs, table.c.job_key == jobs.c.key)
+    bind.execute(InsertFromSelect(archive, select(
+        [columns[column.name] for column in archive.c], whereclause,
+        from_obj=[from_obj])))
+
+
+def archive_ledger (bind, before):
+
+    """Move the ledger before a horizon to the archive tables.
+
+    The ledger must already be closed before the horizon, so that
+    nothing archived can change.
+
+    Arguments:
+    bind -- a session, connection, or engine to write to
+    before -- the horizon (excluded) to archive the ledger before
+
+    Returns the number of jobs, holds, charges, and refunds archived.
+    """
+
+    closed = closed_before(bind)
+    if closed is None or before > closed:
+        raise ValueError(
+            "cannot archive the ledger after it is closed: %s" % before)
+    archived = archived_before(bind)
+    if archived is not None and before <= archived:
+        raise ValueError("the ledger is already archived before %s" % archived)
+
+    ended = select([allocations.c.id], allocations.c.end <= before)
+    refunded_later = exists([refunds.c.id], and_(
+        refunds.c.charge_id == charges.c.id, refunds.c.datetime >= before))
+    charge_done = and_(
+        charges.c.datetime < before,
+        charges.c.allocation_id.in_(ended),
+        not_(refunded_later))
+    archived_job_ids = select([archived_jobs.c.id])
+    job_done = and_(
+        jobs.c.end < before,
+        not_(exists([charges.c.id], and_(
+            charges.c.job_key == jobs.c.key, not_(charge_done)))),
+        not_(exists([holds.c.id], and_(
+            holds.c.job_key == jobs.c.key,
+            or_(holds.c.active == True, holds.c.datetime >= before)))),
+        not_(jobs.c.id.in_(archived_job_ids)))
+
+    # the resource values and nodes of jobs are moved before the jobs,
+    # which they refer to by key
+    for (table, archive) in ((resource_values, archived_resource_values),
+                             (job_nodes, archived_job_nodes)):
+        bind.execute(InsertFromSelect(archive, select(
+            [jobs.c.id] + [column for column in table.c
+                           if column.name != "job_key"],
+            and_(table.c.job_key == jobs.c.key, job_done))))
+        bind.execute(table.delete(table.c.job_key.in_(
+            select([jobs.c.key], job_done))))
+    archive_rows(bind, jobs, archived_jobs, job_done)
+    # the jobs of holds and charges are joined as jobs (see archive_rows)
+    archive_rows(bind, charges, archived_charges, and_(
+        charge_done, or_(
+            charges.c.job_key == None,
+            jobs.c.id.in_(archived_job_ids))))
+    archive_rows(bind, refunds, archived_refunds,
+        refunds.c.charge_id.in_(select([archived_charges.c.id])))
+    archive_rows(bind, holds, archived_holds, and_(
+        holds.c.active == False,
+        holds.c.datetime < before,
+        or_(holds.c.job_key == None, jobs.c.id.in_(archived_job_ids))))
+
+    counts = {}
+    for (table, archive) in ((refunds, archived_refunds),
+                             (charges, archived_charges),
+                             (holds, archived_holds),
+                             (jobs, archived_jobs)):
+        counts[table] = bind.execute(table.delete(
+            table.c.id.in_(select([archive.c.id])))).rowcount
+    bind.execute(ledger_archives.insert(values={
+        'before':before, 'datetime':datetime.now()}))
+    return tuple(counts[table] for table in (jobs, holds, charges, refunds))
+
+
+def archived_before (bind):
+    """The horizon of the latest archive of the ledger (None if none)."""
+    return bind.execute(select([func.max(ledger_archives.c.before)])).scalar()
+
+
+def archived_jobs_by_id (bind, ids):
+    """Archived jobs (as transient Job objects) with any of a list of ids."""
+    jobs_ = []
+    for row in bind.execute(archived_jobs.select(
+            archived_jobs.c.id.in_(ids)).order_by(archived_jobs.c.id)):
+        job = Job(row.id)
+        for column in archived_jobs.c:
+            setattr(job, column.name, row[column])
+        jobs_.append(job)
+    return jobs_
+
+
+def archived_key (key):
+    """The column of the archive tables to group by a summary key."""
+    return {
+        'user_id':archived_jobs.c.user_id,
+        'project_id':allocations.c.project_id,
+        'allocation_id':archived_charges.c.allocation_id}[key]
+
+
+def archived_job_counts (key, users=None, projects=None, resources=None,
+                         after=None, before=None, bind=None):
+
+    """A subquery counting archived jobs, as in the summaries.
+
+    Jobs are counted by project or allocation for each of their
+    charges. (user_summary counts the archived jobs of users itself.)
+
+    Arguments:
+    key -- the key to count by: project_id or allocation_id
+
+    Keyword arguments:
+    users -- users to count the jobs of
+    projects -- projects to count the jobs of
+    resources -- resources to count the jobs of
+    after -- count jobs that ended after a date
+    before -- count jobs that started before a date
+    bind -- a session or connection to store long lists of ids with
+
+    Returns a subquery of key and job_count.
+    """
+
+    column = archived_key(key)
+    clauses = [
+        archived_charges.c.job_id == archived_jobs.c.id,
+        archived_charges.c.allocation_id == allocations.c.id]
+    if projects:
+        clauses.append(allocations.c.project_id.in_(
+            listed_ids("projects",
+                (project.id for project in projects), bind)))
+    if resources:
+        clauses.append(allocations.c.resource_id.in_(
+            listed_ids("resources",
+                (resource.id for resource in resources), bind)))
+    if users:
+        clauses.append(archived_jobs.c.user_id.in_(
+            listed_ids("users", (user.id for user in users), bind)))
+    if after:
+        clauses.append(archived_jobs.c.end > after)
+    if before:
+        clauses.append(archived_jobs.c.start < before)
+    query = select([column.label(key),
+                    func.count(archived_jobs.c.id).label("job_count")],
+                   and_(*clauses), correlate=False)
+    return query.group_by(column).alias()
+
+
+def archived_charge_sums (key, users=None, projects=None, resources=None,
+                          ranges=None, bind=None):
+
+    """Subqueries summing archived charges and refunds, as in the summaries.
+
+    Refunds are summed by the date of the charge they refund.
+
+    Arguments:
+    key -- the key to sum by: user_id, project_id, or allocation_id
+
+    Keyword arguments:
+    users -- users to sum the charges of
+    projects -- projects to sum the charges of
+    resources -- resources to sum the charges of
+    ranges -- (start, end) datetime ranges to sum the charges of
+        (either of which may be None, for unbounded; default all)
+    bind -- a session or connection to store long lists of ids with
+
+    Returns subqueries of key and charge_sum, and of key and refund_sum.
+    """
+
+    column = archived_key(key)
+    clauses = [archived_charges.c.allocation_id == allocations.c.id]
+    if key == "user_id" or users:
+        clauses.append(archived_charges.c.job_id == archived_jobs.c.id)
+    if users:
+        clauses.append(archived_jobs.c.user_id.in_(
+            listed_ids("users", (user.id for user in users), bind)))
+    if projects:
+        clauses.append(allocations.c.project_id.in_(
+            listed_ids("projects",
+                (project.id for project in projects), bind)))
+    if resources:
+        clauses.append(allocations.c.resource_id.in_(
+            listed_ids("resources",
+                (resource.id for resource in resources), bind)))
+    if ranges is not None:
+        within = []
+        for (start, end) in ranges:
+            range_ = []
+            if start is not None:
+                range_.append(archived_charges.c.datetime >= start)
+            if end is not None:
+                range_.append(archived_charges.c.datetime < end)
+            within.append(and_(*range_))
+        clauses.append(or_(*within))
+    charges_q = select([column.label(key),
+        func.sum(archived_charges.c.amount).label("charge_sum")],
+        and_(*clauses), correlate=False).group_by(column)
+    refunds_q = select([column.label(key),
+        func.sum(archived_refunds.c.amount).label("refund_sum")],
+        and_(archived_refunds.c.charge_id == archived_charges.c.id, *clauses),
+        correlate=False).group_by(column)
+    return [charges_q.alias(), refunds_q.alias()]
@@ -0,0 +1,337 @@
+"""Materialized allocation balances.
+
+The allocation_balances table holds the sum of the charges, refunds,
+and active holds of each allocation, so that the amount available
+from an allocation is read by its primary key rather than aggregated
+from its history. AllocationBalances keeps the table up to date in
+the same transaction as each change to the ledger.
+
+AllocationBalances -- a session extension that maintains balances
+computed_balances -- balances aggregated from the ledger
+verify_balances -- compare stored balances with the ledger
+rebuild_balances -- recompute stored balances from the ledger
+ledger_sum -- a balance of allocations, summed from the ledger
+available_balances -- a subquery of the balances available from allocations
+
+Balances are computed from the archive tables as well as the live
+ledger. Allocations without a stored balance (if it is not yet
+rebuilt) are summed from the ledger as they are read.
+"""
+
+
+from sqlalchemy.sql import select, func, and_, case
+from sqlalchemy.orm.session import SessionExtension
+from sqlalchemy.orm.attributes import instance_state
+
+from cbank.model.entities import Allocation, Hold, Charge, Refund
+from cbank.model.database import (
+    allocations, holds, charges, refunds, allocation_balances,
+    archived_charges, archived_refunds)
+
+
+__all__ = [
+    "AllocationBalances",
+    "computed_balances", "verify_balances", "rebuild_balances",
+    "ledger_sum", "available_balances"]
+
+
+balance_columns = ("charged", "refunded", "held")
+
+
+class AllocationBalances (SessionExtension):
+
+    """Maintain allocation balances as the ledger is flushed.
+
+    What each new, changed, or deleted hold, charge, and refund adds
+    to (or removes from) the balance of its allocation is found
+    before the flush, while the old values are still stored, and is
+    added to the stored balances after the flush. The balances of new
+    allocations, and of allocations that entries are moved to or
+    from, are computed from the ledger instead.
+    """
+
+    def before_flush (self, session, flush_context, instances):
+        """Find the balance changes of the objects to be flushed."""
+        changes = []
+        recompute = []
+        for instance in session.new:
+            if isinstance(instance, Allocation):
+                recompute.append(instance)
+            elif ledger_entry(instance) is not None:
+                changes.append(ledger_entry(instance))
+        for instance in session.dirty:
+            if not session.is_modified(instance):
+                continue
+            old = stored_entry(session, instance)
+            new = ledger_entry(instance)
+            if old is None or new is None:
+                continue
+            if old[0] == allocation_id(new[0]):
+                changes.append((new[0], new[1], new[2] - old[2]))
+            else:
+                recompute.extend([old[0], new[0]])
+        deleted = []
+        for instance in session.deleted:
+            if isinstance(instance, Allocation):
+                deleted.append(allocation_id(instance))
+            else:
+                old = stored_entry(session, instance)
+                if old is not None:
+                    changes.append((old[0], old[1], -old[2]))
+        if deleted:
+            session.execute(allocation_balances.delete(
+                allocation_balances.c.allocation_id.in_(deleted)))
+        flush_context.balance_changes = (changes, recompute, deleted)
+
+    def after_flush (self, session, flush_context):
+        """Apply the balance changes of the flushed objects."""
+        changes, recompute, deleted = getattr(
+            flush_context, "balance_changes", ([], [], []))
+        skip = set(deleted)
+        recompute = set(allocation_id(allocation)
+                        for allocation in recompute) - skip - set([None])
+        deltas = {}
+        for (allocation, column, amount) in changes:
+            id_ = allocation_id(allocation)
+            if id_ is None or id_ in skip or id_ in recompute or not amount:
+                continue
+            delta = deltas.setdefault(id_, dict.fromkeys(balance_columns, 0))
+            delta[column] += amount
+        for (id_, delta) in deltas.iteritems():
+            if not any(delta.itervalues()):
+                continue
+            result = session.execute(allocation_balances.update(
+                allocation_balances.c.allocation_id == id_,
+                values=dict(
+                    (column, allocation_balances.c[column] + amount)
+                    for (column, amount) in delta.iteritems() if amount)))
+            if not result.rowcount:
+                recompute.add(id_)
+        if recompute:
+            session.execute(allocation_balances.delete(
+                allocation_balances.c.allocation_id.in_(recompute)))
+            insert_balances(session, computed_balances(session, recompute))
+
+
+def allocation_id (allocation):
+    """The id of an allocation (or None), which may already be an id."""
+    if isinstance(allocation, Allocation):
+        return allocation.id
+    return allocation
+
+
+def ledger_entry (instance):
+
+    """What a ledger entry adds to the balance of its allocation.
+
+    Returns an (allocation, column, amount) triple, or None for an
+    object that is not a hold, charge, or refund.
+    """
+
+    if isinstance(instance, Hold):
+        amount = instance.active and instance.amount
+        return (instance.allocation, "held", amount or 0)
+    elif isinstance(instance, Charge):
+        return (instance.allocation, "charged", instance.amount or 0)
+    elif isinstance(instance, Refund):
+        allocation = instance.charge and instance.charge.allocation
+        return (allocation, "refunded", instance.amount or 0)
+    else:
+        return None
+
+
+def stored_entry (session, instance):
+
+    """What a ledger entry added to its balance when it was stored.
+
+    Returns an (allocation_id, column, amount) triple, or None for
+    an entry that is not stored.
+    """
+
+    key = instance_state(instance).key
+    if key is None:
+        return None
+    (id_, ) = key[1]
+    if isinstance(instance, Hold):
+        query = select([holds.c.allocation_id, holds.c.amount, holds.c.active],
+            holds.c.id == id_)
+        column = "held"
+    elif isinstance(instance, Charge):
+        query = select([charges.c.allocation_id, charges.c.amount],
+            charges.c.id == id_)
+        column = "charged"
+    elif isinstance(instance, Refund):
+        query = select([charges.c.allocation_id, refunds.c.amount],
+            and_(refunds.c.id == id_, refunds.c.charge_id == charges.c.id))
+        column = "refunded"
+    else:
+        return None
+    row = session.execute(query).fetchone()
+    if row is None:
+        return None
+    amount = row[1] or 0
+    if column == "held" and not row[2]:
+        amount = 0
+    return (row[0], column, amount)
+
+
+def computed_balances (bind, allocation_ids=None):
+
+    """Balances aggregated from the ledger.
+
+    Arguments:
+    bind -- a session, connection, or engine to query
+
+    Keyword arguments:
+    allocation_ids -- the allocations to compute (default all)
+
+    Returns a dict of (charged, refunded, held) by allocation id.
+    """
+
+    def where (*clauses):
+        clauses = list(clauses)
+        if allocation_ids is not None:
+            clauses.append(clauses.pop(0).in_(allocation_ids))
+        else:
+            clauses.pop(0)
+        if clauses:
+            return and_(*clauses)
+        return None
+
+    balances = dict(
+        (allocation_id, [0, 0, 0]) for (allocation_id, ) in bind.execute(
+            select([allocations.c.id], where(allocations.c.id))))
+    queries = []
+    for (charges_, refunds_) in ((charges, refunds),
+                                 (archived_charges, archived_refunds)):
+        queries.extend([
+            (0, select([charges_.c.allocation_id, func.sum(charges_.c.amount)],
+                where(charges_.c.allocation_id)
+                ).group_by(charges_.c.allocation_id)),
+            (1, select([charges_.c.allocation_id, func.sum(refunds_.c.amount)],
+                where(charges_.c.allocation_id,
+                      refunds_.c.charge_id == charges_.c.id)
+                ).group_by(charges_.c.allocation_id))])
+    queries.append(
+        (2, select([holds.c.allocation_id, func.sum(holds.c.amount)],
+            where(holds.c.allocation_id, holds.c.active == True)
+            ).group_by(holds.c.allocation_id)))
+    for (index, query) in queries:
+        for (allocation_id, sum_) in bind.execute(query):
+            balances[allocation_id][index] += int(sum_ or 0)
+    return dict(
+        (allocation_id, tuple(balance))
+        for (allocation_id, balance) in balances.iteritems())
+
+
+def stored_balances (bind):
+    """Balances from the allocation_balances table, by allocation id."""
+    return dict(
+        (row[0], tuple(row[1:])) for row in bind.execute(select([
+            allocation_balances.c.allocation_id,
+            allocation_balances.c.charged,
+            allocation_balances.c.refunded,
+            allocation_balances.c.held])))
+
+
+def insert_balances (bind, balances):
+    """Insert balances, as returned by computed_balances."""
+    if balances:
+        bind.execute(allocation_balances.insert(), [
+            {'allocation_id':allocation_id, 'charged':charged,
+             'refunded':refunded, 'held':held}
+            for (allocation_id, (charged, refunded, held))
+            in sorted(balances.iteritems())])
+
+
+def verify_balances (bind):
+
+    """Compare stored balances with the ledger.
+
+    Returns an (allocation_id, stored, computed) triple for each
+    allocation whose stored balance differs from (or is missing, as
+    None) the balance computed from the ledger.
+    """
+
+    stored = stored_balances(bind)
+    computed = computed_balances(bind)
+    return [
+        (allocation_id, stored.get(allocation_id), balance)
+        for (allocation_id, balance) in sorted(computed.iteritems())
+        if stored.get(allocation_id) != balance]
+
+
+def rebuild_balances (bind):
+    """Recompute all stored balances from the ledger.
+
+    Returns the number of balances stored.
+    """
+    balances = computed_balances(bind)
+    bind.execute(allocation_balances.delete())
+    insert_balances(bind, balances)
+    return len(balances)
+
+
+def ledger_sum (column):
+    """A balance of allocations, summed from the live and archived ledger.
+
+    Returns a scalar subquery of the charged, refunded, or held column,
+    correlated to allocations.
+    """
+    if column == "held":
+        sums = [(holds.c.amount, [holds.c.allocation_id == allocations.c.id,
+                                  holds.c.active == True])]
+    elif column == "charged":
+        sums = [(charges_.c.amount,
+                 [charges_.c.allocation_id == allocations.c.id])
+                for charges_ in (charges, archived_charges)]
+    else:
+        sums = [(refunds_.c.amount,
+                 [charges_.c.allocation_id == allocations.c.id,
+                  refunds_.c.charge_id == charges_.c.id])
+                for (charges_, refunds_) in ((charges, refunds),
+                                             (archived_charges,
+                                              archived_refunds))]
+    return reduce(lambda a, b: a + b, [
+        select([func.coalesce(func.sum(amount), 0)]).where(
+            and_(*clauses)).correlate(allocations).as_scalar()
+        for (amount, clauses) in sums])
+
+
+def available_balances (now, whereclause=None):
+
+    """A subquery of the balances available from allocations.
+
+    The balance available from an allocation is its amount, less its
+    stored charges and active holds, plus its stored refunds, while it
+    is active (and 0 otherwise). It is not limited to 0, so that the
+    balances of a project add up before they are. Allocations without
+    a stored balance are summed from the ledger (see ledger_sum), as
+    the balances of Allocation are.
+
+    Arguments:
+    now -- the time at which allocations are active
+
+    Keyword arguments:
+    whereclause -- a clause to select the allocations (default all)
+
+    Returns a subquery of allocation_id, project_id, resource_id, and
+    balance.
+    """
+
+    stored = dict(
+        (column, case([(allocation_balances.c.allocation_id == None,
+                        ledger_sum(column))],
+                      else_=allocation_balances.c[column]))
+        for column in balance_columns)
+    active = and_(allocations.c.start <= now, allocations.c.end > now)
+    balance = (allocations.c.amount - stored['held']
+               - stored['charged'] + stored['refunded'])
+    query = select([
+        allocations.c.id.label("allocation_id"),
+        allocations.c.project_id, allocations.c.resource_id,
+        case([(active, balance)], else_=0).label("balance")],
+        whereclause, from_obj=[allocations.outerjoin(allocation_balances,
+            allocation_balances.c.allocation_id == allocations.c.id)],
+        correlate=False)
+    return query.alias()
@@ -7,22 +7,45 @@ Objects:
 metadata -- master metadata object
 allocations -- allocations
 holds -- holds
-jobs -- jobs run on a resource
+jobs -- jobs run on a resource (keyed by an integer, with the PBS id
+    as a unique natural key)
 charges -- charges
 refunds -- refunds
+allocation_balances -- the charged, refunded, and held sums of allocations
+daily_usage -- the charged and refunded sums of each day
+ledger_closes -- the periods closed to changes in the ledger
+allocation_checkpoints -- the charged and refunded sums of allocations
+    before each close
+ledger_archives -- the horizons the ledger has been archived before
+archived_jobs -- jobs moved out of the jobs table
+archived_holds -- holds moved out of the holds table
+archived_charges -- charges moved out of the charges table
+archived_refunds -- refunds moved out of the refunds table
+resource_values -- numeric values of selected job resources
+archived_resource_values -- resource values of archived jobs
+job_nodes -- the nodes each job ran on
+archived_job_nodes -- the nodes of archived jobs
+import_checkpoints -- how far each log file has been imported
+schema_versions -- the schema migrations applied to the database
 """
 
 
+import re
 from datetime import datetime, timedelta
 
-from sqlalchemy import MetaData, Table, Column, ForeignKey
-from sqlalchemy.types import TypeDecorator, Integer, DateTime, \
-    Text, Boolean, String
+from sqlalchemy import MetaData, Table, Column, ForeignKey, Index
+from sqlalchemy.types import TypeDecorator, Integer, BigInteger, DateTime, \
+    Text, Boolean, String, Date
 
 
 __all__ = [
     "metadata",
     "allocations", "holds", "jobs", "charges", "refunds",
+    "allocation_balances", "daily_usage",
+    "ledger_closes", "allocation_checkpoints",
+    "ledger_archives", "archived_jobs", "archived_holds",
+    "archived_charges", "archived_refunds", "resource_values",
+    "archived_resource_values", "job_nodes", "archived_job_nodes", "import_checkpoints", "schema_versions",
 ]
 
 
@@ -58,26 +81,120 @@ class Dictionary (TypeDecorator):
             return None
         valuedict = {}
         for pair in value.split(" "):
-            try:
-                key, value = pair.split("=", 1)
-            except ValueError:
-                continue
-            else:
-                valuedict[key] = value
-        parsers = [int, float,
-            lambda val:timedelta(*[int(v)
-                for v in valuedict[key].split(":", 2)])]
-        for key in valuedict:
-            for parser in parsers:
-                try:
-                    valuedict[key] = parser(valuedict[key])
-                except ValueError:
-                    continue
-                else:
-                    break
+            key, equals, value_ = pair.partition("=")
+            if equals:
+                valuedict[key] = parse_value(value_)
         return valuedict
 
 
+class ExecHost (TypeDecorator):
+    
+    """Store an exec_host (node/cpu+node/cpu+...) string compactly.
+    
+    Consecutive cpus of the same node are stored as a list of
+    ranges (node/0-7,12), and expanded again as they are loaded.
+    Entries that are not compacted, but would be expanded (such as a
+    node/0-7 already in the exec_host), are escaped with a leading
+    backslash, so that they are loaded as they were.
+    """
+    
+    impl = Text
+    
+    def process_bind_param (self, value, engine):
+        """Compact the cpus of each node to ranges."""
+        if value is None:
+            return None
+        return compact_exec_host(value)
+    
+    def process_result_value (self, value, engine):
+        """Expand the cpu ranges of each node."""
+        if value is None:
+            return None
+        return expand_exec_host(value)
+
+
+cpu_ranges_pattern = re.compile(r"^\d+(-\d+)?(,\d+(-\d+)?)*$")
+
+
+def compact_exec_host (exec_host):
+    """Compact an exec_host string (see ExecHost)."""
+    segments = []
+    for entry in exec_host.split("+"):
+        node, slash, cpu = entry.rpartition("/")
+        if not (slash and cpu.isdigit()) or entry.startswith("\\"):
+            segments.append((entry, None))
+        elif segments and segments[-1][0] == node and segments[-1][1]:
+            segments[-1][1].append(int(cpu))
+        else:
+            segments.append((node, [int(cpu)]))
+    compacted = []
+    for (node, cpus) in segments:
+        if cpus is None:
+            compacted.append(escaped_entry(node))
+        else:
+            compacted.append("%s/%s" % (node, cpu_ranges(cpus)))
+    return "+".join(compacted)
+
+
+def escaped_entry (entry):
+    """An entry of an exec_host that is not compacted, as it is stored."""
+    node, slash, cpus = entry.rpartition("/")
+    if entry.startswith("\\") or (slash and cpu_ranges_pattern.match(cpus)):
+        return "\\" + entry
+    return entry
+
+
+def cpu_ranges (cpus):
+    """Ascending runs in a list of cpus, as a comma-separated list."""
+    runs = []
+    for cpu in cpus:
+        if runs and cpu == runs[-1][1] + 1:
+            runs[-1][1] = cpu
+        else:
+            runs.append([cpu, cpu])
+    return ",".join(
+        first == last and str(first) or "%i-%i" % (first, last)
+        for (first, last) in runs)
+
+
+def expand_exec_host (value):
+    """Expand a stored exec_host string (see ExecHost)."""
+    entries = []
+    for segment in value.split("+"):
+        if segment.startswith("\\"):
+            entries.append(segment[1:])
+            continue
+        node, slash, cpus = segment.rpartition("/")
+        if not (slash and cpu_ranges_pattern.match(cpus)):
+            entries.append(segment)
+            continue
+        for range_ in cpus.split(","):
+            first, dash, last = range_.partition("-")
+            for cpu in xrange(int(first), int(last or first) + 1):
+                entries.append("%s/%i" % (node, cpu))
+    return "+".join(entries)
+
+
+def parse_timedelta_value (value):
+    """Parse a timedelta stored as days:seconds:microseconds."""
+    return timedelta(*[int(v) for v in value.split(":", 2)])
+
+
+value_parsers = [int, float, parse_timedelta_value]
+
+
+def parse_value (value):
+    """Parse a stored dict value as an int, float, or timedelta (or str)."""
+    if value.isdigit():
+        return int(value)
+    for parser in value_parsers:
+        try:
+            return parser(value)
+        except ValueError:
+            continue
+    return value
+
+
 metadata = MetaData()
 
 
@@ -92,6 +209,9 @@ allocations = Table("allocations", metadata,
     Column("comment", Text),
     mysql_engine="InnoDB")
 
+Index("ix_allocations_project_resource", allocations.c.project_id,
+    allocations.c.resource_id, allocations.c.start, allocations.c.end)
+
 
 holds = Table("holds", metadata,
     Column("id", Integer, primary_key=True),
@@ -100,12 +220,17 @@ holds = Table("holds", metadata,
     Column("amount", Integer, nullable=False),
     Column("comment", Text),
     Column("active", Boolean, nullable=False, default=True),
-    Column("job_id", None, ForeignKey("jobs.id"), nullable=True),
+    Column("job_key", None, ForeignKey("jobs.key"), nullable=True),
     mysql_engine="InnoDB")
 
+Index("ix_holds_allocation_active", holds.c.allocation_id, holds.c.active)
+Index("ix_holds_job_key", holds.c.job_key)
+Index("ix_holds_datetime_id", holds.c.datetime, holds.c.id)
+
 
 jobs = Table("jobs", metadata,
-    Column("id", String(255), primary_key=True, autoincrement=False),
+    Column("key", Integer, primary_key=True),
+    Column("id", String(255), nullable=False, unique=True),
     Column("user_id", String(255), nullable=True),
     Column("group", String(255), nullable=True),
     Column("account_id", String(255), nullable=True),
@@ -117,7 +242,7 @@ jobs = Table("jobs", metadata,
     Column("qtime", DateTime, nullable=True),
     Column("etime", DateTime, nullable=True),
     Column("start", DateTime, nullable=True),
-    Column("exec_host", String(255), nullable=True),
+    Column("exec_host", ExecHost, nullable=True),
     Column("resource_list", Dictionary, nullable=True),
     Column("session", Integer, nullable=True),
     Column("alternate_id", String(255), nullable=True),
@@ -125,8 +250,15 @@ jobs = Table("jobs", metadata,
     Column("exit_status", Integer, nullable=True),
     Column("resources_used", Dictionary, nullable=True),
     Column("accounting_id", String(255), nullable=True),
+    Column("resource_id", String(255), nullable=True),
     mysql_engine="InnoDB")
 
+Index("ix_jobs_user_id", jobs.c.user_id, jobs.c.key, jobs.c.start,
+    jobs.c.end)
+Index("ix_jobs_account_id", jobs.c.account_id, jobs.c.key)
+Index("ix_jobs_ctime_key", jobs.c.ctime, jobs.c.key)
+Index("ix_jobs_resource_id", jobs.c.resource_id, jobs.c.ctime)
+
 
 charges = Table("charges", metadata,
     Column("id", Integer, primary_key=True),
@@ -134,9 +266,14 @@ charges = Table("charges", metadata,
     Column("datetime", DateTime, nullable=False, default=datetime.now),
     Column("amount", Integer, nullable=False),
     Column("comment", Text),
-    Column("job_id", None, ForeignKey("jobs.id"), nullable=True),
+    Column("job_key", None, ForeignKey("jobs.key"), nullable=True),
     mysql_engine="InnoDB")
 
+Index("ix_charges_allocation_id", charges.c.allocation_id, charges.c.amount)
+Index("ix_charges_job_key", charges.c.job_key, charges.c.allocation_id,
+    charges.c.amount)
+Index("ix_charges_datetime_id", charges.c.datetime, charges.c.id)
+
 
 refunds = Table("refunds", metadata,
     Column("id", Integer, primary_key=True),
@@ -145,3 +282,170 @@ refunds = Table("refunds", metadata,
     Column("amount", Integer, nullable=False),
     Column("comment", Text),
     mysql_engine="InnoDB")
+
+Index("ix_refunds_charge_id", refunds.c.charge_id)
+
+
+allocation_balances = Table("allocation_balances", metadata,
+    Column("allocation_id", None, ForeignKey("allocations.id"),
+        primary_key=True, autoincrement=False),
+    Column("charged", Integer, nullable=False, default=0),
+    Column("refunded", Integer, nullable=False, default=0),
+    Column("held", Integer, nullable=False, default=0),
+    mysql_engine="InnoDB")
+
+
+# the usage of charges without a user (or job) is stored with a
+# user_id of "", so that each day, user, project, and resource is
+# unique (see cbank.model.usage)
+daily_usage = Table("daily_usage", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("day", Date, nullable=False),
+    Column("user_id", String(255), nullable=False, default=""),
+    Column("project_id", String(255), nullable=False),
+    Column("resource_id", String(255), nullable=False),
+    Column("charge_sum", Integer, nullable=False, default=0),
+    Column("refund_sum", Integer, nullable=False, default=0),
+    mysql_engine="InnoDB")
+
+Index("ix_daily_usage_day", daily_usage.c.day, daily_usage.c.project_id,
+    daily_usage.c.resource_id, daily_usage.c.user_id, unique=True)
+Index("ix_daily_usage_user_id", daily_usage.c.user_id, daily_usage.c.day)
+
+
+ledger_closes = Table("ledger_closes", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("cutoff", DateTime, nullable=False, unique=True),
+    Column("datetime", DateTime, nullable=False, default=datetime.now),
+    mysql_engine="InnoDB")
+
+
+allocation_checkpoints = Table("allocation_checkpoints", metadata,
+    Column("close_id", None, ForeignKey("ledger_closes.id"),
+        primary_key=True, autoincrement=False),
+    Column("allocation_id", None, ForeignKey("allocations.id"),
+        primary_key=True, autoincrement=False),
+    Column("charged", Integer, nullable=False, default=0),
+    Column("refunded", Integer, nullable=False, default=0),
+    mysql_engine="InnoDB")
+
+
+ledger_archives = Table("ledger_archives", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("before", DateTime, nullable=False, unique=True),
+    Column("datetime", DateTime, nullable=False, default=datetime.now),
+    mysql_engine="InnoDB")
+
+
+# archived entries refer to jobs by id, rather than by key
+archived_jobs = Table("archived_jobs", metadata,
+    Column("id", String(255), primary_key=True, autoincrement=False),
+    *[column.copy() for column in jobs.columns
+      if column.name not in ("key", "id")],
+    **dict(mysql_engine="InnoDB"))
+
+Index("ix_archived_jobs_user_id", archived_jobs.c.user_id,
+    archived_jobs.c.end)
+Index("ix_archived_jobs_account_id", archived_jobs.c.account_id,
+    archived_jobs.c.end)
+Index("ix_archived_jobs_resource_id", archived_jobs.c.resource_id,
+    archived_jobs.c.end)
+
+
+archived_holds = Table("archived_holds", metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("allocation_id", Integer, nullable=False),
+    Column("datetime", DateTime, nullable=False),
+    Column("amount", Integer, nullable=False),
+    Column("comment", Text),
+    Column("active", Boolean, nullable=False),
+    Column("job_id", String(255), nullable=True),
+    mysql_engine="InnoDB")
+
+Index("ix_archived_holds_job_id", archived_holds.c.job_id)
+
+
+archived_charges = Table("archived_charges", metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("allocation_id", Integer, nullable=False),
+    Column("datetime", DateTime, nullable=False),
+    Column("amount", Integer, nullable=False),
+    Column("comment", Text),
+    Column("job_id", String(255), nullable=True),
+    mysql_engine="InnoDB")
+
+Index("ix_archived_charges_allocation_id", archived_charges.c.allocation_id,
+    archived_charges.c.datetime)
+Index("ix_archived_charges_job_id", archived_charges.c.job_id)
+
+
+archived_refunds = Table("archived_refunds", metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("charge_id", Integer, nullable=False),
+    Column("datetime", DateTime, nullable=False),
+    Column("amount", Integer, nullable=False),
+    Column("comment", Text),
+    mysql_engine="InnoDB")
+
+Index("ix_archived_refunds_charge_id", archived_refunds.c.charge_id)
+
+
+resource_values = Table("resource_values", metadata,
+    Column("job_key", None, ForeignKey("jobs.key"),
+        primary_key=True, autoincrement=False),
+    Column("attribute", String(32), primary_key=True, autoincrement=False),
+    Column("name", String(255), primary_key=True, autoincrement=False),
+    Column("value", BigInteger, nullable=False),
+    mysql_engine="InnoDB")
+
+Index("ix_resource_values_name", resource_values.c.name,
+    resource_values.c.attribute, resource_values.c.job_key)
+
+
+# the values of archived jobs refer to them by id, as their entries do
+archived_resource_values = Table("archived_resource_values", metadata,
+    Column("job_id", String(255), primary_key=True, autoincrement=False),
+    Column("attribute", String(32), primary_key=True, autoincrement=False),
+    Column("name", String(255), primary_key=True, autoincrement=False),
+    Column("value", BigInteger, nullable=False),
+    mysql_engine="InnoDB")
+
+Index("ix_archived_resource_values_name", archived_resource_values.c.name,
+    archived_resource_values.c.attribute, archived_resource_values.c.job_id)
+
+
+job_nodes = Table("job_nodes", metadata,
+    Column("job_key", None, ForeignKey("jobs.key"),
+        primary_key=True, autoincrement=False),
+    Column("node", String(255), primary_key=True, autoincrement=False),
+    mysql_engine="InnoDB")
+
+Index("ix_job_nodes_node", job_nodes.c.node, job_nodes.c.job_key)
+
+
+# the nodes of archived jobs refer to them by id, as their entries do
+archived_job_nodes = Table("archived_job_nodes", metadata,
+    Column("job_id", String(255), primary_key=True, autoincrement=False),
+    Column("node", String(255), primary_key=True, autoincrement=False),
+    mysql_engine="InnoDB")
+
+Index("ix_archived_job_nodes_node", archived_job_nodes.c.node,
+    archived_job_nodes.c.job_id)
+
+
+import_checkpoints = Table("import_checkpoints", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("path", String(255), nullable=False, unique=True),
+    Column("inode", BigInteger, nullable=False),
+    Column("size", BigInteger, nullable=False),
+    Column("head", String(40), nullable=False),
+    Column("offset", BigInteger, nullable=False),
+    Column("datetime", DateTime, nullable=False, default=datetime.now),
+    mysql_engine="InnoDB")
+
+
+schema_versions = Table("schema_versions", metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("description", Text),
+    Column("datetime", DateTime, nullable=False, default=datetime.now),
+    mysql_engine="InnoDB")
@@ -76,6 +76,8 @@ class UpstreamEntity (Entity):
 
     _in = None
     _out = None
+    _ids = {}
+    id_cache_size = 10000
 
     def __init__ (self, id_):
         Entity.__init__(self)
@@ -89,6 +91,33 @@ class UpstreamEntity (Entity):
                 return cls.cached(id_)
         return cls.cached(input)
 
+    @classmethod
+    def fetch_id (cls, input):
+        """The id of the entity that fetch would return.
+        
+        No entity is created. Ids found upstream are cached instead,
+        and the cache is cleared when it reaches id_cache_size, so
+        that it stays bounded however many entities are looked up.
+        """
+        key = (cls, input)
+        try:
+            return UpstreamEntity._ids[key]
+        except KeyError:
+            pass
+        if cls._in:
+            id_ = cls._in(input)
+            if id_ is not None:
+                if len(UpstreamEntity._ids) >= cls.id_cache_size:
+                    UpstreamEntity._ids.clear()
+                UpstreamEntity._ids[key] = id_
+                return id_
+        return input
+
+    @classmethod
+    def clear_ids (cls):
+        """Clear the cache of ids used by fetch_id."""
+        UpstreamEntity._ids.clear()
+
     @classmethod
     @memoized
     def cached (cls, *args):
@@ -330,6 +359,7 @@ class Job (Entity):
     """A job run on a computational resource.
     
     Attributes:
+    key -- the integer key of the job (assigned when it is stored)
     id -- the canonical job id
     user -- the user under which the job executed
     group -- the group under which the job executed
@@ -350,6 +380,7 @@ class Job (Entity):
     exit_status -- the exit status of the job
     resources_used -- aggregate amount of specified resources used
     accounting_id -- CSA JID, job ID
+    resource -- the resource the job ran on
     charges -- charges associated with the job
     holds -- holds associated with the job
     """
@@ -382,6 +413,7 @@ class Job (Entity):
         self.exit_status = None
         self.resources_used = {}
         self.accounting_id = None
+        self.resource = None
         self.charges = []
         self.holds = []
 
@@ -413,6 +445,20 @@ class Job (Entity):
 
     account = property(_get_account, _set_account)
 
+    def _set_resource (self, resource):
+        if resource is None:
+            self.resource_id = None
+        else:
+            self.resource_id = resource.id
+
+    def _get_resource (self):
+        if self.resource_id is None:
+            return None
+        else:
+            return Resource.cached(self.resource_id)
+
+    resource = property(_get_resource, _set_resource)
+
     @classmethod
     def from_pbs (cls, entry):
         """Construct a job given a PBS accounting log entry."""
@@ -422,30 +468,9 @@ class Job (Entity):
         return job
 
     def update_from_pbs (self, entry):
-        _, _, attributes = parse_pbs(entry)
-        if "user" in attributes:
-            self.user = User.fetch(attributes['user'])
-        if "account" in attributes:
-            self.account = Project.fetch(attributes['account'])
-        for attribute in ("queue", "group", "exec_host"):
-            if attribute in attributes:
-                setattr(self, attribute, attributes[attribute])
-        for attribute in ("ctime", "qtime", "etime", "start", "end"):
-            if attribute in attributes:
-                setattr(self, attribute,
-                        datetime.fromtimestamp(float(attributes[attribute])))
-        if "jobname" in attributes:
-            self.name = attributes["jobname"]
-        if "Exit_status" in attributes:
-            self.exit_status = int(attributes["Exit_status"])
-        if "session" in attributes:
-            self.session = int(attributes['session'])
-        self.resource_list = dict_parser(dict_parser(
-                subdict(attributes, "Resource_List."),
-            int), parse_timedelta)
-        self.resources_used = dict_parser(dict_parser(
-                subdict(attributes, "resources_used."),
-            int), parse_timedelta)
+        _, values = parse_job(entry)
+        for (attribute, value) in values.iteritems():
+            setattr(self, attribute, value)
 
     def __str__ (self):
         return str(self.id)
@@ -559,6 +584,86 @@ def parse_pbs (entry):
     return entry_type, id_, attributes
 
 
+def parse_job (entry):
+    
+    """Parse a PBS accounting log entry as a job id and job column values.
+    
+    Only the attributes present in the entry are included, except for
+    resource_list and resources_used, which are always replaced.
+    
+    The entry is decoded in a single pass over its attributes, each of
+    which is converted by the parser for its key in job_attributes (if
+    any), or by parse_resource for the resources in job_resources.
+    """
+    
+    try:
+        _, entry_type, id_, message_text = entry.split(";", 3)
+    except ValueError:
+        raise ValueError("Invalid job record: %s" % entry)
+    if entry_type not in ("Q", "S", "E"):
+        raise ValueError("Invalid job record: %s" % entry)
+    values = {}
+    resources = {'resource_list':{}, 'resources_used':{}}
+    for attribute in message_text.split(" "):
+        key, equals, value = attribute.partition("=")
+        if not equals:
+            continue
+        try:
+            column, parser = job_attributes[key]
+        except KeyError:
+            prefix, dot, resource = key.partition(".")
+            if dot and prefix in job_resources:
+                resources[job_resources[prefix]][resource] = \
+                    parse_resource(value)
+        else:
+            if parser is not None:
+                value = parser(value)
+            values[column] = value
+    values.update(resources)
+    return id_, values
+
+
+def parse_timestamp (timestamp_string):
+    """Parse a unix timestamp as a datetime object."""
+    return datetime.fromtimestamp(float(timestamp_string))
+
+
+def parse_resource (resource_string):
+    """Parse a resource as an int, a timedelta (HH:MM:SS), or a string."""
+    if resource_string.isdigit():
+        return int(resource_string)
+    try:
+        return int(resource_string)
+    except ValueError:
+        pass
+    if resource_string.count(":") == 2:
+        try:
+            return parse_timedelta(resource_string)
+        except ValueError:
+            pass
+    return resource_string
+
+
+job_attributes = {
+    'user':("user_id", User.fetch_id),
+    'account':("account_id", Project.fetch_id),
+    'queue':("queue", None),
+    'group':("group", None),
+    'exec_host':("exec_host", None),
+    'ctime':("ctime", parse_timestamp),
+    'qtime':("qtime", parse_timestamp),
+    'etime':("etime", parse_timestamp),
+    'start':("start", parse_timestamp),
+    'end':("end", parse_timestamp),
+    'jobname':("name", None),
+    'Exit_status':("exit_status", int),
+    'session':("session", int)}
+
+job_resources = {
+    'Resource_List':"resource_list",
+    'resources_used':"resources_used"}
+
+
 def parse_timedelta (timedelta_string):
     """Parse a HH:MM:SS as a timedelta object."""
     try:
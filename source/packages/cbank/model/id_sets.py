@@ -0,0 +1,129 @@
+"""Filters on long lists of ids.
+
+The summaries filter by lists of users, projects, resources,
+allocations, and jobs, which may be as long as the site (list users,
+for an institute). A short list of ids is listed in the IN clauses
+that filter by it; a list longer than max_listed_ids is stored in a
+temporary table for its kind of id, on the connection of the session,
+and is selected from it instead, so that a statement neither exceeds
+the parameter limit of the database (999, in SQLite before 3.32) nor
+grows with the list.
+
+Each connection has one table for each kind of id, created the first
+time it is used, so that a long-running process keeps the same few
+tables however many lists it stores. Each list is stored under a set
+id of its own, and is selected from its table by it, so that a query
+built with a list reads the same ids however many lists are stored
+before it is executed. The rows of a list are kept for as long as
+the select of them is (and so any query built with it), and are
+deleted as the next list of its kind is stored on the same
+connection. Temporary tables are dropped by the database when the
+connection is closed.
+
+listed_ids -- the ids of a list, to filter by with in_
+"""
+
+
+from itertools import count
+from weakref import ref
+
+from sqlalchemy import MetaData, Table, Column, Integer, String
+from sqlalchemy.sql import select
+from sqlalchemy.orm.session import Session
+from sqlalchemy.engine.base import Connection
+
+from cbank.model.entities import Job
+
+
+__all__ = ["listed_ids"]
+
+
+max_listed_ids = 500
+
+# the temporary tables are not part of the schema (see
+# cbank.model.database), and are created on each connection
+id_metadata = MetaData()
+
+id_tables = dict(
+    (kind, Table("id_set_%s" % kind, id_metadata,
+        Column("set_id", Integer, primary_key=True, autoincrement=False),
+        Column("id", type_, primary_key=True),
+        prefixes=["TEMPORARY"]))
+    for (kind, type_) in (
+        ("users", String(255)),
+        ("projects", String(255)),
+        ("resources", String(255)),
+        ("allocations", Integer),
+        ("jobs", String(255))))
+
+
+class IdSets (object):
+
+    """The lists of ids stored on a connection.
+
+    Lists are released (by a weak reference to the select of each) as
+    the selects are dropped, and their rows are deleted as the next
+    list of their kind is stored.
+    """
+
+    def __init__ (self):
+        self.created = set()
+        self.set_ids = count(1)
+        self.selects = {}
+        self.released = []
+
+    def store (self, bind, kind, ids):
+        """Store a list of ids, and return a select of them."""
+        table = id_tables[kind]
+        if kind in self.created:
+            released = [set_id for (kind_, set_id) in self.released
+                        if kind_ == kind]
+            if released:
+                bind.execute(table.delete(table.c.set_id.in_(released)))
+                self.released = [(kind_, set_id)
+                                 for (kind_, set_id) in self.released
+                                 if kind_ != kind]
+        else:
+            table.create(bind=bind)
+            self.created.add(kind)
+        set_id = self.set_ids.next()
+        bind.execute(table.insert(),
+                     [{'set_id':set_id, 'id':id_} for id_ in ids])
+        query = select([table.c.id], table.c.set_id == set_id)
+        self.selects[set_id] = ref(query,
+            lambda reference: self.release(kind, set_id))
+        return query
+
+    def release (self, kind, set_id):
+        """Release a list, as its select is dropped."""
+        del self.selects[set_id]
+        self.released.append((kind, set_id))
+
+
+def listed_ids (kind, ids, bind=None):
+
+    """The ids of a list, to filter by with in_.
+
+    Arguments:
+    kind -- the kind of id listed: users, projects, resources,
+        allocations, or jobs
+    ids -- the ids of the list
+
+    Keyword arguments:
+    bind -- a session or connection to store a long list with (with
+        an engine, or none, the ids are always listed)
+
+    Returns a list of the ids, or a select of them from the temporary
+    table for their kind (which stays valid for as long as it is
+    kept).
+    """
+
+    ids = list(set(ids))
+    if isinstance(bind, Session):
+        bind = bind.connection(Job)
+    if len(ids) <= max_listed_ids or not isinstance(bind, Connection):
+        return ids
+    id_sets = bind.info.get("id_sets")
+    if id_sets is None:
+        id_sets = bind.info["id_sets"] = IdSets()
+    return id_sets.store(bind, kind, ids)
@@ -0,0 +1,152 @@
+"""The nodes jobs ran on.
+
+The exec_host of a job lists the cpus of each node it ran on, and is
+stored compactly rather than indexed. The nodes themselves are also
+stored in the job_nodes table, one row per job and node, so that the
+jobs that ran on a node are found by an index rather than by
+matching the exec_host of each job.
+
+Nodes are stored as jobs are imported (and by JobNodes, as jobs are
+flushed); rebuild_job_nodes stores the nodes of existing jobs. As
+with resource values, nodes are stored by the key of each job, and
+the nodes of archived jobs are moved to the archived_job_nodes table
+(by the id of the job) as they are archived.
+
+JobNodes -- a session extension that stores the nodes of jobs
+exec_host_nodes -- the nodes in an exec_host string
+store_job_nodes -- store the nodes of imported jobs
+rebuild_job_nodes -- store the nodes of all jobs
+node_job_keys -- a query for the keys of the jobs that ran on nodes
+"""
+
+
+from sqlalchemy.sql import select
+from sqlalchemy.orm.session import SessionExtension
+from sqlalchemy.orm.attributes import get_history, PASSIVE_NO_FETCH
+
+from cbank.model.entities import Job
+from cbank.model.database import (
+    jobs, archived_jobs, job_nodes, archived_job_nodes)
+
+
+__all__ = [
+    "JobNodes",
+    "exec_host_nodes", "store_job_nodes", "rebuild_job_nodes",
+    "node_job_keys"]
+
+
+class JobNodes (SessionExtension):
+
+    """Store the nodes of jobs as they are flushed."""
+
+    def before_flush (self, session, flush_context, instances):
+        """Delete the nodes of deleted jobs, before the jobs."""
+        deleted = [instance.key for instance in session.deleted
+                   if isinstance(instance, Job)]
+        if deleted:
+            session.execute(job_nodes.delete(
+                job_nodes.c.job_key.in_(deleted)))
+
+    def after_flush (self, session, flush_context):
+        """Store the nodes of new and changed jobs."""
+        records = []
+        for instance in session.new:
+            if isinstance(instance, Job):
+                records.append(
+                    (instance.key, {'exec_host':instance.exec_host}))
+        for instance in session.dirty:
+            # an unloaded (deferred) exec_host has not changed
+            if isinstance(instance, Job) and get_history(
+                    instance, "exec_host", passive=PASSIVE_NO_FETCH).added:
+                records.append(
+                    (instance.key, {'exec_host':instance.exec_host}))
+        store_job_nodes(session, records)
+
+
+def exec_host_nodes (exec_host):
+    """The distinct nodes in an exec_host string, in order."""
+    nodes = []
+    for entry in (exec_host or "").split("+"):
+        node = entry.partition("/")[0]
+        if node and node not in nodes:
+            nodes.append(node)
+    return nodes
+
+
+def node_rows (records, column="job_key"):
+    """The job_nodes rows of (job key, values) pairs.
+
+    The rows of archived_job_nodes are of (job id, values) pairs, with
+    a column of job_id.
+    """
+    return [{column:key, 'node':node}
+            for (key, values) in records
+            for node in exec_host_nodes(values.get("exec_host"))]
+
+
+def store_job_nodes (bind, records):
+
+    """Store the nodes of jobs.
+
+    The stored nodes of each job with an exec_host in its values are
+    replaced; other jobs are left as they are.
+
+    Arguments:
+    bind -- a session, connection, or engine to write to
+    records -- (job key, values) pairs, with values as returned by
+        parse_job
+    """
+
+    records = [(key, values) for (key, values) in records
+               if "exec_host" in values]
+    if not records:
+        return
+    bind.execute(job_nodes.delete(job_nodes.c.job_key.in_(
+        set(key for (key, values) in records))))
+    rows = node_rows(records)
+    if rows:
+        bind.execute(job_nodes.insert(), rows)
+
+
+def rebuild_job_nodes (bind, batch_size=1000):
+
+    """Store the nodes of all jobs (live and archived).
+
+    Jobs are read in batches of their keys (or ids, in the archive).
+
+    Arguments:
+    bind -- a session, connection, or engine to write to
+
+    Keyword arguments:
+    batch_size -- the number of jobs to read at a time
+
+    Returns the number of nodes stored.
+    """
+
+    count = 0
+    for (table, key, nodes, column) in (
+            (jobs, jobs.c.key, job_nodes, "job_key"),
+            (archived_jobs, archived_jobs.c.id, archived_job_nodes,
+             "job_id")):
+        bind.execute(nodes.delete())
+        last = None
+        while True:
+            query = select([key, table.c.exec_host])
+            if last is not None:
+                query = query.where(key > last)
+            query = query.order_by(key).limit(batch_size)
+            batch = bind.execute(query).fetchall()
+            if not batch:
+                break
+            last = batch[-1][0]
+            rows = node_rows([(key_, {'exec_host':exec_host})
+                              for (key_, exec_host) in batch], column)
+            if rows:
+                bind.execute(nodes.insert(), rows)
+            count += len(rows)
+    return count
+
+
+def node_job_keys (nodes):
+    """A query for the keys of the jobs that ran on any of a list of nodes."""
+    return select([job_nodes.c.job_key], job_nodes.c.node.in_(nodes))
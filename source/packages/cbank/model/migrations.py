@@ -0,0 +1,349 @@
+"""Schema migrations for existing databases.
+
+Each migration brings the schema of a database from one version to
+the next, and the versions applied are recorded in schema_versions.
+Migrations check what already exists, so that they can be applied to
+a database created with metadata.create_all (which has the current
+schema, but no recorded version), or applied again after a failure.
+
+migrations -- the migrations, in order
+describe_migration -- a one-line description of a migration
+schema_version -- the schema version of a database
+pending_migrations -- the migrations not yet applied to a database
+migrate -- apply pending migrations to a database
+"""
+
+
+from datetime import datetime
+
+from sqlalchemy import MetaData, Table, Column
+from sqlalchemy.sql import select, func, and_
+from sqlalchemy.engine.reflection import Inspector
+
+from cbank.model.database import (
+    metadata, allocations, holds, jobs, charges, refunds,
+    import_checkpoints, schema_versions, allocation_balances, daily_usage,
+    ledger_closes, allocation_checkpoints, ledger_archives,
+    archived_jobs, archived_holds, archived_charges, archived_refunds,
+    resource_values, archived_resource_values,
+    job_nodes, archived_job_nodes)
+from cbank.model.balances import rebuild_balances
+from cbank.model.usage import rebuild_usage
+from cbank.model.resource_values import rebuild_resource_values
+from cbank.model.job_nodes import rebuild_job_nodes
+from cbank.model.archive import InsertFromSelect
+
+
+__all__ = [
+    "migrations", "describe_migration", "schema_version",
+    "pending_migrations", "migrate"]
+
+
+def create_import_checkpoints (connection):
+    """Create the import_checkpoints table."""
+    import_checkpoints.create(connection, checkfirst=True)
+
+
+def create_ledger_indexes (connection):
+    """Index the allocations, holds, jobs, charges, and refunds tables."""
+    # the indexes are of the keyed tables
+    key_jobs(connection)
+    create_indexes(connection, [allocations, holds, jobs, charges, refunds])
+
+
+def create_indexes (connection, tables):
+    """Create the indexes of tables that do not already exist."""
+    inspector = Inspector.from_engine(connection)
+    for table in tables:
+        existing = set(
+            index['name'] for index in inspector.get_indexes(table.name))
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing:
+                index.create(connection)
+
+
+def create_archive_tables (connection):
+    """Create the archive tables that do not already exist."""
+    for table in (archived_jobs, archived_holds,
+                  archived_charges, archived_refunds):
+        table.create(connection, checkfirst=True)
+
+
+def create_allocation_balances (connection):
+    """Create and fill the allocation_balances table."""
+    # balances are computed from the archive tables as well
+    create_archive_tables(connection)
+    allocation_balances.create(connection, checkfirst=True)
+    rebuild_balances(connection)
+
+
+def create_daily_usage (connection):
+    """Create and fill the daily_usage table."""
+    # usage is computed from the archive tables as well, and charges
+    # are joined to their jobs by key
+    create_archive_tables(connection)
+    key_jobs(connection)
+    daily_usage.create(connection, checkfirst=True)
+    rebuild_usage(connection)
+
+
+def create_ledger_closes (connection):
+    """Create the ledger_closes and allocation_checkpoints tables."""
+    ledger_closes.create(connection, checkfirst=True)
+    allocation_checkpoints.create(connection, checkfirst=True)
+
+
+def create_ledger_archives (connection):
+    """Create the ledger_archives table and the archive tables."""
+    ledger_archives.create(connection, checkfirst=True)
+    create_archive_tables(connection)
+
+
+def create_resource_values (connection):
+    """Create and fill the resource_values table."""
+    # the values are of the keyed jobs (an existing table is keyed by
+    # key_resource_values)
+    key_jobs(connection)
+    if resource_values.exists(connection):
+        return
+    resource_values.create(connection)
+    archived_resource_values.create(connection, checkfirst=True)
+    rebuild_resource_values(connection)
+
+
+def key_jobs (connection):
+    """Key jobs by an integer, and refer to them by key in the ledger."""
+    inspector = Inspector.from_engine(connection)
+    if "key" in [column['name'] for column in inspector.get_columns("jobs")]:
+        return
+    # the tables are copied aside, and created again with the current
+    # schema (as the primary key of a table cannot be changed in place)
+    tables = [jobs, holds, charges, refunds]
+    copies = {}
+    copy_metadata = MetaData()
+    preparer = connection.dialect.identifier_preparer
+    for table in tables:
+        copy = Table("unkeyed_%s" % table.name, copy_metadata, *[
+            Column(column['name'], column['type'])
+            for column in inspector.get_columns(table.name)])
+        connection.execute("CREATE TABLE %s AS SELECT * FROM %s" % (
+            preparer.format_table(copy), preparer.format_table(table)))
+        copies[table] = copy
+    for table in reversed(tables):
+        table.drop(connection)
+    for table in tables:
+        table.create(connection)
+        copy = copies[table]
+        # columns added by later migrations are left empty
+        columns = [column for column in table.c
+                   if column.name in copy.c or column.name == "job_key"]
+        selected = []
+        from_obj = copy
+        for column in columns:
+            if column.name == "job_key":
+                selected.append(jobs.c.key)
+                from_obj = copy.outerjoin(jobs, copy.c.job_id == jobs.c.id)
+            else:
+                selected.append(copy.c[column.name])
+        # new keys are assigned to jobs in the order of their ids
+        connection.execute(InsertFromSelect(table, select(
+            selected, from_obj=[from_obj]).order_by(copy.c.id), columns))
+        copy.drop(connection)
+    if connection.dialect.name == "postgresql":
+        # the ids were copied, rather than drawn from their sequences
+        for table in (holds, charges, refunds):
+            connection.execute(
+                "SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+                "(SELECT coalesce(max(id), 0) + 1 FROM %s), false)" % (
+                    table.name, preparer.format_table(table)))
+
+
+def create_job_nodes (connection):
+    """Store exec_host as text, and create and fill the job_nodes table."""
+    # exec_host was a String(255), which truncated the exec_host of
+    # wide jobs (sqlite does not enforce the length of a column)
+    dialect = connection.dialect
+    preparer = dialect.identifier_preparer
+    for table in (jobs, archived_jobs):
+        if not table.exists(connection):
+            continue
+        column = preparer.format_column(table.c.exec_host)
+        if dialect.name == "mysql":
+            connection.execute("ALTER TABLE %s MODIFY %s TEXT" % (
+                preparer.format_table(table), column))
+        elif dialect.name == "postgresql":
+            connection.execute("ALTER TABLE %s ALTER COLUMN %s TYPE TEXT" % (
+                preparer.format_table(table), column))
+    # an existing table is keyed by key_job_nodes
+    if job_nodes.exists(connection):
+        return
+    job_nodes.create(connection)
+    archived_job_nodes.create(connection, checkfirst=True)
+    rebuild_job_nodes(connection)
+
+
+def add_job_resources (connection):
+    """Record the resource of each job, from its charges."""
+    inspector = Inspector.from_engine(connection)
+    preparer = connection.dialect.identifier_preparer
+    for table in (jobs, archived_jobs):
+        columns = [column['name'] for column in inspector.get_columns(
+            table.name)]
+        if "resource_id" not in columns:
+            connection.execute("ALTER TABLE %s ADD COLUMN %s %s" % (
+                preparer.format_table(table),
+                preparer.format_column(table.c.resource_id),
+                table.c.resource_id.type.compile(dialect=connection.dialect)))
+    create_indexes(connection, [jobs, archived_jobs])
+    # jobs charged to more than one resource take the resource of
+    # their first charge, by id (as JobResources records it)
+    for (table, charges_, charged) in (
+            (jobs, charges, charges.c.job_key == jobs.c.key),
+            (archived_jobs, archived_charges,
+             archived_charges.c.job_id == archived_jobs.c.id)):
+        resource_id = select([allocations.c.resource_id], and_(
+            charged, charges_.c.allocation_id == allocations.c.id))
+        resource_id = resource_id.order_by(charges_.c.id).limit(1)
+        connection.execute(table.update(table.c.resource_id == None,
+            values={'resource_id':resource_id.as_scalar()}))
+
+
+def create_page_indexes (connection):
+    """Index the holds, jobs, and charges lists by their order keys."""
+    # the indexes replace those of the first of their keys alone
+    inspector = Inspector.from_engine(connection)
+    preparer = connection.dialect.identifier_preparer
+    for (table, name) in ((jobs, "ix_jobs_ctime"),
+                          (charges, "ix_charges_datetime")):
+        existing = set(
+            index['name'] for index in inspector.get_indexes(table.name))
+        if name in existing:
+            if connection.dialect.name == "mysql":
+                connection.execute("DROP INDEX %s ON %s" % (
+                    preparer.quote(name, False),
+                    preparer.format_table(table)))
+            else:
+                connection.execute(
+                    "DROP INDEX %s" % preparer.quote(name, False))
+    create_indexes(connection, [holds, jobs, charges])
+
+
+def key_daily_usage (connection):
+    """Key daily usage uniquely by day, user, project, and resource."""
+    # daily usage is recomputed from the ledger, with a user_id of ""
+    # for charges without a user, so that the key can be unique
+    # (null values are not equal to each other in a unique index)
+    daily_usage.drop(connection, checkfirst=True)
+    daily_usage.create(connection)
+    rebuild_usage(connection)
+
+
+def key_resource_values (connection):
+    """Key the resource values of jobs by job key, rather than id."""
+    # the values of archived jobs are moved to archived_resource_values
+    # (by id), and all values are recomputed from the jobs
+    archived_resource_values.create(connection, checkfirst=True)
+    inspector = Inspector.from_engine(connection)
+    columns = [column['name'] for column in inspector.get_columns(
+        resource_values.name)]
+    if "job_key" in columns:
+        return
+    resource_values.drop(connection)
+    resource_values.create(connection)
+    rebuild_resource_values(connection)
+
+
+def key_job_nodes (connection):
+    """Key the nodes of jobs by job key, rather than id."""
+    # the nodes of archived jobs are moved to archived_job_nodes (by
+    # id), and all nodes are found again from the jobs
+    archived_job_nodes.create(connection, checkfirst=True)
+    inspector = Inspector.from_engine(connection)
+    columns = [column['name'] for column in inspector.get_columns(
+        job_nodes.name)]
+    if "job_key" in columns:
+        return
+    job_nodes.drop(connection)
+    job_nodes.create(connection)
+    rebuild_job_nodes(connection)
+
+
+migrations = [
+    create_import_checkpoints,
+    create_ledger_indexes,
+    create_allocation_balances,
+    create_daily_usage,
+    create_ledger_closes,
+    create_ledger_archives,
+    create_resource_values,
+    key_jobs,
+    create_job_nodes,
+    add_job_resources,
+    create_page_indexes,
+    key_daily_usage,
+    key_resource_values,
+    key_job_nodes]
+
+
+def describe_migration (migration):
+    """The first line of the docstring of a migration."""
+    return migration.__doc__.strip().splitlines()[0]
+
+
+def schema_version (bind=None):
+    """The latest migration applied to a database (0 for none)."""
+    if bind is None:
+        bind = metadata.bind
+    if not schema_versions.exists(bind):
+        return 0
+    return bind.execute(select(
+        [func.coalesce(func.max(schema_versions.c.version), 0)])).scalar()
+
+
+def pending_migrations (bind=None):
+    """The (version, migration) pairs not yet applied to a database."""
+    current = schema_version(bind)
+    return [(version, migration) for (version, migration)
+            in enumerate(migrations, 1) if version > current]
+
+
+def migrate (bind=None, version=None):
+
+    """Apply pending migrations to a database.
+
+    Each migration is applied in its own transaction, along with the
+    record of its version. (Where the database commits schema changes
+    implicitly, a failed migration is applied again the next time.)
+
+    Keyword arguments:
+    bind -- the engine or connection to migrate (default metadata.bind)
+    version -- the version to migrate to (default the latest)
+
+    Returns the (version, migration) pairs applied.
+    """
+
+    if bind is None:
+        bind = metadata.bind
+    connection = bind.connect()
+    try:
+        schema_versions.create(connection, checkfirst=True)
+        applied = []
+        for (version_, migration) in pending_migrations(connection):
+            if version is not None and version_ > version:
+                break
+            transaction = connection.begin()
+            try:
+                migration(connection)
+                connection.execute(schema_versions.insert(values={
+                    'version':version_,
+                    'description':describe_migration(migration),
+                    'datetime':datetime.now()}))
+            except:
+                transaction.rollback()
+                raise
+            else:
+                transaction.commit()
+            applied.append((version_, migration))
+        return applied
+    finally:
+        connection.close()
@@ -0,0 +1,155 @@
+"""Keyset pagination of lists.
+
+A page of a list is selected by the order keys of the last entry of
+the page before it, rather than by an offset, so that each page is
+read from an index (see ix_holds_datetime_id, ix_charges_datetime_id,
+and ix_jobs_ctime_key) at the same cost, however deep it is. The keys
+of an entry are passed to the next page as an opaque cursor.
+
+Lists are ordered by their keys in turn, the last of which must be
+unique. Entries with a null first key (the ctime of jobs) are ordered
+first: they are paged as a segment of their own, so that each segment
+is still read in order of its index.
+
+hold_keys, charge_keys, job_keys -- the order keys of each list
+page -- a page of a query, after a cursor
+entry_cursor -- the cursor of an entry, to list the entries after it
+"""
+
+
+import json
+import base64
+import binascii
+from datetime import datetime
+
+from sqlalchemy.sql import and_, or_
+from sqlalchemy.types import DateTime
+
+from cbank.model.entities import Hold, Job, Charge
+from cbank.model.database import holds, jobs, charges
+
+
+__all__ = [
+    "hold_keys", "charge_keys", "job_keys",
+    "page", "entry_cursor"]
+
+
+hold_keys = [holds.c.datetime, holds.c.id]
+charge_keys = [charges.c.datetime, charges.c.id]
+job_keys = [jobs.c.ctime, jobs.c.key]
+
+# the entities mapped to the tables of the keys
+entities = {holds:Hold, jobs:Job, charges:Charge}
+
+datetime_format = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def key_name (key):
+    """The qualified name of an order key."""
+    return "%s.%s" % (key.table.name, key.name)
+
+
+def page (query, keys, cursor=None, limit=None):
+
+    """A page of a query, in order of its keys.
+
+    Arguments:
+    query -- the query to page (any order it has is replaced)
+    keys -- the order keys (columns) of the query
+
+    Keyword arguments:
+    cursor -- list the entries after the entry of a cursor (default
+        from the first entry)
+    limit -- list at most this many entries (default all)
+
+    Raises ValueError for a cursor that is not of the keys.
+    """
+
+    values = None
+    if cursor is not None:
+        values = cursor_values(keys, cursor)
+    query = query.order_by(None)
+    if not keys[0].nullable:
+        return segment(query, keys, values, limit)
+    # entries with a null first key are paged as a segment before the
+    # rest, each in order of its index, and only the page of each
+    # segment is sorted together
+    (first, rest) = (keys[0], keys[1:])
+    segments = []
+    if values is None or values[0] is None:
+        segments.append(segment(query.filter(first == None), rest,
+                                values and values[1:], limit))
+    segments.append(segment(query.filter(first != None), keys,
+                            values and values[0] is not None and values,
+                            limit))
+    if len(segments) == 1:
+        return segments[0]
+    if limit is not None:
+        segments = [segment_.from_self() for segment_ in segments]
+    # the union is sorted by the mapped attributes of the keys, which
+    # the query adapts to it (as it does not adapt table columns)
+    attributes = [getattr(entities[key.table], key.key) for key in keys]
+    query = segments[0].union_all(*segments[1:])
+    query = query.order_by(attributes[0] != None, *attributes)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def segment (query, keys, values=None, limit=None):
+    """A page of a query, after the keys of values (if any)."""
+    query = query.order_by(*keys)
+    if values:
+        query = query.filter(after(keys, values))
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def after (keys, values):
+
+    """A clause selecting the entries ordered after keys of values.
+
+    The clause is written as (k1 >= v1 AND (k1 > v1 OR ...)), rather
+    than as a disjunction of each key, so that the database seeks to
+    the first key in its index, rather than scanning the index from
+    the start.
+    """
+
+    (key, value) = (keys[0], values[0])
+    if len(keys) == 1:
+        return key > value
+    return and_(key >= value, or_(key > value, after(keys[1:], values[1:])))
+
+
+def entry_cursor (keys, entry):
+    """The cursor of an entry, to list the entries after it."""
+    values = []
+    for key in keys:
+        value = getattr(entry, key.key)
+        if isinstance(value, datetime):
+            value = value.strftime(datetime_format)
+        values.append(value)
+    return base64.urlsafe_b64encode(json.dumps(
+        [[key_name(key) for key in keys], values]))
+
+
+def cursor_values (keys, cursor):
+    """The key values of a cursor (from entry_cursor)."""
+    try:
+        names, values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError("invalid cursor: %s" % cursor)
+    # a cursor is only valid for the list it was taken from
+    if (names != [key_name(key) for key in keys]
+            or not isinstance(values, list) or len(values) != len(keys)):
+        raise ValueError("invalid cursor: %s" % cursor)
+    for (index, key) in enumerate(keys):
+        if (values[index] is not None
+                and isinstance(key.type, DateTime)):
+            try:
+                values[index] = datetime.strptime(
+                    values[index], datetime_format)
+            except (TypeError, ValueError):
+                raise ValueError("invalid cursor: %s" % cursor)
+    return values
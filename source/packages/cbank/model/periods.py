@@ -0,0 +1,213 @@
+"""Closed ledger periods.
+
+Closing the ledger before a cutoff stores the charged and refunded
+sums of each allocation before the cutoff (a checkpoint), and rejects
+later changes to the charges and refunds dated before it. A balance
+as of any date since is the latest checkpoint before it, plus the
+charges and refunds between the two, rather than a sum of the whole
+history. (Charges and refunds are each counted by their own date.)
+
+ClosedPeriods -- a session extension that rejects changes before a close
+closed_before -- the cutoff of the latest close
+close_period -- close the ledger before a cutoff
+balances_as_of -- the charged and refunded sums of allocations at a date
+"""
+
+
+from datetime import datetime
+
+from sqlalchemy.sql import select, func, and_
+from sqlalchemy.orm.session import SessionExtension
+from sqlalchemy.orm.attributes import instance_state, get_history
+
+from cbank.model.entities import Charge, Refund
+from cbank.model.database import (
+    charges, refunds, ledger_closes, allocation_checkpoints,
+    archived_charges, archived_refunds)
+
+
+__all__ = [
+    "ClosedPeriods",
+    "closed_before", "close_period", "balances_as_of"]
+
+
+class ClosedPeriods (SessionExtension):
+
+    """Reject changes to the ledger before the latest close.
+
+    New, changed, and deleted charges and refunds dated (now or as
+    stored) before the cutoff of the latest close raise ValueError
+    before they are flushed. Changes to their comments are allowed.
+    """
+
+    def before_flush (self, session, flush_context, instances):
+        """Check the charges and refunds to be flushed."""
+        entries = [
+            instance for instance in (list(session.new)
+                + list(session.dirty) + list(session.deleted))
+            if isinstance(instance, (Charge, Refund))]
+        if not entries:
+            return
+        cutoff = closed_before(session)
+        if cutoff is None:
+            return
+        dirty = session.dirty
+        deleted = session.deleted
+        for instance in entries:
+            if instance in dirty and not changed(instance):
+                continue
+            dates = [stored_datetime(session, instance)]
+            if instance not in deleted:
+                dates.append(instance.datetime)
+            if [date for date in dates if date is not None and date < cutoff]:
+                raise ValueError("closed period: %s %s is dated before %s" % (
+                    instance.__class__.__name__.lower(), instance, cutoff))
+
+
+def changed (instance):
+    """Whether the amount, date, or parent of an entry has changed."""
+    if isinstance(instance, Charge):
+        keys = ["amount", "datetime", "allocation"]
+    else:
+        keys = ["amount", "datetime", "charge"]
+    return [key for key in keys
+            if get_history(instance, key).added]
+
+
+def stored_datetime (session, instance):
+    """The stored date of a charge or refund (None if not stored)."""
+    key = instance_state(instance).key
+    if key is None:
+        return None
+    (id_, ) = key[1]
+    if isinstance(instance, Charge):
+        table = charges
+    else:
+        table = refunds
+    return session.execute(
+        select([table.c.datetime], table.c.id == id_)).scalar()
+
+
+def latest_close (bind, before=None):
+    """The (id, cutoff) of the latest close (at or before a date)."""
+    query = select([ledger_closes.c.id, ledger_closes.c.cutoff])
+    if before is not None:
+        query = query.where(ledger_closes.c.cutoff <= before)
+    query = query.order_by(ledger_closes.c.cutoff.desc()).limit(1)
+    row = bind.execute(query).fetchone()
+    if row is None:
+        return None, None
+    return tuple(row)
+
+
+def closed_before (bind):
+    """The cutoff of the latest close of the ledger (None if none)."""
+    return latest_close(bind)[1]
+
+
+def sums_between (bind, start, end, allocation_ids=None):
+
+    """The charged and refunded sums of allocations in a period.
+
+    Archived charges and refunds are summed with the rest.
+
+    Arguments:
+    bind -- a session, connection, or engine to query
+    start -- the start of the period (None for unbounded)
+    end -- the end (excluded) of the period
+
+    Keyword arguments:
+    allocation_ids -- the allocations to sum (default all)
+
+    Returns a dict of [charged, refunded] by allocation id.
+    """
+
+    queries = []
+    for (charges_, refunds_) in ((charges, refunds),
+                                 (archived_charges, archived_refunds)):
+        for (index, table) in enumerate((charges_, refunds_)):
+            clauses = [table.c.datetime < end]
+            if start is not None:
+                clauses.append(table.c.datetime >= start)
+            if table is refunds_:
+                clauses.append(refunds_.c.charge_id == charges_.c.id)
+            if allocation_ids is not None:
+                clauses.append(charges_.c.allocation_id.in_(allocation_ids))
+            queries.append((index, select(
+                [charges_.c.allocation_id, func.sum(table.c.amount)],
+                and_(*clauses)).group_by(charges_.c.allocation_id)))
+    sums = {}
+    for (index, query) in queries:
+        for (allocation_id, sum_) in bind.execute(query):
+            sums.setdefault(allocation_id, [0, 0])[index] += int(sum_ or 0)
+    return sums
+
+
+def balances_as_of (bind, when, allocation_ids=None):
+
+    """The charged and refunded sums of allocations at a date.
+
+    The sums stored at the latest close at or before the date are
+    added to the sums of the charges and refunds since.
+
+    Arguments:
+    bind -- a session, connection, or engine to query
+    when -- the date (excluded) to sum charges and refunds before
+
+    Keyword arguments:
+    allocation_ids -- the allocations to sum (default all)
+
+    Returns a dict of (charged, refunded) by allocation id, for the
+    allocations that have either.
+    """
+
+    close_id, cutoff = latest_close(bind, when)
+    sums = sums_between(bind, cutoff, when, allocation_ids)
+    if close_id is not None:
+        query = select([
+            allocation_checkpoints.c.allocation_id,
+            allocation_checkpoints.c.charged,
+            allocation_checkpoints.c.refunded],
+            allocation_checkpoints.c.close_id == close_id)
+        if allocation_ids is not None:
+            query = query.where(
+                allocation_checkpoints.c.allocation_id.in_(allocation_ids))
+        for (allocation_id, charged, refunded) in bind.execute(query):
+            sum_ = sums.setdefault(allocation_id, [0, 0])
+            sum_[0] += charged
+            sum_[1] += refunded
+    return dict((allocation_id, tuple(sum_))
+                for (allocation_id, sum_) in sums.iteritems())
+
+
+def close_period (bind, cutoff):
+
+    """Close the ledger before a cutoff.
+
+    The charged and refunded sums of each allocation before the
+    cutoff are stored, and the charges and refunds before it can no
+    longer be changed.
+
+    Arguments:
+    bind -- a session, connection, or engine to write to
+    cutoff -- the date (excluded) to close the ledger before
+
+    Returns the number of allocations checkpointed.
+    """
+
+    if cutoff > datetime.now():
+        raise ValueError("cannot close the ledger in the future: %s" % cutoff)
+    closed = closed_before(bind)
+    if closed is not None and cutoff <= closed:
+        raise ValueError("the ledger is already closed before %s" % closed)
+    sums = balances_as_of(bind, cutoff)
+    result = bind.execute(ledger_closes.insert(values={
+        'cutoff':cutoff, 'datetime':datetime.now()}))
+    (close_id, ) = result.inserted_primary_key
+    if sums:
+        bind.execute(allocation_checkpoints.insert(), [
+            {'close_id':close_id, 'allocation_id':allocation_id,
+             'charged':charged, 'refunded':refunded}
+            for (allocation_id, (charged, refunded))
+            in sorted(sums.iteritems())])
+    return len(sums)
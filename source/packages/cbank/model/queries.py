@@ -1,18 +1,34 @@
-from datetime import datetime
+import operator
+from datetime import datetime, timedelta
 
-from sqlalchemy.sql import func, and_, case
+from sqlalchemy.sql import (
+    func, and_, or_, case, select, union, text, bindparam, literal_column)
 from sqlalchemy.orm import scoped_session, sessionmaker, joinedload
 from sqlalchemy.orm.session import SessionExtension
+from sqlalchemy.orm.query import Query
 from sqlalchemy.orm.exc import NoResultFound
 
 from cbank.model import (
     User, Project,
     Allocation, Hold, Job, Charge, Refund)
 from cbank.model.entities import parse_pbs
+from cbank.model.database import (
+    jobs, import_checkpoints, daily_usage, archived_jobs)
+from cbank.model.balances import AllocationBalances, available_balances
+from cbank.model.usage import (
+    DailyUsage, moved_usage, add_usage_changes, no_user)
+from cbank.model.periods import ClosedPeriods
+from cbank.model.resource_values import ResourceValues, store_resource_values
+from cbank.model.job_nodes import JobNodes, store_job_nodes
+from cbank.model.id_sets import listed_ids
+from cbank.model.pages import hold_keys, charge_keys, page
+from cbank.model.archive import (
+    archived_before, archived_job_counts, archived_charge_sums)
 
 
 __all__ = [
-    "Session", "get_projects", "get_users", "import_job",
+    "Session", "get_projects", "get_users", "import_job", "import_jobs",
+    "get_import_checkpoint", "set_import_checkpoint",
     "user_summary", "project_summary", "allocation_summary",
     "hold_summary", "charge_summary"]
 
@@ -25,7 +41,23 @@ class EntityConstraints (SessionExtension):
             entity.validate()
 
 
-Session = scoped_session(sessionmaker(extension=EntityConstraints()))
+class JobResources (SessionExtension):
+
+    def before_flush (self, session, flush_context, instances):
+        """Record the resource of a charged job that has none."""
+        for instance in (session.new | session.dirty):
+            if not isinstance(instance, Charge):
+                continue
+            job = instance.job
+            if (job is not None and job.resource_id is None
+                    and instance.allocation is not None):
+                job.resource_id = instance.allocation.resource_id
+
+
+Session = scoped_session(sessionmaker(
+    extension=[EntityConstraints(), JobResources(), ClosedPeriods(),
+               AllocationBalances(), DailyUsage(), ResourceValues(),
+               JobNodes()]))
 
 
 def get_projects (member=None, manager=None):
@@ -43,10 +75,17 @@ def get_projects (member=None, manager=None):
     return list(projects)
 
 
+def job_user_ids ():
+    """A subquery of the distinct users of live and archived jobs."""
+    return union(*[select([table.c.user_id])
+                   for table in (jobs, archived_jobs)]).alias()
+
+
 def get_users (member=None, manager=None):
+    users_q = job_user_ids()
     users = (
         User.cached(user_id) for (user_id, )
-        in Session.query(Job.user_id).distinct())
+        in Session.query(users_q.c.user_id).select_from(users_q))
     if member:
         users = (
             user for user in users
@@ -69,60 +108,358 @@ def import_job (entry):
     return job
 
 
+def import_jobs (records, resource=None):
+    
+    """Import a batch of parsed jobs.
+    
+    Records for the same job are coalesced (see coalesce_jobs), so
+    that each job is written once. Existing jobs are found with a
+    single query. New jobs are inserted and existing jobs updated with
+    bulk statements (or a single upsert, where the database supports
+    one). Attributes missing from a record are left unchanged. The
+    values of the configured resources, and the nodes of each job, are
+    stored as well (see store_resource_values and store_job_nodes), and
+    the daily usage of jobs that change users is moved to their new
+    user (see moved_usage).
+    
+    Arguments:
+    records -- (id, values) pairs, as returned by parse_job
+    
+    Keyword arguments:
+    resource -- the resource the jobs ran on (default unchanged)
+    
+    Returns the number of jobs inserted and updated.
+    """
+    
+    records = coalesce_jobs(records)
+    if not records:
+        return 0, 0
+    if resource is not None:
+        for (id_, values) in records:
+            values['resource_id'] = resource.id
+    s = Session()
+    ids = set(id_ for (id_, values) in records)
+    stored = dict((id_, (key, user_id)) for (id_, key, user_id) in s.execute(
+        select([jobs.c.id, jobs.c.key, jobs.c.user_id], jobs.c.id.in_(ids))))
+    existing = set(stored)
+    upsert = job_upsert(s.connection(Job).dialect)
+    if upsert is not None:
+        s.execute(upsert, [
+            job_params(id_, values) for (id_, values) in records],
+            mapper=Job)
+    else:
+        inserts = [(id_, values) for (id_, values) in records
+                   if id_ not in existing]
+        updates = [(id_, values) for (id_, values) in records
+                   if id_ in existing]
+        if inserts:
+            s.execute(jobs.insert(), [
+                job_params(id_, values, prefix="")
+                for (id_, values) in inserts])
+        if updates:
+            s.execute(job_update, [
+                job_params(id_, values) for (id_, values) in updates])
+    # the resource values and nodes of jobs are stored by their keys
+    # (new jobs have just been assigned theirs)
+    keys = dict((id_, key) for (id_, (key, user_id)) in stored.iteritems())
+    if ids - existing:
+        keys.update(s.execute(select([jobs.c.id, jobs.c.key],
+            jobs.c.id.in_(ids - existing))).fetchall())
+    keyed = [(keys[id_], values) for (id_, values) in records]
+    store_resource_values(s, keyed)
+    store_job_nodes(s, keyed)
+    # the usage of jobs charged before their user was imported is
+    # moved to the new user
+    users = {}
+    for (id_, values) in records:
+        if id_ in stored and values.get("user_id") is not None:
+            (key, user_id) = stored[id_]
+            if (user_id or no_user) != values['user_id']:
+                users[key] = (user_id or no_user, values['user_id'])
+    if users:
+        add_usage_changes(s.connection(Job), moved_usage(s, users))
+    return len(ids - existing), len(ids & existing)
+
+
+def coalesce_jobs (records):
+    
+    """Coalesce parsed records for the same job.
+    
+    The values of each job's records are combined in order, so that
+    later records replace the attributes they include, as
+    Job.update_from_pbs would. Jobs are returned in the order they
+    are first seen.
+    
+    Arguments:
+    records -- (id, values) pairs, as returned by parse_job
+    """
+    
+    coalesced = {}
+    order = []
+    for (id_, values) in records:
+        try:
+            coalesced[id_].update(values)
+        except KeyError:
+            coalesced[id_] = dict(values)
+            order.append(id_)
+    return [(id_, coalesced[id_]) for id_ in order]
+
+
+# the columns imported (the key of a new job is assigned on insert)
+job_columns = [column for column in jobs.c
+               if column.name not in ("key", "id")]
+
+
+job_update = jobs.update(jobs.c.id == bindparam("new_id"), values=dict(
+    (column.name, func.coalesce(
+        bindparam("new_%s" % column.name, type_=column.type), column))
+    for column in job_columns))
+
+
+def job_params (id_, values, prefix="new_"):
+    """Bind parameters for a job in job_update or job_upsert."""
+    params = dict(
+        (prefix + column.name, values.get(column.name))
+        for column in job_columns)
+    params[prefix + "id"] = id_
+    return params
+
+
+def job_upsert (dialect):
+    
+    """A dialect-native insert-or-update statement for jobs.
+    
+    Returns None if the dialect has no native upsert. Attributes
+    bound as null leave the existing value unchanged.
+    """
+    
+    quote = dialect.identifier_preparer.format_column
+    table = dialect.identifier_preparer.format_table(jobs)
+    if dialect.name == "mysql":
+        assignment = "%(column)s = COALESCE(VALUES(%(column)s), %(column)s)"
+        conflict = "ON DUPLICATE KEY UPDATE"
+    elif ((dialect.name == "sqlite"
+           and dialect.dbapi.sqlite_version_info >= (3, 24))
+          or (dialect.name == "postgresql"
+              and (dialect.server_version_info or ()) >= (9, 5))):
+        assignment = ("%(column)s = COALESCE(excluded.%(column)s, "
+                      "%(table)s.%(column)s)")
+        conflict = "ON CONFLICT (%s) DO UPDATE SET" % quote(jobs.c.id)
+    else:
+        return None
+    columns = [jobs.c.id] + job_columns
+    statement = "INSERT INTO %s (%s) VALUES (%s) %s %s" % (
+        table,
+        ", ".join(quote(column) for column in columns),
+        ", ".join(":new_%s" % column.name for column in columns),
+        conflict,
+        ", ".join(assignment % {'column':quote(column), 'table':table}
+                  for column in job_columns))
+    return text(statement, bindparams=[
+        bindparam("new_%s" % column.name, type_=column.type)
+        for column in columns])
+
+
+def get_import_checkpoint (path):
+    """The import checkpoint for a log file, or None."""
+    return Session().execute(import_checkpoints.select(
+        import_checkpoints.c.path == path)).fetchone()
+
+
+def set_import_checkpoint (path, inode, size, head, offset):
+    
+    """Record how far a log file has been imported.
+    
+    The checkpoint is written in the current transaction, so that it
+    is committed (or rolled back) along with the imported jobs.
+    
+    Arguments:
+    path -- the path to the log file
+    inode -- the inode of the log file
+    size -- the size of the log file
+    head -- a hash identifying the beginning of the log file
+    offset -- the offset after the last line imported
+    """
+    
+    s = Session()
+    values = {'inode':inode, 'size':size, 'head':head, 'offset':offset,
+              'datetime':datetime.now()}
+    result = s.execute(import_checkpoints.update(
+        import_checkpoints.c.path == path, values=values))
+    if not result.rowcount:
+        values['path'] = path
+        s.execute(import_checkpoints.insert(values=values))
+
+
+def split_days (after=None, before=None):
+    
+    """Split a datetime range into whole days and partial days.
+    
+    Keyword arguments:
+    after -- the start of the range (default unbounded)
+    before -- the end of the range (default unbounded)
+    
+    Returns (days, edges). days is a (first, last) pair of dates,
+    for the whole days first <= day < last (either of which may be
+    None, where the range is unbounded), or None if the range has no
+    whole day. edges are the (start, end) datetime ranges of the
+    partial days.
+    """
+    
+    midnight = dict(hour=0, minute=0, second=0, microsecond=0)
+    if after is not None:
+        first_start = after.replace(**midnight)
+        if after != first_start:
+            first_start += timedelta(days=1)
+        first = first_start.date()
+    if before is not None:
+        last_start = before.replace(**midnight)
+        last = last_start.date()
+    if after is not None and before is not None and first >= last:
+        return None, [(after, before)]
+    edges = []
+    if after is not None and after != first_start:
+        edges.append((after, first_start))
+    if before is not None and before != last_start:
+        edges.append((last_start, before))
+    return ((after is not None and first or None,
+             before is not None and last or None), edges)
+
+
+def within_days (query, days):
+    """Filter daily_usage to a (first, last) pair from split_days."""
+    (first, last) = days
+    if first is not None:
+        query = query.filter(daily_usage.c.day >= first)
+    if last is not None:
+        query = query.filter(daily_usage.c.day < last)
+    return query
+
+
+def within_edges (edges):
+    """Filter charges to the partial days from split_days."""
+    return or_(*[
+        and_(Charge.datetime >= start, Charge.datetime < end)
+        for (start, end) in edges])
+
+
+def net_charges (subqueries):
+    """The charge_sum, less the refund_sum, of a list of subqueries."""
+    charges_ = [func.coalesce(subquery.c.charge_sum, 0)
+                for subquery in subqueries if "charge_sum" in subquery.c]
+    refunds_ = [func.coalesce(subquery.c.refund_sum, 0)
+                for subquery in subqueries if "refund_sum" in subquery.c]
+    return reduce(operator.sub, refunds_, reduce(operator.add, charges_))
+
+
+def job_counts (subqueries):
+    """The sum of the job_count of a list of subqueries."""
+    return reduce(operator.add, [
+        func.coalesce(subquery.c.job_count, 0) for subquery in subqueries])
+
+
+def reaches_archive (after=None):
+    """Whether a range starting after a date includes archived entries."""
+    horizon = archived_before(Session())
+    return horizon is not None and (not after or after < horizon)
+
+
 def user_summary (users, projects=None, resources=None,
                   after=None, before=None):
+    
+    """Job counts and net charges of users.
+    
+    The rows of each source (the live and archived jobs of the
+    users, the daily usage of whole days, and the charges and refunds
+    of partial days) are selected by user, and summed by user in a
+    single aggregation, so that the cost of a summary follows the
+    history of the users summarized rather than of the whole site.
+    Each user with jobs (live or archived) is summarized, with the
+    jobs that match the filters counted.
+    
+    Returns a query of (user_id, job_count, charge_sum) rows, in
+    order of user_id.
+    """
+    
     s = Session()
-    jobs_q = s.query(
-        Job.user_id.label("user_id"),
-        func.count(Job.id).label("job_count"))
-    charges_q = s.query(
-        Job.user_id.label("user_id"),
-        func.sum(Charge.amount).label("charge_sum"))
-    charges_q = charges_q.join(Charge.job)
-    refunds_q = s.query(
-        Job.user_id.label("user_id"),
-        func.sum(Refund.amount).label("refund_sum"))
-    refunds_q = refunds_q.join(Refund.charge, Charge.job)
-
-    jobs_q.filter(Job.user_id.in_(user.id for user in users))
+    user_ids = listed_ids("users", (user.id for user in users), s)
     if projects:
-        jobs_q = jobs_q.filter(
-            Job.account_id.in_(project.id for project in projects))
-        charges_ = Charge.allocation.has(
-            Allocation.project_id.in_(project.id for project in projects))
-        charges_q = charges_q.filter(charges_)
-        refunds_q = refunds_q.filter(charges_)
+        project_ids = listed_ids("projects",
+            (project.id for project in projects), s)
     if resources:
-        charges_ = Charge.allocation.has(Allocation.resource_id.in_(
-            resource.id for resource in resources))
-        jobs_q = jobs_q.filter(Job.charges.any(charges_))
-        charges_q = charges_q.filter(charges_)
-        refunds_q = refunds_q.filter(charges_)
-    if after:
-        jobs_q = jobs_q.filter(Job.end > after)
-        charges_ = Charge.datetime >= after
-        charges_q = charges_q.filter(charges_)
-        refunds_q = refunds_q.filter(charges_)
-    if before:
-        jobs_q = jobs_q.filter(Job.start < before)
-        charges_ = Charge.datetime < before
-        charges_q = charges_q.filter(charges_)
-        refunds_q = refunds_q.filter(charges_)
-
-    jobs_q = jobs_q.group_by(Job.user_id).subquery()
-    charges_q = charges_q.group_by(Job.user_id).subquery()
-    refunds_q = refunds_q.group_by(Job.user_id).subquery()
+        resource_ids = listed_ids("resources",
+            (resource.id for resource in resources), s)
+    zero = literal_column("0")
+    def summary_rows (user_id, job_count=zero, charge_sum=zero,
+                      refund_sum=zero):
+        return s.query(
+            user_id.label("user_id"),
+            job_count.label("job_count"),
+            charge_sum.label("charge_sum"),
+            refund_sum.label("refund_sum"))
+    
+    rows = []
+    for table in (jobs, archived_jobs):
+        counted = []
+        if projects:
+            counted.append(table.c.account_id.in_(project_ids))
+        if resources:
+            counted.append(table.c.resource_id.in_(resource_ids))
+        if after:
+            counted.append(table.c.end > after)
+        if before:
+            counted.append(table.c.start < before)
+        if counted:
+            job_count = func.sum(case([(and_(*counted), 1)], else_=0))
+        else:
+            job_count = func.count()
+        rows.append(summary_rows(table.c.user_id, job_count).filter(
+            table.c.user_id.in_(user_ids)).group_by(table.c.user_id))
+    
+    # whole days are summed from daily_usage, and partial days from
+    # the charges and refunds themselves
+    days, edges = split_days(after or None, before or None)
+    if days is not None:
+        usage_q = summary_rows(daily_usage.c.user_id, zero,
+            daily_usage.c.charge_sum, daily_usage.c.refund_sum)
+        usage_q = usage_q.filter(daily_usage.c.user_id.in_(user_ids))
+        if projects:
+            usage_q = usage_q.filter(
+                daily_usage.c.project_id.in_(project_ids))
+        if resources:
+            usage_q = usage_q.filter(
+                daily_usage.c.resource_id.in_(resource_ids))
+        rows.append(within_days(usage_q, days))
+    if edges:
+        charges_q = summary_rows(Job.user_id, charge_sum=Charge.amount)
+        charges_q = charges_q.join(Charge.job)
+        refunds_q = summary_rows(Job.user_id, refund_sum=Refund.amount)
+        refunds_q = refunds_q.join(Refund.charge, Charge.job)
+        charges_ = [Job.user_id.in_(user_ids), within_edges(edges)]
+        if projects:
+            charges_.append(Charge.allocation.has(
+                Allocation.project_id.in_(project_ids)))
+        if resources:
+            charges_.append(Charge.allocation.has(
+                Allocation.resource_id.in_(resource_ids)))
+        rows.append(charges_q.filter(and_(*charges_)))
+        rows.append(refunds_q.filter(and_(*charges_)))
+        if reaches_archive(after):
+            archived_charges_q, archived_refunds_q = archived_charge_sums(
+                "user_id", users, projects, resources, edges, bind=s)
+            rows.append(summary_rows(archived_charges_q.c.user_id,
+                charge_sum=archived_charges_q.c.charge_sum))
+            rows.append(summary_rows(archived_refunds_q.c.user_id,
+                refund_sum=archived_refunds_q.c.refund_sum))
+    
+    rows = rows[0].union_all(*rows[1:]).subquery()
     query = s.query(
-        Job.user_id,
-        func.coalesce(jobs_q.c.job_count, 0),
-        (func.coalesce(charges_q.c.charge_sum, 0)
-            - func.coalesce(refunds_q.c.refund_sum, 0)))
-    query = query.outerjoin(
-        (jobs_q, Job.user_id == jobs_q.c.user_id),
-        (charges_q, Job.user_id == charges_q.c.user_id),
-        (refunds_q, Job.user_id == refunds_q.c.user_id))
-    query = query.filter(Job.user_id.in_(user.id for user in users))
-    query = query.distinct().order_by(Job.user_id)
+        rows.c.user_id,
+        func.sum(rows.c.job_count),
+        func.coalesce(func.sum(rows.c.charge_sum), 0)
+        - func.coalesce(func.sum(rows.c.refund_sum), 0))
+    query = query.group_by(rows.c.user_id)
+    query = query.order_by(rows.c.user_id)
     return query
 
 
@@ -130,20 +467,11 @@ def project_summary (projects, users=None, resources=None,
                      before=None, after=None):
     now = datetime.now()
     s = Session()
-    allocations_q = s.query(
-        Allocation.project_id,
-        func.sum(Allocation.amount).label("allocation_sum")
-        ).group_by(Allocation.project_id)
-
-    holds_q = s.query(
-        Allocation.project_id,
-        func.sum(Hold.amount).label("hold_sum"))
-    holds_q = holds_q.group_by(Allocation.project_id)
-    holds_q = holds_q.join(Hold.allocation)
-    holds_q = holds_q.filter(Hold.active == True)
+    project_ids = listed_ids("projects",
+        (project.id for project in projects), s)
     jobs_q = s.query(
         Allocation.project_id,
-        func.count(Job.id).label("job_count")).group_by(Allocation.project_id)
+        func.count(Job.key).label("job_count")).group_by(Allocation.project_id)
     jobs_q = jobs_q.outerjoin(Job.charges, Charge.allocation)
     charges_q = s.query(
         Allocation.project_id,
@@ -155,87 +483,110 @@ def project_summary (projects, users=None, resources=None,
         func.sum(Refund.amount).label("refund_sum"))
     refunds_q = refunds_q.group_by(Allocation.project_id)
     refunds_q = refunds_q.join(Refund.charge, Charge.allocation)
-
+    usage_q = s.query(
+        daily_usage.c.project_id.label("project_id"),
+        func.sum(daily_usage.c.charge_sum).label("charge_sum"),
+        func.sum(daily_usage.c.refund_sum).label("refund_sum"))
+    usage_q = usage_q.group_by(daily_usage.c.project_id)
+    usage_q = usage_q.filter(daily_usage.c.project_id.in_(project_ids))
+
+    # each sum is of the selected projects alone
+    selected = Allocation.project_id.in_(project_ids)
+    jobs_q = jobs_q.filter(selected)
+    charges_q = charges_q.filter(selected)
+    refunds_q = refunds_q.filter(selected)
+
+    # every allocated project is listed, but only the allocations of
+    # the resources are available
+    balances = available_balances(now, selected)
+    balance = balances.c.balance
     if resources:
-        resources_ = Allocation.resource_id.in_(
-            resource.id for resource in resources)
-        allocations_q = allocations_q.filter(resources_)
-        holds_q = holds_q.filter(resources_)
+        resource_ids = listed_ids("resources",
+            (resource.id for resource in resources), s)
+        resources_ = Allocation.resource_id.in_(resource_ids)
         charges_q = charges_q.filter(resources_)
         refunds_q = refunds_q.filter(resources_)
         jobs_q = jobs_q.filter(resources_)
-
-    allocations_active = and_(Allocation.start <= now, Allocation.end > now)
-    allocations_q = allocations_q.filter(allocations_active)
-    holds_q = holds_q.filter(Hold.allocation.has(allocations_active))
-    charges_ = Charge.allocation.has(allocations_active)
-    balance_charges_q = charges_q.filter(charges_)
-    balance_refunds_q = refunds_q.filter(Refund.charge.has(charges_))
-
-    holds_q = holds_q.subquery()
-    balance_charges_q = balance_charges_q.subquery()
-    balance_refunds_q = balance_refunds_q.subquery()
+        usage_q = usage_q.filter(daily_usage.c.resource_id.in_(resource_ids))
+        balance = case([(balances.c.resource_id.in_(resource_ids), balance)],
+                       else_=0)
+    balances_q = select([balances.c.project_id,
+                         func.sum(balance).label("balance")],
+                        correlate=False)
+    balances_q = balances_q.group_by(balances.c.project_id).alias()
 
     if users:
-        users_ = Job.user_id.in_(user.id for user in users)
+        user_ids = listed_ids("users", (user.id for user in users), s)
+        users_ = Job.user_id.in_(user_ids)
         jobs_q = jobs_q.filter(users_)
         charges_ = Charge.job.has(users_)
         charges_q = charges_q.filter(charges_)
         refunds_q = refunds_q.filter(charges_)
+        usage_q = usage_q.filter(daily_usage.c.user_id.in_(user_ids))
     if after:
         jobs_q = jobs_q.filter(Job.end > after)
-        after_ = Charge.datetime >= after
-        charges_q = charges_q.filter(after_)
-        refunds_q = refunds_q.filter(after_)
     if before:
         jobs_q = jobs_q.filter(Job.start < before)
-        before_ = Charge.datetime < before
-        charges_q = charges_q.filter(before_)
-        refunds_q = refunds_q.filter(before_)
-
-    allocations_q = allocations_q.subquery()
-    jobs_q = jobs_q.subquery()
-    charges_q = charges_q.subquery()
-    refunds_q = refunds_q.subquery()
-
-    balance = (
-        func.coalesce(allocations_q.c.allocation_sum, 0)
-        - func.coalesce(holds_q.c.hold_sum, 0)
-        - func.coalesce(balance_charges_q.c.charge_sum, 0)
-        + func.coalesce(balance_refunds_q.c.refund_sum, 0))
 
+    # whole days are summed from daily_usage, and partial days from
+    # the charges and refunds themselves
+    days, edges = split_days(after or None, before or None)
+    sums = []
+    if days is not None:
+        sums.append(within_days(usage_q, days).subquery())
+    if edges:
+        sums.append(charges_q.filter(within_edges(edges)).subquery())
+        sums.append(refunds_q.filter(within_edges(edges)).subquery())
+
+    counts = [jobs_q.subquery()]
+    if reaches_archive(after):
+        counts.append(archived_job_counts("project_id",
+            users, projects, resources, after, before, bind=s))
+        if edges:
+            sums.extend(archived_charge_sums("project_id",
+                users, projects, resources, edges, bind=s))
+
+    joined = balances_q
+    for sum_q in counts + sums:
+        joined = joined.outerjoin(sum_q,
+            balances_q.c.project_id == sum_q.c.project_id)
     query = s.query(
-        Allocation.project_id,
-        func.coalesce(jobs_q.c.job_count, 0),
-        (func.coalesce(charges_q.c.charge_sum, 0)
-         - func.coalesce(refunds_q.c.refund_sum, 0)),
-        case([(balance>=0, balance)], else_=0))
-    query = query.distinct()
-    query = query.outerjoin(
-        (jobs_q, Allocation.project_id == jobs_q.c.project_id),
-        (charges_q, Allocation.project_id == charges_q.c.project_id),
-        (refunds_q, Allocation.project_id == refunds_q.c.project_id),
-        (allocations_q, Allocation.project_id == allocations_q.c.project_id),
-        (holds_q, Allocation.project_id == holds_q.c.project_id),
-        (balance_charges_q,
-            Allocation.project_id == balance_charges_q.c.project_id),
-        (balance_refunds_q,
-            Allocation.project_id == balance_refunds_q.c.project_id))
-    query = query.order_by(Allocation.project_id)
-    query = query.filter(
-        Allocation.project_id.in_(project.id for project in projects))
+        balances_q.c.project_id,
+        job_counts(counts),
+        net_charges(sums),
+        case([(balances_q.c.balance>=0, balances_q.c.balance)], else_=0))
+    query = query.select_from(joined)
+    query = query.order_by(balances_q.c.project_id)
     return query
 
 
 def allocation_summary (allocations, users=None,
                         before=None, after=None):
+
+    """Job counts, net charges, and available balances of allocations.
+
+    Arguments:
+    allocations -- the allocations to summarize, or a query of them (so
+        that they are selected in the same statement)
+
+    Keyword arguments:
+    users -- count the jobs and charges of these users
+    after -- count jobs and charges after this date
+    before -- count jobs and charges before this date
+
+    Returns a query of (allocation, job count, net charges, available
+    balance), by allocation id.
+    """
+
     now = datetime.now()
     s = Session()
-    holds_q = s.query(
-        Allocation.id.label("allocation_id"),
-        func.sum(Hold.amount).label("hold_sum")).group_by(Allocation.id)
-    holds_q = holds_q.join(Hold.allocation)
-    holds_q = holds_q.filter(Hold.active == True)
+    if isinstance(allocations, Query):
+        # by id, so that any joins of the query select as they would
+        ids = allocations.order_by(None).subquery()
+        selected = Allocation.id.in_(select([ids.c.id]))
+    else:
+        selected = Allocation.id.in_(listed_ids("allocations",
+            (allocation.id for allocation in allocations), s))
     charges_q = s.query(
         Allocation.id.label("allocation_id"),
         func.sum(Charge.amount).label("charge_sum")).group_by(Allocation.id)
@@ -247,16 +598,19 @@ def allocation_summary (allocations, users=None,
         Refund.charge, Charge.allocation)
     jobs_q = s.query(
         Allocation.id.label("allocation_id"),
-        func.count(Job.id).label("job_count")).group_by(Allocation.id)
+        func.count(Job.key).label("job_count")).group_by(Allocation.id)
     jobs_q = jobs_q.join(
         Job.charges, Charge.allocation)
 
-    balance_charges_q = charges_q.subquery()
-    balance_refunds_q = refunds_q.subquery()
-    holds_q = holds_q.subquery()
+    # each sum is of the selected allocations alone
+    balances = available_balances(now, selected)
+    jobs_q = jobs_q.filter(selected)
+    charges_q = charges_q.filter(selected)
+    refunds_q = refunds_q.filter(selected)
 
     if users:
-        jobs_ = Job.user_id.in_(str(user.id) for user in users)
+        jobs_ = Job.user_id.in_(
+            listed_ids("users", (str(user.id) for user in users), s))
         jobs_q = jobs_q.filter(jobs_)
         charges_ = Charge.job.has(jobs_)
         charges_q = charges_q.filter(charges_)
@@ -272,38 +626,50 @@ def allocation_summary (allocations, users=None,
         charges_q = charges_q.filter(before_)
         refunds_q = refunds_q.filter(before_)
 
-    charges_q = charges_q.subquery()
-    refunds_q = refunds_q.subquery()
-    jobs_q = jobs_q.subquery()
-
-    balance = (
-        Allocation.amount
-        - func.coalesce(holds_q.c.hold_sum, 0)
-        - func.coalesce(balance_charges_q.c.charge_sum, 0)
-        + func.coalesce(balance_refunds_q.c.refund_sum, 0))
-
-    allocations_active = and_(Allocation.start <= now, Allocation.end > now)
+    counts = [jobs_q.subquery()]
+    sums = [charges_q.subquery(), refunds_q.subquery()]
+    if reaches_archive(after):
+        counts.append(archived_job_counts("allocation_id",
+            users=users, after=after, before=before, bind=s))
+        if after or before:
+            ranges = [(after or None, before or None)]
+        else:
+            ranges = None
+        sums.extend(archived_charge_sums("allocation_id",
+            users=users, ranges=ranges, bind=s))
 
     query = s.query(
         Allocation,
-        func.coalesce(jobs_q.c.job_count, 0),
-        (func.coalesce(charges_q.c.charge_sum, 0)
-            - func.coalesce(refunds_q.c.refund_sum, 0)),
-        (case([(and_(allocations_active, balance>=0), balance)], else_=0)))
+        job_counts(counts),
+        net_charges(sums),
+        case([(balances.c.balance>=0, balances.c.balance)], else_=0))
+    query = query.join(
+        (balances, Allocation.id == balances.c.allocation_id))
     query = query.outerjoin(
-        (jobs_q, Allocation.id == jobs_q.c.allocation_id),
-        (charges_q, Allocation.id == charges_q.c.allocation_id),
-        (balance_charges_q, Allocation.id == balance_charges_q.c.allocation_id),
-        (refunds_q, Allocation.id == refunds_q.c.allocation_id),
-        (balance_refunds_q, Allocation.id == balance_refunds_q.c.allocation_id),
-        (holds_q, Allocation.id == holds_q.c.allocation_id))
+        *[(sum_q, Allocation.id == sum_q.c.allocation_id)
+          for sum_q in counts + sums])
     query = query.order_by(Allocation.id)
-    query = query.filter(Allocation.id.in_(
-            allocation.id for allocation in allocations))
+    query = query.filter(selected)
     return query
 
 
-def hold_summary (users=None, projects=None, resources=None, jobs=None, after=None, before=None):
+def streamed (query, batch_size):
+    """A query that fetches its results batch_size rows at a time.
+
+    Rows are read from a server-side cursor, where the dialect has
+    one (yield_per sets the stream_results option), and the objects
+    of each batch are loaded as it is fetched, so that results can be
+    used as they arrive. The objects are not kept by the session
+    (unless they are changed), so the memory used does not grow with
+    the number of results. Only many-to-one relations can be loaded
+    eagerly.
+    """
+    return query.yield_per(batch_size)
+
+
+def hold_summary (users=None, projects=None, resources=None, jobs=None,
+                  after=None, before=None, batch_size=None,
+                  cursor=None, limit=None):
     s = Session()
     query = s.query(Hold).filter_by(active=True)
     query = query.options(joinedload(Hold.allocation))
@@ -311,25 +677,32 @@ def hold_summary (users=None, projects=None, resources=None, jobs=None, after=No
 
     if users:
         query = query.filter(Hold.job.has(Job.user_id.in_(
-            user.id for user in users)))
+            listed_ids("users", (user.id for user in users), s))))
     if projects:
-        query = query.filter(Hold.allocation.has(
-            Allocation.project_id.in_(project.id for project in projects)))
+        query = query.filter(Hold.allocation.has(Allocation.project_id.in_(
+            listed_ids("projects", (project.id for project in projects), s))))
     if resources:
-        query = query.filter(Hold.allocation.has(
-            Allocation.resource_id.in_(resource.id for resource in resources)))
+        query = query.filter(Hold.allocation.has(Allocation.resource_id.in_(
+            listed_ids("resources",
+                (resource.id for resource in resources), s))))
     if after:
         query = query.filter(Hold.datetime >= after)
     if before:
         query = query.filter(Hold.datetime < before)
     if jobs:
         query = query.filter(Hold.job.has(Job.id.in_(
-            job.id for job in jobs)))
+            listed_ids("jobs", (job.id for job in jobs), s))))
+    if cursor is not None or limit is not None:
+        query = page(query, hold_keys, cursor, limit)
+    if batch_size is not None:
+        query = streamed(query, batch_size)
 
     return query
 
 
-def charge_summary (users=None, projects=None, resources=None, jobs=None, after=None, before=None):
+def charge_summary (users=None, projects=None, resources=None, jobs=None,
+                    after=None, before=None, batch_size=None,
+                    cursor=None, limit=None):
     s = Session()
     query = s.query(Charge)
     query = query.options(joinedload(Charge.allocation))
@@ -337,19 +710,24 @@ def charge_summary (users=None, projects=None, resources=None, jobs=None, after=
 
     if users:
         query = query.filter(Charge.job.has(Job.user_id.in_(
-            user.id for user in users)))
+            listed_ids("users", (user.id for user in users), s))))
     if projects:
-        query = query.filter(Charge.allocation.has(
-            Allocation.project_id.in_(project.id for project in projects)))
+        query = query.filter(Charge.allocation.has(Allocation.project_id.in_(
+            listed_ids("projects", (project.id for project in projects), s))))
     if resources:
-        query = query.filter(Charge.allocation.has(
-            Allocation.resource_id.in_(resource.id for resource in resources)))
+        query = query.filter(Charge.allocation.has(Allocation.resource_id.in_(
+            listed_ids("resources",
+                (resource.id for resource in resources), s))))
     if after:
         query = query.filter(Charge.datetime >= after)
     if before:
         query = query.filter(Charge.datetime < before)
     if jobs:
         query = query.filter(Charge.job.has(Job.id.in_(
-            job.id for job in jobs)))
+            listed_ids("jobs", (job.id for job in jobs), s))))
+    if cursor is not None or limit is not None:
+        query = page(query, charge_keys, cursor, limit)
+    if batch_size is not None:
+        query = streamed(query, batch_size)
 
     return query
@@ -0,0 +1,264 @@
+"""Numeric values of job resources.
+
+The resource_list and resources_used of a job are stored as text, so
+they cannot be filtered or summed in the database. The values of a
+configured set of resources are also stored as integers, one row per
+job, attribute, and resource, in the resource_values table (by the key
+of the job): durations (walltime) in seconds, sizes (mem) in bytes,
+and counts (ncpus, nodect) as they are. The values of archived jobs
+are moved to the archived_resource_values table (by the id of the
+job) as they are archived.
+
+The resources are configured as a comma-separated list in the
+resources option of the jobs section (walltime, ncpus, nodect, and
+mem by default). Values are stored as jobs are imported (and by
+ResourceValues, as jobs are flushed); rebuild_resource_values stores
+the values of existing jobs, after the configured resources change.
+
+ResourceValues -- a session extension that stores the values of jobs
+configured_resources -- the names of the resources to store
+numeric_value -- a resource value as an integer
+store_resource_values -- store the values of imported jobs
+rebuild_resource_values -- store the values of all jobs
+resource_summary -- the sums of resource values by project
+"""
+
+
+import re
+import ConfigParser
+from datetime import timedelta
+
+from sqlalchemy.sql import select, func, and_
+from sqlalchemy.orm.session import SessionExtension
+from sqlalchemy.orm.attributes import get_history, PASSIVE_NO_FETCH
+
+from cbank import config
+from cbank.model.entities import Job
+from cbank.model.database import (
+    jobs, archived_jobs, resource_values, archived_resource_values)
+from cbank.model.id_sets import listed_ids
+
+
+__all__ = [
+    "ResourceValues",
+    "configured_resources", "numeric_value",
+    "store_resource_values", "rebuild_resource_values", "resource_summary"]
+
+
+default_resources = ["walltime", "ncpus", "nodect", "mem"]
+
+resource_attributes = ["resource_list", "resources_used"]
+
+size_units = {'b':1, 'w':8}
+for (index, prefix) in enumerate("kmgt"):
+    for unit in ("b", "w"):
+        size_units[prefix + unit] = size_units[unit] * 1024 ** (index + 1)
+
+size_pattern = re.compile(r"^(\d+)([kmgt]?[bw])$")
+
+
+class ResourceValues (SessionExtension):
+
+    """Store the resource values of jobs as they are flushed."""
+
+    def before_flush (self, session, flush_context, instances):
+        """Delete the values of deleted jobs, before the jobs."""
+        deleted = [instance.key for instance in session.deleted
+                   if isinstance(instance, Job)]
+        if deleted:
+            session.execute(resource_values.delete(
+                resource_values.c.job_key.in_(deleted)))
+
+    def after_flush (self, session, flush_context):
+        """Store the values of new and changed jobs."""
+        records = []
+        for instance in session.new:
+            if isinstance(instance, Job):
+                records.append((instance.key, dict(
+                    (attribute, getattr(instance, attribute))
+                    for attribute in resource_attributes)))
+        for instance in session.dirty:
+            if isinstance(instance, Job):
+                # unloaded (deferred) attributes have not changed
+                changed = dict(
+                    (attribute, getattr(instance, attribute))
+                    for attribute in resource_attributes
+                    if get_history(instance, attribute,
+                                   passive=PASSIVE_NO_FETCH).added)
+                if changed:
+                    records.append((instance.key, changed))
+        store_resource_values(session, records)
+
+
+def configured_resources ():
+    """The names of the resources to store the values of."""
+    try:
+        names = config.get("jobs", "resources")
+    except ConfigParser.Error:
+        return default_resources
+    return [name.strip() for name in names.split(",") if name.strip()]
+
+
+def numeric_value (value):
+    """A resource value as an integer (or None, if it is not numeric).
+
+    Durations are converted to seconds, and sizes (such as 1024kb) to
+    bytes.
+    """
+    if isinstance(value, bool):
+        return None
+    elif isinstance(value, (int, long)):
+        return value
+    elif isinstance(value, float):
+        return int(round(value))
+    elif isinstance(value, timedelta):
+        return value.days * 86400 + value.seconds
+    elif isinstance(value, basestring):
+        match = size_pattern.match(value.strip().lower())
+        if match:
+            return int(match.group(1)) * size_units[match.group(2)]
+    return None
+
+
+def value_rows (records, names, column="job_key"):
+    """The resource_values rows of (job key, values) pairs.
+
+    The rows of archived_resource_values are of (job id, values)
+    pairs, with a column of job_id.
+    """
+    rows = []
+    for (key, values) in records:
+        for attribute in resource_attributes:
+            resources = values.get(attribute) or {}
+            for name in names:
+                value = numeric_value(resources.get(name))
+                if value is not None:
+                    rows.append({column:key, 'attribute':attribute,
+                                 'name':name, 'value':value})
+    return rows
+
+
+def store_resource_values (bind, records):
+
+    """Store the resource values of jobs.
+
+    The stored values of each attribute (resource_list or
+    resources_used) in a job's values are replaced; attributes not in
+    its values are left as they are.
+
+    Arguments:
+    bind -- a session, connection, or engine to write to
+    records -- (job key, values) pairs, with values as returned by
+        parse_job
+    """
+
+    if not records:
+        return
+    for attribute in resource_attributes:
+        keys = set(key for (key, values) in records if attribute in values)
+        if keys:
+            bind.execute(resource_values.delete(and_(
+                resource_values.c.job_key.in_(keys),
+                resource_values.c.attribute == attribute)))
+    rows = value_rows(records, configured_resources())
+    if rows:
+        bind.execute(resource_values.insert(), rows)
+
+
+def rebuild_resource_values (bind, batch_size=1000):
+
+    """Store the resource values of all jobs (live and archived).
+
+    Jobs are read in batches of their keys (or ids, in the archive).
+
+    Arguments:
+    bind -- a session, connection, or engine to write to
+
+    Keyword arguments:
+    batch_size -- the number of jobs to read at a time
+
+    Returns the number of values stored.
+    """
+
+    names = configured_resources()
+    count = 0
+    for (table, key, values_, column) in (
+            (jobs, jobs.c.key, resource_values, "job_key"),
+            (archived_jobs, archived_jobs.c.id, archived_resource_values,
+             "job_id")):
+        bind.execute(values_.delete())
+        last = None
+        while True:
+            query = select([key, table.c.resource_list,
+                            table.c.resources_used])
+            if last is not None:
+                query = query.where(key > last)
+            query = query.order_by(key).limit(batch_size)
+            batch = bind.execute(query).fetchall()
+            if not batch:
+                break
+            last = batch[-1][0]
+            rows = value_rows([
+                (key_, {'resource_list':resource_list,
+                        'resources_used':resources_used})
+                for (key_, resource_list, resources_used) in batch],
+                names, column)
+            if rows:
+                bind.execute(values_.insert(), rows)
+            count += len(rows)
+    return count
+
+
+def resource_summary (bind, names, projects=None, users=None,
+                      after=None, before=None, attribute="resources_used"):
+
+    """The sums of resource values of jobs (live and archived), by project.
+
+    Arguments:
+    bind -- a session, connection, or engine to query
+    names -- the resources to sum
+
+    Keyword arguments:
+    projects -- projects to sum the jobs of
+    users -- users to sum the jobs of
+    after -- sum jobs that ended after a date
+    before -- sum jobs that started before a date
+    attribute -- resources_used (default) or resource_list
+
+    Returns (project_id, name, sum) triples, in order.
+    """
+
+    if projects:
+        project_ids = listed_ids("projects",
+            (project.id for project in projects), bind)
+    if users:
+        user_ids = listed_ids("users", (user.id for user in users), bind)
+    # the values of live and archived jobs are selected alike, and
+    # summed together
+    rows = []
+    for (table, values_, valued) in (
+            (jobs, resource_values, resource_values.c.job_key == jobs.c.key),
+            (archived_jobs, archived_resource_values,
+             archived_resource_values.c.job_id == archived_jobs.c.id)):
+        clauses = [
+            valued,
+            values_.c.attribute == attribute,
+            values_.c.name.in_(names)]
+        if projects:
+            clauses.append(table.c.account_id.in_(project_ids))
+        if users:
+            clauses.append(table.c.user_id.in_(user_ids))
+        if after:
+            clauses.append(table.c.end > after)
+        if before:
+            clauses.append(table.c.start < before)
+        rows.append(select([table.c.account_id.label("project_id"),
+                            values_.c.name, values_.c.value],
+                           and_(*clauses)))
+    rows = rows[0].union_all(*rows[1:]).alias()
+    query = select([rows.c.project_id, rows.c.name,
+                    func.sum(rows.c.value)])
+    query = query.group_by(rows.c.project_id, rows.c.name)
+    query = query.order_by(rows.c.project_id, rows.c.name)
+    return [(project_id, name, int(sum_))
+            for (project_id, name, sum_) in bind.execute(query)]
@@ -0,0 +1,473 @@
+"""Daily usage rollups.
+
+The daily_usage table holds the sum of the charges and refunds of
+each day, by user, project, and resource, so that the usage of a
+range of whole days is summed from a row for each day rather than from
+each charge. (Refunds are counted on the day of the charge they
+refund, as in the summaries, and archived charges and refunds are
+counted with the rest.) DailyUsage keeps the table up to date in
+the same transaction as each change to the ledger, and to the user of
+a charged job. Each day, user, project, and resource is stored once
+(charges without a user are stored with a user_id of no_user), so
+that usage is added to its key with an upsert (see add_usage).
+
+DailyUsage -- a session extension that maintains daily usage
+moved_usage -- the usage changes of jobs changing users
+add_usage_changes -- add usage changes to the stored usage
+computed_usage -- daily usage aggregated from the ledger
+verify_usage -- compare stored daily usage with the ledger
+rebuild_usage -- recompute stored daily usage from the ledger
+"""
+
+
+from datetime import datetime, timedelta
+
+from sqlalchemy.sql import select, and_, or_, text, bindparam
+from sqlalchemy.orm.session import SessionExtension
+from sqlalchemy.orm.attributes import instance_state, get_history
+
+from cbank.model.entities import Job, Charge, Refund
+from cbank.model.database import (
+    allocations, jobs, charges, refunds, daily_usage,
+    archived_jobs, archived_charges, archived_refunds)
+
+
+__all__ = [
+    "DailyUsage", "moved_usage", "add_usage_changes",
+    "computed_usage", "verify_usage", "rebuild_usage"]
+
+
+usage_columns = ("charge_sum", "refund_sum")
+
+# the user_id of the usage of charges without a user (or job)
+no_user = ""
+
+# the charges, refunds, and jobs tables of the live ledger and of its
+# archive, with the clause joining charges to their jobs (by key, or
+# by id in the archive)
+ledgers = [
+    (charges, refunds, jobs, charges.c.job_key == jobs.c.key),
+    (archived_charges, archived_refunds, archived_jobs,
+     archived_charges.c.job_id == archived_jobs.c.id)]
+
+
+class DailyUsage (SessionExtension):
+
+    """Maintain daily usage as the ledger is flushed.
+
+    What each new, changed, or deleted charge and refund adds to (or
+    removes from) the usage of its day, user, project, and resource
+    is found before the flush, while the old values are still
+    stored, and is added to the stored usage after the flush. The
+    usage of days that entries are moved to or from is computed from
+    the ledger instead. The stored charges and refunds of a job that
+    changes users are moved from the usage of its old user to its new
+    one.
+    """
+
+    def before_flush (self, session, flush_context, instances):
+        """Find the usage changes of the objects to be flushed."""
+        changes = []
+        recompute = []
+        users = {}
+        # entries changed or deleted in the flush are found below
+        # (under the new user of their job), rather than moved
+        flushed = set()
+        for instance in session.new:
+            new = usage_entry(instance)
+            if new is not None:
+                changes.append(new)
+        for instance in session.dirty:
+            if not session.is_modified(instance):
+                continue
+            if isinstance(instance, Job):
+                user = user_change(session, instance)
+                if user is not None:
+                    users[instance.key] = user
+                continue
+            old = stored_entry(session, instance)
+            if old is not None:
+                flushed.add(entry_id(instance))
+            new = usage_entry(instance)
+            if old is None or new is None:
+                continue
+            if old[0] == new[0]:
+                changes.append((new[0], new[1], new[2] - old[2]))
+            else:
+                recompute.extend([old[0], new[0]])
+        for instance in session.deleted:
+            old = stored_entry(session, instance)
+            if old is not None:
+                flushed.add(entry_id(instance))
+                changes.append((old[0], old[1], -old[2]))
+        if users:
+            changes.extend(moved_usage(session, users, flushed))
+        flush_context.usage_changes = (changes, recompute)
+
+    def after_flush (self, session, flush_context):
+        """Apply the usage changes of the flushed objects."""
+        changes, recompute = getattr(
+            flush_context, "usage_changes", ([], []))
+        recompute = set(recompute)
+        add_usage_changes(session.connection(clause=daily_usage), [
+            change for change in changes if change[0] not in recompute])
+        if recompute:
+            session.execute(daily_usage.delete(
+                or_(*[key_clause(key) for key in recompute])))
+            insert_usage(session, computed_usage(session, recompute))
+
+
+def usage_entry (instance):
+
+    """What a ledger entry adds to the usage of its day.
+
+    Returns a (key, column, amount) triple, where key is a (day,
+    user_id, project_id, resource_id) tuple, or None for an object
+    that is not a charge or refund (or not yet charged to an
+    allocation).
+    """
+
+    if isinstance(instance, Charge):
+        charge = instance
+        column = "charge_sum"
+    elif isinstance(instance, Refund):
+        charge = instance.charge
+        column = "refund_sum"
+    else:
+        return None
+    if charge is None or charge.allocation is None:
+        return None
+    key = usage_key(
+        charge.datetime or datetime.now(),
+        charge.job and charge.job.user_id,
+        charge.allocation.project_id,
+        charge.allocation.resource_id)
+    return (key, column, instance.amount or 0)
+
+
+def user_change (session, job):
+    """The (old, new) user_id of a stored job whose user changed, or None."""
+    (added, unchanged, deleted) = get_history(job, "user_id")
+    if not added:
+        return None
+    if deleted:
+        old = deleted[0]
+    else:
+        # the old user was not loaded
+        old = session.execute(select([jobs.c.user_id],
+            jobs.c.key == job.key)).scalar()
+    (old, new) = (old or no_user, added[0] or no_user)
+    if old == new:
+        return None
+    return (old, new)
+
+
+def entry_id (instance):
+    """The (column, id) of a stored charge or refund."""
+    (id_, ) = instance_state(instance).key[1]
+    if isinstance(instance, Charge):
+        return ("charge_sum", id_)
+    return ("refund_sum", id_)
+
+
+def stored_entry (session, instance):
+
+    """What a ledger entry added to the usage of its day when stored.
+
+    Returns a (key, column, amount) triple, as in usage_entry, or None
+    for an entry that is not stored.
+    """
+
+    if not isinstance(instance, (Charge, Refund)):
+        return None
+    key = instance_state(instance).key
+    if key is None:
+        return None
+    (id_, ) = key[1]
+    if isinstance(instance, Charge):
+        (column, query) = usage_queries(charges.c.id == id_)[0]
+    else:
+        (column, query) = usage_queries(refunds.c.id == id_)[1]
+    row = session.execute(query).fetchone()
+    if row is None:
+        return None
+    (datetime_, user_id, project_id, resource_id, amount) = row
+    return (usage_key(datetime_, user_id, project_id, resource_id),
+            column, amount or 0)
+
+
+def usage_queries (whereclause=None, ledger=None):
+
+    """Queries for the usage of charges and of refunds.
+
+    Each selects the datetime of the charge, the user of its job,
+    the project and resource of its allocation, and the amount of the
+    charge (or refund).
+
+    Keyword arguments:
+    whereclause -- a clause to select the charges
+    ledger -- the tables to query, from ledgers (default the live
+        ledger)
+
+    Returns (column, query) pairs for charges and for refunds.
+    """
+
+    (charges_, refunds_, jobs_, charged) = ledger or ledgers[0]
+    joined = charges_.join(allocations,
+        charges_.c.allocation_id == allocations.c.id).outerjoin(jobs_,
+        charged)
+    key = [charges_.c.datetime, jobs_.c.user_id,
+           allocations.c.project_id, allocations.c.resource_id]
+    return [
+        ("charge_sum", select(key + [charges_.c.amount], whereclause,
+            from_obj=[joined])),
+        ("refund_sum", select(key + [refunds_.c.amount], whereclause,
+            from_obj=[joined.join(refunds_,
+                refunds_.c.charge_id == charges_.c.id)]))]
+
+
+def moved_usage (bind, users, skip=()):
+
+    """The usage changes of jobs changing users.
+
+    The usage of each stored charge and refund of the jobs is moved
+    from the old user of its job to the new one.
+
+    Arguments:
+    bind -- a session or connection to query
+    users -- the (old, new) user_id of each job, by key
+
+    Keyword arguments:
+    skip -- the (column, id) of charges and refunds not to move
+
+    Returns (key, column, amount) triples, as in usage_entry.
+    """
+
+    joined = charges.join(allocations,
+        charges.c.allocation_id == allocations.c.id)
+    columns = [charges.c.job_key, charges.c.datetime,
+               allocations.c.project_id, allocations.c.resource_id]
+    whereclause = charges.c.job_key.in_(users.keys())
+    queries = [
+        ("charge_sum", select(columns + [charges.c.id, charges.c.amount],
+            whereclause, from_obj=[joined])),
+        ("refund_sum", select(columns + [refunds.c.id, refunds.c.amount],
+            whereclause, from_obj=[joined.join(refunds,
+                refunds.c.charge_id == charges.c.id)]))]
+    changes = []
+    for (column, query) in queries:
+        for (job_key, datetime_, project_id, resource_id, id_, amount) \
+                in bind.execute(query):
+            if (column, id_) in skip or not amount:
+                continue
+            (old, new) = users[job_key]
+            changes.append((usage_key(datetime_, old, project_id,
+                                      resource_id), column, -amount))
+            changes.append((usage_key(datetime_, new, project_id,
+                                      resource_id), column, amount))
+    return changes
+
+
+def add_usage_changes (connection, changes):
+
+    """Add usage changes to the stored usage.
+
+    The changes to each key are added together, and stored with a
+    single add_usage (if they do not cancel out).
+
+    Arguments:
+    connection -- the connection to write to
+    changes -- (key, column, amount) triples, as in usage_entry
+    """
+
+    deltas = {}
+    for (key, column, amount) in changes:
+        if not amount:
+            continue
+        delta = deltas.setdefault(key, dict.fromkeys(usage_columns, 0))
+        delta[column] += amount
+    for (key, delta) in sorted(deltas.iteritems()):
+        if any(delta.itervalues()):
+            add_usage(connection, key, delta)
+
+
+def usage_key (datetime_, user_id, project_id, resource_id):
+    """The (day, user, project, resource) key of the usage of a charge."""
+    if user_id is None:
+        user_id = no_user
+    return (datetime_.date(), user_id, project_id, resource_id)
+
+
+def key_clause (key):
+    """Select the stored usage of a (day, user, project, resource) key."""
+    (day, user_id, project_id, resource_id) = key
+    return and_(
+        daily_usage.c.day == day,
+        daily_usage.c.user_id == user_id,
+        daily_usage.c.project_id == project_id,
+        daily_usage.c.resource_id == resource_id)
+
+
+def charges_clause (key, ledger=None):
+    """Select the charges of a (day, user, project, resource) key."""
+    (day, user_id, project_id, resource_id) = key
+    (charges_, refunds_, jobs_, charged) = ledger or ledgers[0]
+    start = datetime(day.year, day.month, day.day)
+    if user_id == no_user:
+        user_id = None
+    return and_(
+        charges_.c.datetime >= start,
+        charges_.c.datetime < start + timedelta(days=1),
+        jobs_.c.user_id == user_id,
+        allocations.c.project_id == project_id,
+        allocations.c.resource_id == resource_id)
+
+
+def computed_usage (bind, keys=None):
+
+    """Daily usage aggregated from the ledger (and its archive).
+
+    Arguments:
+    bind -- a session, connection, or engine to query
+
+    Keyword arguments:
+    keys -- the (day, user_id, project_id, resource_id) keys to
+        compute (default all)
+
+    Returns a dict of (charge_sum, refund_sum) by key.
+    """
+
+    usage = {}
+    for ledger in ledgers:
+        if keys is None:
+            whereclause = None
+        else:
+            whereclause = or_(*[charges_clause(key, ledger) for key in keys])
+        queries = usage_queries(whereclause, ledger)
+        for (index, (column, query)) in enumerate(queries):
+            for (datetime_, user_id, project_id, resource_id, amount) \
+                    in bind.execute(query):
+                key = usage_key(datetime_, user_id, project_id, resource_id)
+                usage.setdefault(key, [0, 0])[index] += amount or 0
+    return dict((key, tuple(sums)) for (key, sums) in usage.iteritems())
+
+
+def stored_usage (bind):
+    """Daily usage from the daily_usage table, by key."""
+    usage = {}
+    for row in bind.execute(select([
+            daily_usage.c.day, daily_usage.c.user_id,
+            daily_usage.c.project_id, daily_usage.c.resource_id,
+            daily_usage.c.charge_sum, daily_usage.c.refund_sum])):
+        sums = usage.setdefault(tuple(row[:4]), [0, 0])
+        sums[0] += row[4]
+        sums[1] += row[5]
+    return dict((key, tuple(sums)) for (key, sums) in usage.iteritems())
+
+
+def add_usage (connection, key, delta):
+
+    """Add to the stored usage of a key, inserting it if it is new.
+
+    The usage is written with a single upsert, where the database
+    supports one. Otherwise it is updated, and inserted if the update
+    finds nothing; if another transaction has inserted the key since,
+    the insert fails on the unique index of the key (rather than the
+    key being stored, and counted, twice).
+
+    Arguments:
+    connection -- the connection to write to
+    key -- a (day, user_id, project_id, resource_id) key
+    delta -- the amounts to add, by column
+    """
+
+    upsert = usage_upsert(connection.dialect)
+    (day, user_id, project_id, resource_id) = key
+    if upsert is not None:
+        connection.execute(upsert, day=day, user_id=user_id,
+            project_id=project_id, resource_id=resource_id, **delta)
+        return
+    update = daily_usage.update(key_clause(key), values=dict(
+        (column, daily_usage.c[column] + amount)
+        for (column, amount) in delta.iteritems() if amount))
+    if not connection.execute(update).rowcount:
+        insert_usage(connection, {key:(
+            delta['charge_sum'], delta['refund_sum'])})
+
+
+def usage_upsert (dialect):
+
+    """A dialect-native insert-or-add statement for daily usage.
+
+    Returns None if the dialect has no native upsert.
+    """
+
+    quote = dialect.identifier_preparer.format_column
+    table = dialect.identifier_preparer.format_table(daily_usage)
+    key = [daily_usage.c.day, daily_usage.c.user_id,
+           daily_usage.c.project_id, daily_usage.c.resource_id]
+    if dialect.name == "mysql":
+        assignment = "%(column)s = %(column)s + VALUES(%(column)s)"
+        conflict = "ON DUPLICATE KEY UPDATE"
+    elif ((dialect.name == "sqlite"
+           and dialect.dbapi.sqlite_version_info >= (3, 24))
+          or (dialect.name == "postgresql"
+              and (dialect.server_version_info or ()) >= (9, 5))):
+        assignment = ("%(column)s = %(table)s.%(column)s "
+                      "+ excluded.%(column)s")
+        conflict = "ON CONFLICT (%s) DO UPDATE SET" % ", ".join(
+            quote(column) for column in key)
+    else:
+        return None
+    columns = key + [daily_usage.c[column] for column in usage_columns]
+    statement = "INSERT INTO %s (%s) VALUES (%s) %s %s" % (
+        table,
+        ", ".join(quote(column) for column in columns),
+        ", ".join(":%s" % column.name for column in columns),
+        conflict,
+        ", ".join(assignment % {'column':quote(daily_usage.c[column]),
+                                'table':table}
+                  for column in usage_columns))
+    return text(statement, bindparams=[
+        bindparam(column.name, type_=column.type) for column in columns])
+
+
+def insert_usage (bind, usage):
+    """Insert daily usage, as returned by computed_usage."""
+    if usage:
+        bind.execute(daily_usage.insert(), [
+            {'day':day, 'user_id':user_id, 'project_id':project_id,
+             'resource_id':resource_id,
+             'charge_sum':charge_sum, 'refund_sum':refund_sum}
+            for ((day, user_id, project_id, resource_id),
+                 (charge_sum, refund_sum)) in sorted(usage.iteritems())])
+
+
+def verify_usage (bind):
+
+    """Compare stored daily usage with the ledger.
+
+    Returns a (key, stored, computed) triple for each key whose
+    stored usage differs from the usage computed from the ledger
+    (either of which may be missing, as None).
+    """
+
+    stored = stored_usage(bind)
+    computed = computed_usage(bind)
+    unused = (0, 0)
+    return [
+        (key, stored.get(key), computed.get(key))
+        for key in sorted(set(stored) | set(computed))
+        if stored.get(key, unused) != computed.get(key, unused)]
+
+
+def rebuild_usage (bind):
+    """Recompute all stored daily usage from the ledger.
+
+    Returns the number of days (by user, project, and resource)
+    stored.
+    """
+    usage = computed_usage(bind)
+    bind.execute(daily_usage.delete())
+    insert_usage(bind, usage)
+    return len(usage)
@@ -46,7 +46,7 @@ class BaseTester (object):
 
     def setup_database (self):
         cbank.model.database.metadata.bind = (
-            sqlalchemy.create_engine("sqlite:///:memory:"))
+            cbank.model.database_engine("sqlite:///:memory:"))
         cbank.model.database.metadata.create_all()
 
     def teardown_database (self):
@@ -1,33 +1,47 @@
 import sys
 import pwd
 import os
+import json
+import signal
+import gzip
+import bz2
+import shutil
+import tempfile
 from datetime import datetime, timedelta
 from StringIO import StringIO
 from textwrap import dedent
 
-from sqlalchemy import create_engine
+from sqlalchemy.exceptions import IntegrityError
+
+from cbank.model.database import (
+    allocation_balances, daily_usage, resource_values)
 
 import cbank
 from cbank.model import (
     metadata,
     User, Project, Resource,
     Allocation, Hold, Job, Charge, Refund,
-    get_projects, get_users)
+    get_projects, get_users, import_jobs, migrations, schema_version,
+    closed_before, close_period, archive_ledger, archived_before,
+    hold_keys, charge_keys, job_keys, entry_cursor)
 from cbank.cli.controllers import Session
 import cbank.upstreams.volatile
 import cbank.cli.controllers
+from cbank.cli.views import display_units
 from cbank.cli.controllers import (
     main, list_main, new_main,
     edit_main, list_users_main, list_projects_main, list_allocations_main,
     list_holds_main, list_jobs_main, list_charges_main, new_allocation_main,
     new_charge_main, new_hold_main, new_refund_main, handle_exceptions,
     detail_jobs_main, import_main, import_jobs_main, detail_charges_main,
-    detail_refunds_main)
+    detail_refunds_main, admin_migrate_main, admin_balances_main,
+    admin_close_main, admin_archive_main, admin_backfill_main)
 from cbank.cli.exceptions import (
     UnknownCommand, UnexpectedArguments,
     UnknownProject, MissingArgument, MissingResource, NotPermitted,
-    ValueError_, UnknownCharge, HasChildren)
+    ValueError_, UnknownCharge, HasChildren, UnbalancedAllocations)
 
+from mock import patch
 from nose.tools import assert_equal, assert_true, assert_false
 
 
@@ -115,7 +129,7 @@ def not_admin ():
 
 
 def setup ():
-    metadata.bind = create_engine("sqlite:///:memory:")
+    metadata.bind = cbank.model.database_engine("sqlite:///:memory:")
     current_user = current_username()
     cbank.model.use_upstream(cbank.upstreams.volatile)
     cbank.upstreams.volatile.users = [
@@ -1712,6 +1726,34 @@ class TestEditChargeMain (CbankTester):
         a = Session.query(Allocation).filter_by(id=1).one()
         assert_identical(c.allocation, a)
     
+    def close (self):
+        c = Session.query(Charge).filter_by(id=1).one()
+        c.datetime = datetime(2008, 6, 1)
+        Session.commit()
+        close_period(Session(), datetime(2008, 7, 1))
+        Session.commit()
+    
+    def test_delete_closed (self):
+        self.close()
+        args = "-D 1"
+        code, stdout, stderr = run(
+            cbank.cli.controllers.edit_charge_main, args.split())
+        Session.remove()
+        assert_equal(code, ValueError_.exit_code)
+        assert_equal(stderr.read(), "cbank: value error: closed period: "
+            "charge 1 is dated before 2008-07-01 00:00:00\n")
+        assert_equal(len(Session.query(Charge).filter_by(id=1).all()), 1)
+    
+    def test_allocation_closed (self):
+        self.close()
+        args = "1 -A 2"
+        code, stdout, stderr = run(
+            cbank.cli.controllers.edit_charge_main, args.split())
+        Session.remove()
+        assert_equal(code, ValueError_.exit_code)
+        c = Session.query(Charge).filter_by(id=1).one()
+        assert_equal(c.allocation.id, 1)
+    
     def test_non_admin (self):
         cbank.config.set("cli", "admins", "")
         args = ""
@@ -1764,6 +1806,22 @@ class TestEditRefundMain (CbankTester):
         refund = Session.query(Refund).filter_by(id=1).one()
         assert_identical(refund.comment, None)
     
+    def test_delete_closed (self):
+        refund = Session.query(Refund).filter_by(id=1).one()
+        refund.charge.datetime = datetime(2008, 6, 1)
+        refund.datetime = datetime(2008, 6, 2)
+        Session.commit()
+        close_period(Session(), datetime(2008, 7, 1))
+        Session.commit()
+        args = "-D 1"
+        code, stdout, stderr = run(
+            cbank.cli.controllers.edit_refund_main, args.split())
+        Session.remove()
+        assert_equal(code, ValueError_.exit_code)
+        assert_equal(stderr.read(), "cbank: value error: closed period: "
+            "refund 1 is dated before 2008-07-01 00:00:00\n")
+        assert_equal(len(Session.query(Refund).filter_by(id=1).all()), 1)
+    
     def test_non_admin (self):
         cbank.config.set("cli", "admins", "")
         args = ""
@@ -1777,11 +1835,344 @@ class TestImportJobs (CbankTester):
     def setup (self):
         CbankTester.setup(self)
         be_admin()
+        self.directory = tempfile.mkdtemp()
+    
+    def teardown (self):
+        shutil.rmtree(self.directory)
+        CbankTester.teardown(self)
     
-    def test_extra_arguments (self):
-        code, stdout, stderr = run(import_jobs_main, ["arg1, arg2"])
+    def write_log (self, name, entries, open_=open):
+        path = os.path.join(self.directory, name)
+        f = open_(path, "wb")
+        try:
+            for entry in entries:
+                f.write(entry + "\n")
+        finally:
+            f.close()
+        return path
+    
+    def test_missing_file (self):
+        path = os.path.join(self.directory, "missing")
+        code, stdout, stderr = run(import_jobs_main, [path])
+        assert_equal(code, ValueError_.exit_code)
         assert_equal(stderr.read(),
-            "cbank: unexpected arguments: arg1, arg2\n")
+            "cbank: value error: %s: No such file or directory\n" % path)
+    
+    def test_files (self):
+        path_1 = self.write_log("20080418", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared"])
+        path_2 = self.write_log("20080419", [
+            "04/19/2008 02:10:12;Q;2.jmayor5.lcrc.anl.gov;queue=shared"])
+        code, stdout, stderr = run(import_jobs_main, [path_1, path_2])
+        assert_equal(code, 0)
+        assert_equal([job.id for job in Session.query(Job).order_by(Job.id)],
+            ["1.jmayor5.lcrc.anl.gov", "2.jmayor5.lcrc.anl.gov"])
+    
+    def test_resource (self):
+        path = self.write_log("20080418", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared"])
+        code, stdout, stderr = run(import_jobs_main,
+            ["-r", "resource1", path])
+        assert_equal(code, 0)
+        job = Session.query(Job).one()
+        assert_equal(job.resource, Resource.fetch("resource1"))
+    
+    def test_compressed_files (self):
+        path_1 = self.write_log("20080418.gz", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared"],
+            gzip.open)
+        path_2 = self.write_log("20080419.bz2", [
+            "04/19/2008 02:10:12;Q;2.jmayor5.lcrc.anl.gov;queue=shared"],
+            bz2.BZ2File)
+        code, stdout, stderr = run(import_jobs_main, [path_1, path_2])
+        assert_equal(code, 0)
+        assert_equal([job.id for job in Session.query(Job).order_by(Job.id)],
+            ["1.jmayor5.lcrc.anl.gov", "2.jmayor5.lcrc.anl.gov"])
+    
+    def test_directory (self):
+        self.write_log("20080418", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared"])
+        self.write_log("20080419", [
+            "04/19/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=exclusive"])
+        code, stdout, stderr = run(import_jobs_main, [self.directory])
+        assert_equal(code, 0)
+        job = Session.query(Job).one()
+        assert_equal(job.queue, "exclusive")
+    
+    def test_glob (self):
+        self.write_log("20080418", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared"])
+        self.write_log("other", [
+            "04/19/2008 02:10:12;Q;2.jmayor5.lcrc.anl.gov;queue=shared"])
+        code, stdout, stderr = run(import_jobs_main,
+            [os.path.join(self.directory, "2008*")])
+        assert_equal(code, 0)
+        job = Session.query(Job).one()
+        assert_equal(job.id, "1.jmayor5.lcrc.anl.gov")
+    
+    def test_resume (self):
+        path = self.write_log("20080418", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared"])
+        code, stdout, stderr = run(import_jobs_main, [path])
+        Session.query(Job).one().queue = "changed"
+        Session.commit()
+        f = open(path, "a")
+        f.write("04/18/2008 02:10:13;Q;2.jmayor5.lcrc.anl.gov;queue=shared\n")
+        f.close()
+        code, stdout, stderr = run(import_jobs_main, ["-v", path])
+        assert_equal(code, 0)
+        assert_equal(stderr.read(), "2.jmayor5.lcrc.anl.gov\n")
+        job = Session.query(Job).filter_by(id="1.jmayor5.lcrc.anl.gov").one()
+        assert_equal(job.queue, "changed")
+    
+    def test_no_resume (self):
+        path = self.write_log("20080418", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared"])
+        code, stdout, stderr = run(import_jobs_main, [path])
+        Session.query(Job).one().queue = "changed"
+        Session.commit()
+        code, stdout, stderr = run(import_jobs_main, ["--no-resume", path])
+        assert_equal(code, 0)
+        Session.expire_all()
+        assert_equal(Session.query(Job).one().queue, "shared")
+    
+    def test_resume_replaced (self):
+        path = self.write_log("20080418", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared"])
+        code, stdout, stderr = run(import_jobs_main, [path])
+        os.unlink(path)
+        self.write_log("20080418", [
+            "04/18/2008 02:10:12;Q;2.jmayor5.lcrc.anl.gov;queue=shared"])
+        code, stdout, stderr = run(import_jobs_main, [path])
+        assert_equal(code, 0)
+        assert_equal(Session.query(Job).count(), 2)
+    
+    def test_workers (self):
+        path = self.write_log("20080418", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared",
+            "some invalid data",
+            "04/18/2008 02:10:13;Q;2.jmayor5.lcrc.anl.gov;queue=shared",
+            "04/18/2008 02:10:14;Q;1.jmayor5.lcrc.anl.gov;queue=exclusive"])
+        code, stdout, stderr = run(import_jobs_main,
+            ["-w", "2", "--chunk-size", "1", path])
+        assert_equal(code, 0)
+        assert_equal(stderr.read(),
+            "Invalid job record: some invalid data\n")
+        jobs = Session.query(Job).order_by(Job.id)
+        assert_equal([(job.id, job.queue) for job in jobs], [
+            ("1.jmayor5.lcrc.anl.gov", "exclusive"),
+            ("2.jmayor5.lcrc.anl.gov", "shared")])
+    
+    def test_invalid_workers (self):
+        code, stdout, stderr = run(import_jobs_main, ["-w", "-1"])
+        assert_equal(code, ValueError_.exit_code)
+    
+    def test_invalid_chunk_size (self):
+        code, stdout, stderr = run(import_jobs_main, ["--chunk-size", "0"])
+        assert_equal(code, ValueError_.exit_code)
+    
+    def test_follow (self):
+        path_1 = self.write_log("20080418", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared"])
+        written = []
+        def sleep (seconds):
+            if not written:
+                f = open(path_1, "a")
+                f.write("04/18/2008 02:10:13;Q;2.jmayor5.lcrc.anl.gov;"
+                    "queue=shared\n")
+                f.close()
+                self.write_log("20080419", [
+                    "04/19/2008 02:10:12;Q;3.jmayor5.lcrc.anl.gov;"
+                    "queue=shared"])
+                written.append(True)
+            else:
+                os.kill(os.getpid(), signal.SIGTERM)
+        handler = signal.getsignal(signal.SIGTERM)
+        sleep_patch = patch("time.sleep", sleep)
+        sleep_patch.start()
+        try:
+            code, stdout, stderr = run(import_jobs_main,
+                ["-f", "-i", "0.1", self.directory])
+        finally:
+            sleep_patch.stop()
+        assert_equal(code, 0)
+        assert_equal(signal.getsignal(signal.SIGTERM), handler)
+        assert_equal([job.id for job in Session.query(Job).order_by(Job.id)],
+            ["1.jmayor5.lcrc.anl.gov", "2.jmayor5.lcrc.anl.gov",
+             "3.jmayor5.lcrc.anl.gov"])
+        code, stdout, stderr = run(import_jobs_main, ["-v", self.directory])
+        assert_equal(stderr.read(), "")
+    
+    def test_follow_stdin (self):
+        code, stdout, stderr = run(import_jobs_main, ["-f"])
+        assert_equal(code, ValueError_.exit_code)
+    
+    def test_invalid_interval (self):
+        code, stdout, stderr = run(import_jobs_main, ["-i", "0"])
+        assert_equal(code, ValueError_.exit_code)
+    
+    def failing_import (self, failing):
+        def import_jobs_ (records, *args):
+            for (id_, values) in records:
+                if id_ in failing:
+                    raise IntegrityError("INSERT", [], Exception("failed"))
+            return import_jobs(records, *args)
+        return patch("cbank.cli.controllers.import_jobs", import_jobs_)
+    
+    def test_quarantine (self):
+        path = self.write_log("20080418", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared",
+            "some invalid data",
+            "04/18/2008 02:10:13;Q;2.jmayor5.lcrc.anl.gov;queue=shared",
+            "04/18/2008 02:10:14;Q;3.jmayor5.lcrc.anl.gov;queue=shared",
+            "04/18/2008 02:10:15;S;2.jmayor5.lcrc.anl.gov;queue=shared"])
+        quarantine = os.path.join(self.directory, "quarantine")
+        import_patch = self.failing_import(["2.jmayor5.lcrc.anl.gov"])
+        import_patch.start()
+        try:
+            code, stdout, stderr = run(import_jobs_main,
+                ["-q", quarantine, path])
+        finally:
+            import_patch.stop()
+        assert_equal(code, 0)
+        assert_equal(stderr.read(), "".join([
+            "Invalid job record: some invalid data\n",
+            "2.jmayor5.lcrc.anl.gov: failed\n",
+            "2.jmayor5.lcrc.anl.gov: failed\n"]))
+        assert_equal(open(quarantine).read(), "".join([
+            "# Invalid job record: some invalid data\n",
+            "some invalid data\n",
+            "# 2.jmayor5.lcrc.anl.gov: failed\n",
+            "04/18/2008 02:10:13;Q;2.jmayor5.lcrc.anl.gov;queue=shared\n",
+            "# 2.jmayor5.lcrc.anl.gov: failed\n",
+            "04/18/2008 02:10:15;S;2.jmayor5.lcrc.anl.gov;queue=shared\n"]))
+        assert_equal([job.id for job in Session.query(Job).order_by(Job.id)],
+            ["1.jmayor5.lcrc.anl.gov", "3.jmayor5.lcrc.anl.gov"])
+        code, stdout, stderr = run(import_jobs_main, ["-v", path])
+        assert_equal(stderr.read(), "")
+        code, stdout, stderr = run(import_jobs_main, ["-v", quarantine])
+        assert_equal(stderr.read(), "".join([
+            "Invalid job record: some invalid data\n",
+            "2.jmayor5.lcrc.anl.gov\n",
+            "2.jmayor5.lcrc.anl.gov\n"]))
+    
+    def test_batch_failure (self):
+        path = self.write_log("20080418", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared",
+            "04/18/2008 02:10:13;Q;2.jmayor5.lcrc.anl.gov;queue=shared"])
+        import_patch = self.failing_import(
+            ["1.jmayor5.lcrc.anl.gov", "2.jmayor5.lcrc.anl.gov"])
+        import_patch.start()
+        try:
+            code, stdout, stderr = run(import_jobs_main, [path])
+        finally:
+            import_patch.stop()
+        assert_equal(code, ValueError_.exit_code)
+        assert_equal(stderr.read(), "cbank: value error: failed\n")
+        assert_equal(Session.query(Job).count(), 0)
+    
+    def test_bisected_checkpoints (self):
+        path = self.write_log("20080418", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared",
+            "04/18/2008 02:10:13;Q;2.jmayor5.lcrc.anl.gov;queue=shared"])
+        def save_checkpoints (offsets):
+            raise RuntimeError("interrupted")
+        import_patch = self.failing_import(["2.jmayor5.lcrc.anl.gov"])
+        checkpoints_patch = patch("cbank.cli.controllers.save_checkpoints",
+            save_checkpoints)
+        import_patch.start()
+        checkpoints_patch.start()
+        try:
+            try:
+                run(import_jobs_main, [path])
+            except RuntimeError:
+                pass
+            else:
+                assert False, "the interruption was not raised"
+        finally:
+            checkpoints_patch.stop()
+            import_patch.stop()
+        # the job isolated from the failure is not committed without
+        # its checkpoint
+        Session.rollback()
+        assert_equal(Session.query(Job).count(), 0)
+    
+    def test_batch_size (self):
+        path = self.write_log("20080418", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared",
+            "04/18/2008 02:10:13;Q;2.jmayor5.lcrc.anl.gov;queue=shared"])
+        commit_jobs = cbank.cli.controllers.commit_jobs
+        batches = []
+        def commit_jobs_ (batch, *args):
+            batches.append(len(batch))
+            return commit_jobs(batch, *args)
+        commit_patch = patch("cbank.cli.controllers.commit_jobs",
+            commit_jobs_)
+        commit_patch.start()
+        try:
+            code, stdout, stderr = run(import_jobs_main, ["-b", "1", path])
+        finally:
+            commit_patch.stop()
+        assert_equal(code, 0)
+        assert_equal(batches, [1, 1, 0])
+    
+    def test_session_released (self):
+        path = self.write_log("20080418", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared"])
+        code, stdout, stderr = run(import_jobs_main, [path])
+        job = Session.query(Job).one()
+        f = open(path, "a")
+        f.write("04/18/2008 02:10:13;Q;2.jmayor5.lcrc.anl.gov;queue=shared\n")
+        f.close()
+        code, stdout, stderr = run(import_jobs_main, [path])
+        assert_equal(code, 0)
+        assert job not in Session
+        assert Session().expire_on_commit
+
+    def test_stats_file (self):
+        path = self.write_log("20080418", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared",
+            "some invalid data",
+            "04/18/2008 02:10:13;Q;2.jmayor5.lcrc.anl.gov;queue=shared",
+            "04/18/2008 02:10:14;Q;1.jmayor5.lcrc.anl.gov;queue=debug"])
+        stats = os.path.join(self.directory, "stats")
+        code, stdout, stderr = run(import_jobs_main,
+            ["--stats-file", stats, path])
+        assert_equal(code, 0)
+        report = json.loads(open(stats).readlines()[-1])
+        assert_equal(report['records'], 4)
+        assert_equal(report['rejected'], 1)
+        assert_equal(report['inserted'], 2)
+        assert_equal(report['updated'], 0)
+        assert_equal(report['commits'], 1)
+        assert report['final']
+    
+    def test_stats (self):
+        path = self.write_log("20080418", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared"])
+        code, stdout, stderr = run(import_jobs_main, ["-s", "60", path])
+        assert_equal(code, 0)
+        assert "1 records" in stderr.read()
+    
+    def test_invalid_stats (self):
+        code, stdout, stderr = run(import_jobs_main, ["-s", "0"])
+        assert_equal(code, ValueError_.exit_code)
+    
+    def test_invalid_batch_size (self):
+        code, stdout, stderr = run(import_jobs_main, ["-b", "0"])
+        assert_equal(code, ValueError_.exit_code)
+    
+    def test_merge (self):
+        path_1 = self.write_log("server1", [
+            "04/18/2008 02:10:12;Q;1.jmayor5.lcrc.anl.gov;queue=shared",
+            "04/18/2008 02:10:14;Q;1.jmayor5.lcrc.anl.gov;queue=debug"])
+        path_2 = self.write_log("server2", [
+            "04/18/2008 02:10:13;Q;1.jmayor5.lcrc.anl.gov;queue=exclusive",
+            "04/18/2008 02:10:15;Q;1.jmayor5.lcrc.anl.gov;queue=long"])
+        code, stdout, stderr = run(import_jobs_main, [path_2, path_1])
+        assert_equal(code, 0)
+        job = Session.query(Job).one()
+        assert_equal(job.queue, "long")
     
     def test_empty (self):
         stdin = StringIO()
@@ -1987,6 +2378,202 @@ class TestImportJobs (CbankTester):
         assert_identical(job_.account, Project.fetch("project2"))
 
 
+class TestAdminMigrate (CbankTester):
+
+    def setup (self):
+        CbankTester.setup(self)
+        be_admin()
+
+    def test_migrate (self):
+        code, stdout, stderr = run(admin_migrate_main)
+        assert_equal(code, 0)
+        assert_equal(stdout.read(), "".join(
+            "%i %s\n" % (version, migration.__doc__)
+            for (version, migration) in enumerate(migrations, 1)))
+        assert_equal(schema_version(), len(migrations))
+        code, stdout, stderr = run(admin_migrate_main)
+        assert_equal(code, 0)
+        assert_equal(stdout.read(), "")
+
+    def test_dry_run (self):
+        code, stdout, stderr = run(admin_migrate_main, ["-n"])
+        assert_equal(code, 0)
+        assert_equal(len(stdout.read().splitlines()), len(migrations))
+        assert_equal(schema_version(), 0)
+
+    def test_to_version (self):
+        code, stdout, stderr = run(admin_migrate_main, ["-t", "1"])
+        assert_equal(code, 0)
+        assert_equal(schema_version(), 1)
+
+    def test_invalid_version (self):
+        code, stdout, stderr = run(admin_migrate_main,
+            ["-t", str(len(migrations) + 1)])
+        assert_equal(code, ValueError_.exit_code)
+
+    def test_non_admin (self):
+        not_admin()
+        code, stdout, stderr = run(admin_migrate_main)
+        assert_equal(code, NotPermitted.exit_code)
+
+
+class TestAdminBalances (CbankTester):
+
+    def setup (self):
+        CbankTester.setup(self)
+        be_admin()
+        allocation = Allocation(Project.fetch("project1"),
+            Resource.fetch("resource1"), 100,
+            datetime(2000, 1, 1), datetime(2001, 1, 1))
+        Session.add_all([allocation, Charge(allocation, 10)])
+        Session.commit()
+        self.allocation_id = allocation.id
+
+    def test_balanced (self):
+        code, stdout, stderr = run(admin_balances_main)
+        assert_equal(code, 0)
+        assert_equal(stdout.read(), "")
+
+    def test_unbalanced (self):
+        Session.execute(allocation_balances.update(values={'charged':0}))
+        Session.commit()
+        code, stdout, stderr = run(admin_balances_main)
+        assert_equal(code, UnbalancedAllocations.exit_code)
+        assert_equal(stdout.read(), "%i 0/0/0 10/0/0\n" % self.allocation_id)
+
+    def test_unbalanced_usage (self):
+        Session.execute(daily_usage.update(values={'charge_sum':4}))
+        Session.commit()
+        code, stdout, stderr = run(admin_balances_main)
+        assert_equal(code, UnbalancedAllocations.exit_code)
+        assert_equal(stdout.read(), "%s - %s %s 4/0 10/0\n" % (
+            datetime.now().date(), Project.fetch("project1").id,
+            Resource.fetch("resource1").id))
+
+    def test_rebuild (self):
+        Session.execute(daily_usage.delete())
+        Session.execute(allocation_balances.delete())
+        Session.commit()
+        code, stdout, stderr = run(admin_balances_main, ["-r"])
+        assert_equal(code, 0)
+        assert_equal(stdout.read(),
+            "%i missing 10/0/0\n%s - %s %s missing 10/0\n" % (
+                self.allocation_id, datetime.now().date(),
+                Project.fetch("project1").id,
+                Resource.fetch("resource1").id))
+        code, stdout, stderr = run(admin_balances_main)
+        assert_equal(code, 0)
+
+    def test_non_admin (self):
+        not_admin()
+        code, stdout, stderr = run(admin_balances_main)
+        assert_equal(code, NotPermitted.exit_code)
+
+
+class TestAdminClose (CbankTester):
+
+    def setup (self):
+        CbankTester.setup(self)
+        be_admin()
+        allocation = Allocation(Project.fetch("project1"),
+            Resource.fetch("resource1"), 100,
+            datetime(2000, 1, 1), datetime(2001, 1, 1))
+        charge = Charge(allocation, 10)
+        charge.datetime = datetime(2000, 1, 1)
+        Session.add_all([allocation, charge])
+        Session.commit()
+
+    def test_close (self):
+        code, stdout, stderr = run(admin_close_main, ["-b", "2000-02-01"])
+        assert_equal(code, 0)
+        assert_equal(stdout.read(),
+                     "closed before 2000-02-01 00:00:00 (1 allocations)\n")
+        assert_equal(closed_before(Session()), datetime(2000, 2, 1))
+
+    def test_already_closed (self):
+        run(admin_close_main, ["-b", "2000-02-01"])
+        code, stdout, stderr = run(admin_close_main, ["-b", "2000-01-15"])
+        assert_equal(code, ValueError_.exit_code)
+
+    def test_missing_date (self):
+        code, stdout, stderr = run(admin_close_main)
+        assert_equal(code, MissingArgument.exit_code)
+
+    def test_non_admin (self):
+        not_admin()
+        code, stdout, stderr = run(admin_close_main, ["-b", "2000-02-01"])
+        assert_equal(code, NotPermitted.exit_code)
+
+
+class TestAdminArchive (CbankTester):
+
+    def setup (self):
+        CbankTester.setup(self)
+        be_admin()
+        allocation = Allocation(Project.fetch("project1"),
+            Resource.fetch("resource1"), 100,
+            datetime(2000, 1, 1), datetime(2000, 6, 1))
+        job = Job("resource1.1")
+        job.end = datetime(2000, 1, 1)
+        charge = Charge(allocation, 10)
+        charge.datetime = datetime(2000, 1, 1)
+        charge.job = job
+        Session.add_all([allocation, charge])
+        Session.commit()
+        close_period(Session(), datetime(2000, 7, 1))
+        Session.commit()
+
+    def test_archive (self):
+        code, stdout, stderr = run(admin_archive_main, ["-b", "2000-07-01"])
+        assert_equal(code, 0)
+        assert_equal(stdout.read(), "archived before 2000-07-01 00:00:00 "
+                     "(1 jobs, 0 holds, 1 charges, 0 refunds)\n")
+        assert_equal(archived_before(Session()), datetime(2000, 7, 1))
+        assert_equal(Session.query(Job).count(), 0)
+
+    def test_not_closed (self):
+        code, stdout, stderr = run(admin_archive_main, ["-b", "2000-08-01"])
+        assert_equal(code, ValueError_.exit_code)
+
+    def test_missing_date (self):
+        code, stdout, stderr = run(admin_archive_main)
+        assert_equal(code, MissingArgument.exit_code)
+
+    def test_non_admin (self):
+        not_admin()
+        code, stdout, stderr = run(admin_archive_main, ["-b", "2000-07-01"])
+        assert_equal(code, NotPermitted.exit_code)
+
+
+class TestAdminBackfill (CbankTester):
+
+    def setup (self):
+        CbankTester.setup(self)
+        be_admin()
+        import_jobs([("resource1.%i" % index, {
+            'resources_used':{'ncpus':index, 'walltime':timedelta(hours=1)}})
+            for index in range(3)])
+        Session.commit()
+        Session().execute(resource_values.delete())
+        Session.commit()
+
+    def test_backfill (self):
+        code, stdout, stderr = run(admin_backfill_main, ["-b", "2"])
+        assert_equal(code, 0)
+        assert_equal(stdout.read(), "6 resource values stored\n")
+        assert_equal(
+            Session().execute(resource_values.count()).scalar(), 6)
+
+    def test_batch_size (self):
+        code, stdout, stderr = run(admin_backfill_main, ["-b", "0"])
+        assert_equal(code, ValueError_.exit_code)
+
+    def test_non_admin (self):
+        not_admin()
+        code, stdout, stderr = run(admin_backfill_main)
+        assert_equal(code, NotPermitted.exit_code)
+
+
 class TestListMain (CbankTester):
     
     def setup (self):
@@ -2754,7 +3341,43 @@ class TestHoldsList (CbankTester):
         assert_equal(code, 0)
         args, kwargs = cbank.cli.controllers.print_holds_list.calls[0]
         assert_false(kwargs['truncate'])
-
+    
+    def test_batch_size (self):
+        code, stdout, stderr = run(list_holds_main, ["--batch-size", "2"])
+        assert_equal(code, 0)
+        args, kwargs = cbank.cli.controllers.print_holds_list.calls[0]
+        assert_equal(args[0]._yield_per, 2)
+    
+    def test_invalid_batch_size (self):
+        code, stdout, stderr = run(list_holds_main, ["--batch-size", "0"])
+        assert_equal(code, ValueError_.exit_code)
+        assert not cbank.cli.controllers.print_holds_list.calls
+    
+    def test_limit (self):
+        code, stdout, stderr = run(list_holds_main, ["--limit", "2"])
+        assert_equal(code, 0)
+        args, kwargs = cbank.cli.controllers.print_holds_list.calls[0]
+        assert_equal(kwargs['limit'], 2)
+        assert len(list(args[0])) <= 2
+    
+    def test_after_cursor (self):
+        run(list_holds_main)
+        args, kwargs = cbank.cli.controllers.print_holds_list.calls[0]
+        entries = list(args[0])
+        cursor = entry_cursor(hold_keys, entries[0])
+        code, stdout, stderr = run(list_holds_main, ["--after-cursor", cursor])
+        assert_equal(code, 0)
+        args, kwargs = cbank.cli.controllers.print_holds_list.calls[1]
+        assert_equal(list(args[0]), entries[1:])
+    
+    def test_invalid_cursor (self):
+        code, stdout, stderr = run(list_holds_main, ["--after-cursor", "cursor"])
+        assert_equal(code, ValueError_.exit_code)
+        assert not cbank.cli.controllers.print_holds_list.calls
+    
+    def test_invalid_limit (self):
+        code, stdout, stderr = run(list_holds_main, ["--limit", "0"])
+        assert_equal(code, ValueError_.exit_code)
 
 class TestHoldsList_Admin (TestHoldsList):
     
@@ -2762,6 +3385,24 @@ class TestHoldsList_Admin (TestHoldsList):
         TestHoldsList.setup(self)
         be_admin()
     
+    def test_batch_size_output (self):
+        cbank.cli.controllers.print_holds_list = self._print_holds_list
+        holds = Session.query(Hold).filter_by(active=True).all()
+        for (index, hold) in enumerate(holds):
+            hold.amount = index + 1
+        Session.flush()
+        outputs = []
+        for batch_size in ["2", "1000"]:
+            code, stdout, stderr = run(list_holds_main,
+                ["--batch-size", batch_size])
+            assert_equal(code, 0)
+            outputs.append((stdout.read(), stderr.read()))
+        assert_equal(outputs[0], outputs[1])
+        stdout, stderr = outputs[0]
+        assert_equal(len(stdout.splitlines()), len(holds))
+        total = sum(hold.amount for hold in holds)
+        assert display_units(total) in stderr, stderr
+    
     def test_self_users (self):
         user = current_user()
         holds = Session.query(Hold).filter_by(active=True).filter(
@@ -2865,12 +3506,14 @@ class TestJobsList (CbankTester):
         j1.end = datetime(2000, 1, 2)
         j1.account = Project.fetch("project2")
         j1.ctime = datetime(2000, 1, 1)
+        j1.exec_host = "node1/0+node1/1+node2/0"
         j1.charges = [Charge(p2r1, 0)]
         j2 = Job("resource1.2")
         j2.user = current_user_
         j2.start = datetime(2000, 1, 30)
         j2.end = datetime(2000, 2, 2)
         j2.ctime = datetime(2000, 1, 2)
+        j2.exec_host = "node2/0"
         j2.account = Project.fetch("project2")
         j2.charges = [Charge(p2r1, 0)]
         j3 = Job("resource1.3")
@@ -3046,13 +3689,51 @@ class TestJobsList (CbankTester):
         args, kwargs = cbank.cli.controllers.print_jobs_list.calls[0]
         assert_equal(set(args[0]), set(jobs))
     
+    def test_nodes (self):
+        code, stdout, stderr = run(list_jobs_main, "-n node1".split())
+        assert_equal(code, 0)
+        jobs = Session.query(Job).filter(Job.id.in_(["resource1.1"]))
+        args, kwargs = cbank.cli.controllers.print_jobs_list.calls[0]
+        assert_equal(set(args[0]), set(jobs))
+        code, stdout, stderr = run(list_jobs_main,
+            "-n node1 -n node2".split())
+        jobs = Session.query(Job).filter(Job.id.in_([
+            "resource1.1", "resource1.2"]))
+        args, kwargs = cbank.cli.controllers.print_jobs_list.calls[1]
+        assert_equal(set(args[0]), set(jobs))
+    
     def test_long (self):
         code, stdout, stderr = run(
             list_jobs_main, ["-l"])
         assert_equal(code, 0)
         args, kwargs = cbank.cli.controllers.print_jobs_list.calls[0]
         assert_false(kwargs['truncate'])
-
+    
+    def test_limit (self):
+        code, stdout, stderr = run(list_jobs_main, ["--limit", "2"])
+        assert_equal(code, 0)
+        args, kwargs = cbank.cli.controllers.print_jobs_list.calls[0]
+        assert_equal(kwargs['limit'], 2)
+        assert len(list(args[0])) <= 2
+    
+    def test_after_cursor (self):
+        run(list_jobs_main)
+        args, kwargs = cbank.cli.controllers.print_jobs_list.calls[0]
+        entries = list(args[0])
+        cursor = entry_cursor(job_keys, entries[0])
+        code, stdout, stderr = run(list_jobs_main, ["--after-cursor", cursor])
+        assert_equal(code, 0)
+        args, kwargs = cbank.cli.controllers.print_jobs_list.calls[1]
+        assert_equal(list(args[0]), entries[1:])
+    
+    def test_invalid_cursor (self):
+        code, stdout, stderr = run(list_jobs_main, ["--after-cursor", "cursor"])
+        assert_equal(code, ValueError_.exit_code)
+        assert not cbank.cli.controllers.print_jobs_list.calls
+    
+    def test_invalid_limit (self):
+        code, stdout, stderr = run(list_jobs_main, ["--limit", "0"])
+        assert_equal(code, ValueError_.exit_code)
 
 class TestJobsList_Admin (TestJobsList):
     
@@ -3060,6 +3741,17 @@ class TestJobsList_Admin (TestJobsList):
         TestJobsList.setup(self)
         be_admin()
 
+    def test_uncharged_resource (self):
+        job = Session.query(Job).filter_by(id="resource1.6").one()
+        job.resource = Resource.fetch("resource2")
+        Session.flush()
+        code, stdout, stderr = run(list_jobs_main, "-r resource2".split())
+        assert_equal(code, 0)
+        jobs = Session.query(Job).filter(Job.id.in_([
+            "resource1.6", "resource2.1"]))
+        args, kwargs = cbank.cli.controllers.print_jobs_list.calls[0]
+        assert_equal(set(args[0]), set(jobs))
+
     def test_default (self):
         code, stdout, stderr = run(list_jobs_main)
         assert_equal(code, 0)
@@ -3306,7 +3998,43 @@ class TestChargesList (CbankTester):
         assert_equal(code, 0)
         args, kwargs = cbank.cli.controllers.print_charges_list.calls[0]
         assert_false(kwargs['truncate'])
-
+    
+    def test_batch_size (self):
+        code, stdout, stderr = run(list_charges_main, ["--batch-size", "2"])
+        assert_equal(code, 0)
+        args, kwargs = cbank.cli.controllers.print_charges_list.calls[0]
+        assert_equal(args[0]._yield_per, 2)
+    
+    def test_invalid_batch_size (self):
+        code, stdout, stderr = run(list_charges_main, ["--batch-size", "0"])
+        assert_equal(code, ValueError_.exit_code)
+        assert not cbank.cli.controllers.print_charges_list.calls
+    
+    def test_limit (self):
+        code, stdout, stderr = run(list_charges_main, ["--limit", "2"])
+        assert_equal(code, 0)
+        args, kwargs = cbank.cli.controllers.print_charges_list.calls[0]
+        assert_equal(kwargs['limit'], 2)
+        assert len(list(args[0])) <= 2
+    
+    def test_after_cursor (self):
+        run(list_charges_main)
+        args, kwargs = cbank.cli.controllers.print_charges_list.calls[0]
+        entries = list(args[0])
+        cursor = entry_cursor(charge_keys, entries[0])
+        code, stdout, stderr = run(list_charges_main, ["--after-cursor", cursor])
+        assert_equal(code, 0)
+        args, kwargs = cbank.cli.controllers.print_charges_list.calls[1]
+        assert_equal(list(args[0]), entries[1:])
+    
+    def test_invalid_cursor (self):
+        code, stdout, stderr = run(list_charges_main, ["--after-cursor", "cursor"])
+        assert_equal(code, ValueError_.exit_code)
+        assert not cbank.cli.controllers.print_charges_list.calls
+    
+    def test_invalid_limit (self):
+        code, stdout, stderr = run(list_charges_main, ["--limit", "0"])
+        assert_equal(code, ValueError_.exit_code)
 
 class TestChargesList_Admin (TestChargesList):
     
@@ -3315,6 +4043,24 @@ class TestChargesList_Admin (TestChargesList):
         Charge.__repr__ = lambda self: str(self.id)
         be_admin()
     
+    def test_batch_size_output (self):
+        cbank.cli.controllers.print_charges_list = self._print_charges_list
+        charges = Session.query(Charge).all()
+        for (index, charge) in enumerate(charges):
+            charge.amount = index + 1
+        Session.flush()
+        outputs = []
+        for batch_size in ["2", "1000"]:
+            code, stdout, stderr = run(list_charges_main,
+                ["--batch-size", batch_size])
+            assert_equal(code, 0)
+            outputs.append((stdout.read(), stderr.read()))
+        assert_equal(outputs[0], outputs[1])
+        stdout, stderr = outputs[0]
+        assert_equal(len(stdout.splitlines()), len(charges))
+        total = sum(charge.amount for charge in charges)
+        assert display_units(total) in stderr, stderr
+    
     def test_self_users (self):
         charges = Session.query(Charge).filter(Charge.id.in_([
             20, 4, 11, 27, 24, 15, 8, 31, 3, 12, 19, 16, 23, 32, 28, 7]))
@@ -3414,4 +4160,21 @@ class TestDetailJobs (CbankTester):
         jobs = Session.query(Job).filter(Job.id.in_(["resource1.1"]))
         args, kwargs = cbank.cli.controllers.print_jobs.calls[0]
         assert_equal(set(args[0]), set(jobs))
+
+    def test_archived_jobs (self):
+        job = Job("resource1.2")
+        job.end = datetime(2000, 1, 1)
+        Session.add(job)
+        Session.commit()
+        close_period(Session(), datetime(2000, 2, 1))
+        archive_ledger(Session(), datetime(2000, 2, 1))
+        Session.commit()
+        Session.expunge_all()
+        assert_equal([job.id for job in Session.query(Job)], ["resource1.1"])
+        code, stdout, stderr = run(
+            detail_jobs_main, "resource1.1 resource1.2".split())
+        assert_equal(code, 0)
+        args, kwargs = cbank.cli.controllers.print_jobs.calls[0]
+        assert_equal(sorted(job.id for job in args[0]),
+                     ["resource1.1", "resource1.2"])
  
@@ -6,8 +6,6 @@ from datetime import datetime, timedelta
 from StringIO import StringIO
 from textwrap import dedent
 
-from sqlalchemy import create_engine
-
 import cbank
 import cbank.model
 from cbank.model import (
@@ -21,6 +19,7 @@ from cbank.cli.views import (
     print_users_list, print_projects_list, print_allocations_list,
     print_holds_list, print_jobs_list, print_charges_list,
     print_charges, print_jobs, print_refunds, print_holds, display_units)
+from cbank.model.pages import charge_keys, entry_cursor
 
 
 class FakeDateTime (object):
@@ -36,7 +35,8 @@ class FakeDateTime (object):
 
 
 def setup ():
-    cbank.model.database.metadata.bind = create_engine("sqlite:///:memory:")
+    cbank.model.database.metadata.bind = (
+        cbank.model.database_engine("sqlite:///:memory:"))
     cbank.model.use_upstream(cbank.upstreams.volatile)
     cbank.upstreams.volatile.projects = [
         cbank.upstreams.volatile.Project("1", "project1"),
@@ -280,6 +280,24 @@ class TestChargesList (CbankViewTester):
             Units are undefined.
             """))
 
+    def test_next_cursor (self):
+        start = datetime(2000, 1, 1)
+        end = start + timedelta(weeks=1)
+        a1 = Allocation(Project.fetch("project1"), Resource.fetch("res1"),
+            10, start, end)
+        c1 = Charge(a1, 1)
+        c2 = Charge(a1, 2)
+        Session.add(a1)
+        Session.flush()
+        stdout, stderr = capture(lambda:
+            print_charges_list([c1, c2], limit=2))
+        assert_equal(stderr.getvalue().splitlines()[-1],
+            "next cursor: %s" % entry_cursor(charge_keys, c2))
+        stdout, stderr = capture(lambda:
+            print_charges_list([c1, c2], limit=3))
+        assert_equal(stderr.getvalue().splitlines()[-1],
+            "Units are undefined.")
+    
     def test_upstream_ids (self):
         start = datetime(2000, 1, 1)
         end = start + timedelta(weeks=1)
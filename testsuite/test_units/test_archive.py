@@ -0,0 +1,157 @@
+from nose.tools import raises, assert_equal
+
+from testsuite import BaseTester
+
+from datetime import datetime
+
+from cbank.model.entities import (
+    User, Project, Resource, Allocation, Hold, Job, Charge, Refund)
+from cbank.model.database import (
+    metadata, jobs, holds, charges, refunds,
+    archived_jobs, archived_holds, archived_charges, archived_refunds)
+from cbank.model.queries import (
+    Session, get_users, user_summary, project_summary, allocation_summary)
+from cbank.model.balances import verify_balances
+from cbank.model.usage import verify_usage
+from cbank.model.periods import close_period, balances_as_of
+from cbank.model.archive import (
+    archive_ledger, archived_before, archived_jobs_by_id)
+
+
+def dated (entry, datetime_):
+    entry.datetime = datetime_
+    return entry
+
+
+def ids (table):
+    return sorted(row.id for row in metadata.bind.execute(table.select()))
+
+
+class TestArchive (BaseTester):
+
+    def setup (self):
+        self.setup_database()
+        self.project = Project.cached("project")
+        self.resource = Resource.cached("resource")
+        self.user = User.cached("user")
+        self.ended = Allocation(self.project, self.resource, 100,
+            datetime(2000, 1, 1), datetime(2001, 1, 1))
+        self.current = Allocation(self.project, self.resource, 100,
+            datetime(2000, 1, 1), datetime(2100, 1, 1))
+        self.old_job = self.job("1.old", datetime(2000, 1, 2, 12))
+        charge = dated(Charge(self.ended, 10), datetime(2000, 1, 2, 12))
+        self.old_job.charges = [charge]
+        dated(Refund(charge, 4), datetime(2000, 1, 3))
+        hold = dated(Hold(self.ended, 10), datetime(2000, 1, 2))
+        hold.active = False
+        self.old_job.holds = [hold]
+        dated(Charge(self.ended, 5), datetime(2000, 2, 1))
+        # charged against an allocation that has not ended
+        self.current_job = self.job("2.current", datetime(2000, 1, 2))
+        self.current_job.charges = [
+            dated(Charge(self.ended, 1), datetime(2000, 1, 2)),
+            dated(Charge(self.current, 2), datetime(2000, 1, 2))]
+        Session.add_all([self.ended, self.current,
+                         self.old_job, self.current_job])
+        Session.commit()
+        close_period(Session(), datetime(2001, 6, 1))
+        Session.commit()
+
+    def teardown (self):
+        Session.remove()
+        self.teardown_database()
+
+    def job (self, id_, end):
+        job = Job(id_)
+        job.user = self.user
+        job.account = self.project
+        job.start = datetime(2000, 1, 2)
+        job.end = end
+        return job
+
+    def archive (self):
+        counts = archive_ledger(Session(), datetime(2001, 6, 1))
+        Session.commit()
+        Session.expunge_all()
+        return counts
+
+    def test_archive (self):
+        assert_equal(self.archive(), (1, 1, 2, 1))
+        assert_equal(archived_before(metadata.bind), datetime(2001, 6, 1))
+        assert_equal(ids(jobs), ["2.current"])
+        assert_equal(ids(archived_jobs), ["1.old"])
+        assert_equal(len(ids(charges)), 2)
+        assert_equal(len(ids(archived_charges)), 2)
+        assert_equal(ids(refunds), [])
+        assert_equal(len(ids(archived_refunds)), 1)
+        assert_equal(ids(holds), [])
+        assert_equal(len(ids(archived_holds)), 1)
+
+    def test_not_archived (self):
+        assert_equal(archived_before(metadata.bind), None)
+
+    @raises(ValueError)
+    def test_not_closed (self):
+        archive_ledger(Session(), datetime(2001, 7, 1))
+
+    @raises(ValueError)
+    def test_already_archived (self):
+        self.archive()
+        archive_ledger(Session(), datetime(2001, 5, 1))
+
+    def test_active_hold (self):
+        hold = dated(Hold(self.ended, 1), datetime(2000, 1, 2))
+        hold.job = self.old_job
+        Session.commit()
+        assert_equal(self.archive(), (0, 0, 1, 0))
+        assert_equal(ids(archived_jobs), [])
+
+    def test_later_refund (self):
+        charge = Session.query(Charge).filter_by(amount=10).one()
+        Session.add(dated(Refund(charge, 1), datetime(2001, 7, 1)))
+        Session.commit()
+        assert_equal(self.archive(), (0, 0, 1, 0))
+        assert_equal(ids(archived_jobs), [])
+
+    def test_balances (self):
+        balances = balances_as_of(metadata.bind, datetime(2000, 6, 1))
+        self.archive()
+        assert_equal(verify_balances(metadata.bind), [])
+        assert_equal(verify_usage(metadata.bind), [])
+        assert_equal(balances_as_of(metadata.bind, datetime(2000, 6, 1)),
+                     balances)
+
+    def test_archived_jobs_by_id (self):
+        self.archive()
+        (job, ) = archived_jobs_by_id(metadata.bind, ["1.old", "2.current"])
+        assert_equal(job.id, "1.old")
+        assert job.user is self.user
+        assert job.account is self.project
+        assert_equal(job.end, datetime(2000, 1, 2, 12))
+
+    def test_users (self):
+        self.current_job.user_id = "other"
+        Session.commit()
+        self.archive()
+        assert_equal(set(get_users()),
+                     set([self.user, User.cached("other")]))
+
+    def test_summaries (self):
+        ranges = [(None, None), (datetime(2000, 1, 2, 6), None),
+                  (None, datetime(2000, 1, 2, 18)),
+                  (datetime(2001, 6, 1), None)]
+        summaries = [
+            lambda after, before: list(user_summary(
+                [self.user], after=after, before=before)),
+            lambda after, before: list(project_summary(
+                [self.project], after=after, before=before)),
+            lambda after, before: [
+                row[1:] for row in allocation_summary(
+                    Session.query(Allocation).all(),
+                    after=after, before=before)]]
+        expected = [summary(after, before)
+                    for summary in summaries for (after, before) in ranges]
+        self.archive()
+        assert_equal([summary(after, before)
+                      for summary in summaries for (after, before) in ranges],
+                     expected)
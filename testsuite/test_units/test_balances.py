@@ -0,0 +1,182 @@
+from nose.tools import assert_equal
+
+from testsuite import BaseTester
+
+from datetime import datetime
+
+from cbank.model.entities import Allocation, Hold, Charge, Refund
+from cbank.model.database import (
+    metadata, allocation_balances, archived_charges, archived_refunds)
+from cbank.model.queries import Session
+from cbank.model.balances import (
+    computed_balances, verify_balances, rebuild_balances, available_balances)
+
+
+def new_allocation (amount=100):
+    allocation = Allocation(None, None, amount,
+                            datetime(2000, 1, 1), datetime(2001, 1, 1))
+    allocation.project_id = "project"
+    allocation.resource_id = "resource"
+    return allocation
+
+
+def stored (allocation):
+    return tuple(metadata.bind.execute(allocation_balances.select(
+        allocation_balances.c.allocation_id==allocation.id)).fetchone()[1:])
+
+
+class TestAllocationBalances (BaseTester):
+
+    def setup (self):
+        self.setup_database()
+        self.allocation = new_allocation()
+        Session.add(self.allocation)
+        Session.commit()
+
+    def teardown (self):
+        Session.remove()
+        self.teardown_database()
+
+    def test_new_allocation (self):
+        assert_equal(stored(self.allocation), (0, 0, 0))
+
+    def test_hold (self):
+        hold = Hold(self.allocation, 10)
+        Session.add(hold)
+        Session.commit()
+        assert_equal(stored(self.allocation), (0, 0, 10))
+        hold.active = False
+        Session.commit()
+        assert_equal(stored(self.allocation), (0, 0, 0))
+
+    def test_charge_and_refund (self):
+        charge = Charge(self.allocation, 10)
+        Session.add(charge)
+        Session.commit()
+        refund = Refund(charge, 4)
+        Session.add(refund)
+        Session.commit()
+        assert_equal(stored(self.allocation), (10, 4, 0))
+        refund.amount = 3
+        charge.amount = 12
+        Session.commit()
+        assert_equal(stored(self.allocation), (12, 3, 0))
+        Session.delete(refund)
+        Session.commit()
+        assert_equal(stored(self.allocation), (12, 0, 0))
+
+    def test_offsetting_changes (self):
+        charge = Charge(self.allocation, 10)
+        refund = Refund(charge, 4)
+        Session.add(charge)
+        Session.commit()
+        refund.amount = 3
+        Refund(charge, 1)
+        Session.commit()
+        assert_equal(stored(self.allocation), (10, 4, 0))
+
+    def test_moved_charge (self):
+        other = new_allocation()
+        charge = Charge(self.allocation, 10)
+        Session.add_all([other, charge, Refund(charge, 4)])
+        Session.commit()
+        allocation_id, other_id = self.allocation.id, other.id
+        Session.close()
+        charge = Session.query(Charge).one()
+        charge.allocation = Session.query(Allocation).get(other_id)
+        Session.commit()
+        assert_equal(stored(Session.query(Allocation).get(allocation_id)),
+                     (0, 0, 0))
+        assert_equal(stored(Session.query(Allocation).get(other_id)),
+                     (10, 4, 0))
+
+    def test_new_allocation_with_ledger (self):
+        allocation = new_allocation()
+        charge = Charge(allocation, 5)
+        Session.add_all([allocation, charge, Hold(allocation, 2)])
+        Session.commit()
+        assert_equal(stored(allocation), (5, 0, 2))
+
+    def test_deleted_allocation (self):
+        Session.delete(self.allocation)
+        Session.commit()
+        assert_equal(metadata.bind.execute(
+            allocation_balances.select()).fetchall(), [])
+
+    def test_read_by_mapper (self):
+        Session.add_all([
+            Charge(self.allocation, 10), Hold(self.allocation, 5)])
+        Session.commit()
+        Session.close()
+        allocation = Session.query(Allocation).one()
+        assert_equal(allocation.amount_available(), 85)
+
+    def test_read_without_stored_balance (self):
+        refund = Refund(Charge(self.allocation, 10), 1)
+        Session.add_all([refund, Hold(self.allocation, 5)])
+        Session.commit()
+        metadata.bind.execute(archived_charges.insert(), id=100,
+            allocation_id=self.allocation.id, datetime=datetime(2000, 1, 2),
+            amount=20)
+        metadata.bind.execute(archived_refunds.insert(), id=100,
+            charge_id=100, datetime=datetime(2000, 1, 3), amount=2)
+        metadata.bind.execute(allocation_balances.delete())
+        Session.close()
+        allocation = Session.query(Allocation).one()
+        assert_equal(allocation.amount_charged(), 27)
+        assert_equal(allocation.amount_held(), 5)
+        assert_equal(allocation.amount_available(), 68)
+
+    def test_verify_and_rebuild (self):
+        Session.add(Charge(self.allocation, 10))
+        Session.commit()
+        assert_equal(verify_balances(metadata.bind), [])
+        metadata.bind.execute(allocation_balances.update(values={
+            'charged':0}))
+        assert_equal(verify_balances(metadata.bind),
+                     [(self.allocation.id, (0, 0, 0), (10, 0, 0))])
+        assert_equal(rebuild_balances(metadata.bind), 1)
+        assert_equal(verify_balances(metadata.bind), [])
+
+    def test_verify_missing (self):
+        metadata.bind.execute(allocation_balances.delete())
+        assert_equal(verify_balances(metadata.bind),
+                     [(self.allocation.id, None, (0, 0, 0))])
+
+    def test_computed_balances (self):
+        other = new_allocation()
+        Session.add_all([other, Charge(other, 3)])
+        Session.commit()
+        assert_equal(computed_balances(metadata.bind, [other.id]),
+                     {other.id:(3, 0, 0)})
+
+    def test_available_balances (self):
+        ended = new_allocation()
+        ended.end = datetime(2000, 6, 1)
+        hold = Hold(self.allocation, 5)
+        refund = Refund(Charge(self.allocation, 20), 4)
+        Session.add_all([ended, hold, refund])
+        Session.commit()
+        balances = available_balances(datetime(2000, 7, 1))
+        assert_equal(
+            sorted((row.allocation_id, row.balance)
+                   for row in metadata.bind.execute(balances.select())),
+            [(self.allocation.id, 79), (ended.id, 0)])
+        balances = available_balances(datetime(2000, 7, 1),
+            allocation_balances.c.allocation_id == ended.id)
+        assert_equal(
+            [row.balance for row in metadata.bind.execute(balances.select())],
+            [0])
+
+    def test_available_without_stored_balance (self):
+        refund = Refund(Charge(self.allocation, 10), 1)
+        Session.add_all([refund, Hold(self.allocation, 5)])
+        Session.commit()
+        metadata.bind.execute(archived_charges.insert(), id=100,
+            allocation_id=self.allocation.id, datetime=datetime(2000, 1, 2),
+            amount=20)
+        metadata.bind.execute(allocation_balances.delete())
+        balances = available_balances(datetime(2000, 7, 1))
+        assert_equal(
+            [row.balance for row in metadata.bind.execute(balances.select())],
+            [66])
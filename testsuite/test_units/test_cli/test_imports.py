@@ -0,0 +1,267 @@
+import os
+import json
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from nose.tools import assert_equal, assert_true, raises
+from mock import sentinel
+
+from cbank.cli.imports import (
+    FollowedLog, ImportStats, LogFile, log_streams, read_logs, parse_lines,
+    parse_entries, percentile, timestamp)
+
+
+class TestTimestamp (object):
+
+    def test_order (self):
+        assert_true(
+            timestamp("12/31/2007 23:59:59;E;1.server;")
+            < timestamp("01/01/2008 00:00:00;Q;2.server;"))
+
+
+class LogsTester (object):
+
+    def setup (self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown (self):
+        shutil.rmtree(self.directory)
+
+    def write_log (self, name, lines):
+        path = os.path.join(self.directory, name)
+        f = open(path, "w")
+        try:
+            f.write("".join(line + "\n" for line in lines))
+        finally:
+            f.close()
+        return path
+
+
+class TestLogStreams (LogsTester):
+
+    def test_file (self):
+        path = self.write_log("20080418", [])
+        assert_equal(log_streams([path]), [[path]])
+
+    def test_directory (self):
+        path_2 = self.write_log("20080419", [])
+        path_1 = self.write_log("20080418", [])
+        assert_equal(log_streams([self.directory]), [[path_1, path_2]])
+
+    def test_glob (self):
+        path_1 = self.write_log("20080418", [])
+        self.write_log("other", [])
+        assert_equal(
+            log_streams([os.path.join(self.directory, "2008*")]),
+            [[path_1]])
+
+    @raises(IOError)
+    def test_missing (self):
+        log_streams([os.path.join(self.directory, "missing")])
+
+
+class TestReadLogs (LogsTester):
+
+    def test_merge (self):
+        path_1 = self.write_log("server1", [
+            "04/18/2008 02:10:12;Q;1.server1;",
+            "# comment",
+            "04/18/2008 02:10:14;Q;2.server1;"])
+        path_2 = self.write_log("server2", [
+            "04/18/2008 02:10:12;Q;1.server2;",
+            "04/18/2008 02:10:13;Q;2.server2;"])
+        assert_equal([line for (line, log, offset)
+                      in read_logs([path_1, path_2])], [
+            "04/18/2008 02:10:12;Q;1.server1;",
+            "04/18/2008 02:10:12;Q;1.server2;",
+            "04/18/2008 02:10:13;Q;2.server2;",
+            "04/18/2008 02:10:14;Q;2.server1;"])
+
+
+class TestLogFile (LogsTester):
+
+    def test_lines (self):
+        path = self.write_log("20080418", ["a", "# comment", "b"])
+        assert_equal(list(LogFile(path).lines()), [("a", 2), ("b", 14)])
+
+    def test_lines_from_offset (self):
+        path = self.write_log("20080418", ["a", "# comment", "b"])
+        assert_equal(list(LogFile(path).lines(2)), [("b", 14)])
+
+    def test_unterminated_line (self):
+        path = self.write_log("20080418", ["a"])
+        f = open(path, "a")
+        f.write("b")
+        f.close()
+        assert_equal(list(LogFile(path).lines()), [("a", 2), ("b", 2)])
+
+    def test_identify (self):
+        path = self.write_log("20080418", ["a"])
+        log = LogFile(path)
+        log.identify()
+        assert_equal(log.inode, os.stat(path).st_ino)
+        assert_equal(log.size, 2)
+
+
+class TestFollowedLog (LogsTester):
+
+    def append (self, path, data):
+        f = open(path, "a")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+    def read (self, followed):
+        return [(line, log.path, offset)
+                for (line, log, offset) in followed.read()]
+
+    def test_growth (self):
+        path = self.write_log("20080418", ["line 1"])
+        followed = FollowedLog(path)
+        assert_equal(self.read(followed), [("line 1", path, 7)])
+        assert_equal(self.read(followed), [])
+        self.append(path, "line 2\n")
+        assert_equal(self.read(followed), [("line 2", path, 14)])
+        assert_equal(followed.log.size, 14)
+
+    def test_unterminated_line (self):
+        path = self.write_log("20080418", ["line 1"])
+        followed = FollowedLog(path)
+        self.append(path, "line")
+        assert_equal(self.read(followed), [("line 1", path, 7)])
+        self.append(path, " 2\n")
+        assert_equal(self.read(followed), [("line 2", path, 14)])
+
+    def test_rotation (self):
+        path_1 = self.write_log("20080418", ["line 1"])
+        followed = FollowedLog(self.directory)
+        assert_equal(self.read(followed), [("line 1", path_1, 7)])
+        self.append(path_1, "line 2\n")
+        path_2 = self.write_log("20080419", ["line 3"])
+        assert_equal(self.read(followed),
+            [("line 2", path_1, 14), ("line 3", path_2, 7)])
+        assert_equal(followed.log.path, path_2)
+
+    def test_empty_directory (self):
+        followed = FollowedLog(self.directory)
+        assert_equal(self.read(followed), [])
+        path = self.write_log("20080418", ["line 1"])
+        assert_equal(self.read(followed), [("line 1", path, 7)])
+
+    def test_replaced (self):
+        path = self.write_log("20080418", ["line 1", "line 2"])
+        followed = FollowedLog(path)
+        self.read(followed)
+        os.rename(path, path + ".old")
+        self.write_log("20080418", ["line 3"])
+        assert_equal(self.read(followed), [("line 3", path, 7)])
+
+    def test_truncated (self):
+        path = self.write_log("20080418", ["line 1", "line 2"])
+        followed = FollowedLog(path)
+        self.read(followed)
+        open(path, "w").close()
+        self.append(path, "line 3\n")
+        assert_equal(self.read(followed), [("line 3", path, 7)])
+
+    def test_resume (self):
+        path = self.write_log("20080418", ["line 1", "line 2"])
+        followed = FollowedLog(path, lambda log: 7)
+        assert_equal(self.read(followed), [("line 2", path, 14)])
+
+
+class TestParseLines (object):
+
+    def test_parse (self):
+        results = parse_lines([
+            "04/18/2008 02:10:12;Q;1.server;queue=shared",
+            "invalid"])
+        assert_equal(results, [
+            (("1.server", {'queue':"shared", 'resource_list':{},
+                           'resources_used':{}}), None),
+            (None, "Invalid job record: invalid")])
+
+
+class TestParseEntries (object):
+
+    entries = [
+        ("04/18/2008 02:10:12;Q;%i.server;queue=shared" % index,
+         sentinel.log, index)
+        for index in range(10)]
+
+    def check (self, results):
+        assert_equal([entry[:3] for entry in results], self.entries)
+        assert_equal([record[0] for (line, log, offset, record, error)
+                      in results],
+                     ["%i.server" % index for index in range(10)])
+
+    def test_in_process (self):
+        self.check(list(parse_entries(self.entries, 0, 3)))
+
+    def test_workers (self):
+        self.check(list(parse_entries(self.entries, 2, 3)))
+
+    def test_idle (self):
+        entries = self.entries[:2] + [None] + self.entries[2:]
+        for workers in (0, 2):
+            results = list(parse_entries(entries, workers, 3))
+            assert_equal(results[2], None)
+            assert_equal([entry[:3] for entry in results if entry],
+                         self.entries)
+
+
+class TestPercentile (object):
+
+    def test_empty (self):
+        assert_equal(percentile([], 0.5), None)
+
+    def test_nearest_rank (self):
+        values = range(1, 101)
+        assert_equal(percentile(values, 0.5), 50)
+        assert_equal(percentile(values, 0.99), 99)
+        assert_equal(percentile(values, 1.0), 100)
+        assert_equal(percentile([3], 0.5), 3)
+
+
+class TestImportStats (object):
+
+    def test_timed (self):
+        stats = ImportStats()
+        entries = list(stats.timed([sentinel.entry_1, None, sentinel.entry_2]))
+        assert_equal(entries, [sentinel.entry_1, None, sentinel.entry_2])
+        assert_equal(stats.records, 2)
+
+    def test_report (self):
+        stats = ImportStats()
+        stats.records = 10
+        stats.rejected = 1
+        for seconds in (0.3, 0.1, 0.2):
+            stats.committed(seconds, 2, 1)
+        report = stats.report()
+        assert_equal(report['records'], 10)
+        assert_equal(report['rejected'], 1)
+        assert_equal(report['inserted'], 6)
+        assert_equal(report['updated'], 3)
+        assert_equal(report['commits'], 3)
+        assert_equal(report['commit_p50'], 0.2)
+        assert_equal(report['commit_max'], 0.3)
+        assert_equal(stats.report()['commit_p50'], None)
+
+    def test_json (self):
+        file_ = StringIO()
+        stats = ImportStats(file_, format="json")
+        stats.committed(0.1, 1, 0)
+        stats.report(final=True)
+        report = json.loads(file_.getvalue())
+        assert_equal(report['inserted'], 1)
+        assert_true(report['final'])
+
+    def test_text (self):
+        file_ = StringIO()
+        stats = ImportStats(file_)
+        stats.committed(0.1, 1, 0)
+        stats.report()
+        assert_true("1 inserted" in file_.getvalue())
+        assert_true("commit p50 0.100 s" in file_.getvalue())
@@ -15,7 +15,7 @@ from cbank import config
 from cbank.model.entities import (
     UpstreamEntity, User, Project, Resource,
     Allocation, Hold, Charge, Refund,
-    distribute_amount)
+    distribute_amount, parse_job, parse_resource)
 from cbank.model.queries import Session
 import cbank.model
 
@@ -123,6 +123,29 @@ class TestUpstreamEntity (BaseTester):
         assert_equal(entity.id, "1")
         UpstreamEntity._in.assert_called_with("one")
 
+    @patch.object(UpstreamEntity, "_in",
+                  Mock([], return_value=None))
+    def test_fetch_id_undefined (self):
+        UpstreamEntity.clear_ids()
+        assert_equal(UpstreamEntity.fetch_id("one"), "one")
+        UpstreamEntity._in.assert_called_with("one")
+
+    @patch.object(UpstreamEntity, "_in",
+                  Mock([], return_value="1"))
+    def test_fetch_id_defined (self):
+        UpstreamEntity.clear_ids()
+        assert_equal(UpstreamEntity.fetch_id("one"), "1")
+        assert_equal(UpstreamEntity.fetch_id("one"), "1")
+        assert_equal(UpstreamEntity._in.call_count, 1)
+
+    @patch.object(UpstreamEntity, "_in", Mock([], return_value="1"))
+    @patch.object(UpstreamEntity, "id_cache_size", 2)
+    def test_fetch_id_bounded (self):
+        UpstreamEntity.clear_ids()
+        for input in ("one", "two", "three", "four"):
+            UpstreamEntity.fetch_id(input)
+        assert len(UpstreamEntity._ids) <= 2
+
     def test_cached (self):
         assert_identical(
             UpstreamEntity.cached("1"),
@@ -419,3 +442,53 @@ class TestRefund (BaseTester):
         assert_equal(refund.charge, sentinel.charge)
         assert_equal(refund.amount, sentinel.refund_amount)
         assert_equal(refund.comment, None)
+
+
+class TestParseJob (BaseTester):
+
+    def test_attributes (self):
+        id_, values = parse_job(
+            "04/18/2008 02:10:12;E;1.server;user=user1 account=project1 "
+            "queue=shared jobname=myjob ctime=1208502612 Exit_status=0 "
+            "session=100 unknown=value")
+        assert_equal(id_, "1.server")
+        assert_equal(values, {
+            'user_id':"user1", 'account_id':"project1", 'queue':"shared",
+            'name':"myjob", 'ctime':datetime.fromtimestamp(1208502612),
+            'exit_status':0, 'session':100,
+            'resource_list':{}, 'resources_used':{}})
+
+    def test_resources (self):
+        id_, values = parse_job(
+            "04/18/2008 02:10:12;E;1.server;Resource_List.ncpus=8 "
+            "Resource_List.walltime=01:00:00 resources_used.mem=1024kb "
+            "Resource_List=invalid other.ncpus=4")
+        assert_equal(values, {
+            'resource_list':{'ncpus':8, 'walltime':timedelta(hours=1)},
+            'resources_used':{'mem':"1024kb"}})
+
+    def test_empty_message (self):
+        assert_equal(parse_job("04/18/2008 02:10:12;Q;1.server;"),
+            ("1.server", {'resource_list':{}, 'resources_used':{}}))
+
+    @raises(ValueError)
+    def test_invalid_type (self):
+        parse_job("04/18/2008 02:10:12;D;1.server;queue=shared")
+
+    @raises(ValueError)
+    def test_invalid (self):
+        parse_job("some invalid data")
+
+
+class TestParseResource (object):
+
+    def test_int (self):
+        assert_equal(parse_resource("8"), 8)
+
+    def test_timedelta (self):
+        assert_equal(parse_resource("01:02:03"),
+            timedelta(hours=1, minutes=2, seconds=3))
+
+    def test_string (self):
+        assert_equal(parse_resource("1024kb"), "1024kb")
+        assert_equal(parse_resource("1:2"), "1:2")
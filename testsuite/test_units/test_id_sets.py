@@ -0,0 +1,118 @@
+from nose.tools import assert_equal
+
+from testsuite import BaseTester
+
+import gc
+from datetime import datetime
+
+import cbank.model.id_sets
+from cbank.model.entities import User, Project, Resource, Allocation, Job
+from cbank.model.database import metadata
+from cbank.model.queries import (
+    Session, import_jobs, user_summary, allocation_summary)
+from cbank.model.id_sets import listed_ids
+
+
+class TestListedIds (BaseTester):
+
+    def setup (self):
+        self.setup_database()
+        self._max_listed_ids = cbank.model.id_sets.max_listed_ids
+        cbank.model.id_sets.max_listed_ids = 2
+
+    def teardown (self):
+        cbank.model.id_sets.max_listed_ids = self._max_listed_ids
+        Session.remove()
+        self.teardown_database()
+
+    def temporary_tables (self):
+        return sorted(name for (name, ) in Session().connection(Job).execute(
+            "SELECT name FROM sqlite_temp_master WHERE type = 'table'"))
+
+    def test_short (self):
+        assert_equal(sorted(listed_ids("users", ["b", "a", "b"], Session())),
+                     ["a", "b"])
+        assert_equal(self.temporary_tables(), [])
+
+    def test_long (self):
+        import_jobs([("%i.host" % index, {}) for index in range(4)])
+        ids = listed_ids("jobs",
+            ["1.host", "2.host", "3.host", "4.host"], Session())
+        assert_equal(
+            sorted(job.id for job in Session.query(Job).filter(
+                Job.id.in_(ids))),
+            ["1.host", "2.host", "3.host"])
+
+    def test_reused (self):
+        import_jobs([("%i.host" % index, {}) for index in range(6)])
+        for first in range(3):
+            ids = listed_ids("jobs",
+                ["%i.host" % index for index in range(first, first + 3)],
+                Session())
+        listed_ids("users", ["a", "b", "c"], Session())
+        assert_equal(
+            sorted(job.id for job in Session.query(Job).filter(
+                Job.id.in_(ids))),
+            ["2.host", "3.host", "4.host"])
+        assert_equal(self.temporary_tables(),
+                     ["id_set_jobs", "id_set_users"])
+
+    def test_kept (self):
+        import_jobs([("%i.host" % index, {}) for index in range(6)])
+        query = Session.query(Job).filter(Job.id.in_(listed_ids("jobs",
+            ["0.host", "1.host", "2.host"], Session())))
+        later = listed_ids("jobs", ["3.host", "4.host", "5.host"], Session())
+        assert_equal(sorted(job.id for job in query),
+                     ["0.host", "1.host", "2.host"])
+        assert_equal(
+            sorted(job.id for job in Session.query(Job).filter(
+                Job.id.in_(later))),
+            ["3.host", "4.host", "5.host"])
+
+    def test_released (self):
+        for first in range(3):
+            listed_ids("users",
+                [str(index) for index in range(first, first + 3)],
+                Session())
+            gc.collect()
+        assert_equal(Session().connection(Job).execute(
+            "SELECT count(*) FROM id_set_users").scalar(), 3)
+
+    def test_import_jobs (self):
+        for batch in range(3):
+            import_jobs([("%i.%i.host" % (index, batch), {})
+                         for index in range(4)])
+        assert_equal(self.temporary_tables(), [])
+
+    def test_integers (self):
+        allocations = [
+            Allocation(Project.cached("1"), Resource.cached("1"), 10,
+                       datetime(2000, 1, 1), datetime(2001, 1, 1))
+            for index in range(3)]
+        Session.add_all(allocations)
+        Session.flush()
+        assert_equal(
+            [row[0] for row in allocation_summary(allocations)], allocations)
+
+    def test_engine (self):
+        assert_equal(
+            sorted(listed_ids("users", ["c", "b", "a"], metadata.bind)),
+                     ["a", "b", "c"])
+
+
+class TestManyUsers (BaseTester):
+
+    def setup (self):
+        self.setup_database()
+
+    def teardown (self):
+        Session.remove()
+        self.teardown_database()
+
+    def test_user_summary (self):
+        # more users than SQLite (before 3.32) allows parameters
+        users = [User.cached(str(index)) for index in range(1500)]
+        import_jobs([("%i.host" % index, {'user_id':str(index)})
+                     for index in range(0, 1500, 500)])
+        assert_equal(list(user_summary(users)),
+                     [("0", 1, 0), ("1000", 1, 0), ("500", 1, 0)])
@@ -0,0 +1,124 @@
+from nose.tools import assert_equal
+
+from testsuite import BaseTester
+
+from datetime import datetime
+
+from sqlalchemy.sql import select
+
+from cbank.model.entities import Job
+from cbank.model.database import (
+    metadata, jobs, job_nodes, archived_job_nodes,
+    compact_exec_host, expand_exec_host)
+from cbank.model.queries import Session, import_jobs
+from cbank.model.periods import close_period
+from cbank.model.archive import archive_ledger
+from cbank.model.job_nodes import (
+    exec_host_nodes, rebuild_job_nodes, node_job_keys)
+
+
+def stored_nodes ():
+    return sorted(tuple(row) for row in metadata.bind.execute(select(
+        [jobs.c.id, job_nodes.c.node], job_nodes.c.job_key == jobs.c.key)))
+
+
+def archived_nodes ():
+    return sorted(tuple(row) for row in metadata.bind.execute(
+        archived_job_nodes.select()))
+
+
+class TestExecHost (object):
+
+    def test_compact (self):
+        assert_equal(
+            compact_exec_host("a/0+a/1+a/2+a/5+b/0+b/1+a/3"),
+            "a/0-2,5+b/0-1+a/3")
+
+    def test_expand (self):
+        assert_equal(expand_exec_host("a/0-2,5+b/0-1+a/3"),
+                     "a/0+a/1+a/2+a/5+b/0+b/1+a/3")
+
+    def test_round_trip (self):
+        for exec_host in ("a/0", "a/3+a/2+a/2", "node-1/0+node-1/1",
+                          "a/0*2+a/1", "a", "", "n1/0-3", "a/1,2",
+                          "\\a/0", "n1/0-3+n1/4", "a/0+a/1+b/0-1"):
+            assert_equal(expand_exec_host(compact_exec_host(exec_host)),
+                         exec_host)
+
+    def test_escaped (self):
+        assert_equal(compact_exec_host("n1/0-3+a/0+a/1"), "\\n1/0-3+a/0-1")
+
+    def test_nodes (self):
+        assert_equal(exec_host_nodes("a/0+a/1+b/0+a/2"), ["a", "b"])
+        assert_equal(exec_host_nodes(None), [])
+
+
+class TestJobNodes (BaseTester):
+
+    def setup (self):
+        self.setup_database()
+
+    def teardown (self):
+        Session.remove()
+        self.teardown_database()
+
+    def test_stored_compactly (self):
+        exec_host = "+".join("host1/%i" % cpu for cpu in range(64))
+        job = Job("1.host")
+        job.exec_host = exec_host
+        Session.add(job)
+        Session.commit()
+        assert_equal(metadata.bind.execute(
+            "SELECT exec_host FROM jobs").scalar(), "host1/0-63")
+        Session.expunge_all()
+        assert_equal(Session.query(Job).one().exec_host, exec_host)
+
+    def test_import (self):
+        import_jobs([("1.host", {'exec_host':"a/0+a/1+b/0"}),
+                     ("2.host", {'queue':"batch"})])
+        assert_equal(stored_nodes(), [("1.host", "a"), ("1.host", "b")])
+        import_jobs([("1.host", {'exec_host':"c/0"})])
+        assert_equal(stored_nodes(), [("1.host", "c")])
+
+    def test_flush (self):
+        job = Job("1.host")
+        job.exec_host = "a/0"
+        Session.add(job)
+        Session.flush()
+        assert_equal(stored_nodes(), [("1.host", "a")])
+        job.exec_host = "b/0"
+        Session.flush()
+        assert_equal(stored_nodes(), [("1.host", "b")])
+        Session.delete(job)
+        Session.flush()
+        assert_equal(stored_nodes(), [])
+
+    def test_rebuild (self):
+        import_jobs([("%i.host" % index, {'exec_host':"a/0+b/%i" % index})
+                     for index in range(5)])
+        metadata.bind.execute(job_nodes.delete())
+        assert_equal(rebuild_job_nodes(metadata.bind, batch_size=2), 10)
+        assert_equal(len(stored_nodes()), 10)
+
+    def test_rebuild_archived (self):
+        import_jobs([
+            ("1.host", {'end':datetime(2000, 1, 2), 'exec_host':"a/0"}),
+            ("2.host", {'end':datetime(2000, 3, 1), 'exec_host':"b/0"})])
+        close_period(Session(), datetime(2000, 2, 1))
+        archive_ledger(Session(), datetime(2000, 2, 1))
+        Session.commit()
+        assert_equal(stored_nodes(), [("2.host", "b")])
+        assert_equal(archived_nodes(), [("1.host", "a")])
+        metadata.bind.execute(job_nodes.delete())
+        metadata.bind.execute(archived_job_nodes.delete())
+        assert_equal(rebuild_job_nodes(metadata.bind), 2)
+        assert_equal(stored_nodes(), [("2.host", "b")])
+        assert_equal(archived_nodes(), [("1.host", "a")])
+
+    def test_node_job_keys (self):
+        import_jobs([("1.host", {'exec_host':"a/0+b/0"}),
+                     ("2.host", {'exec_host':"b/1"}),
+                     ("3.host", {'exec_host':"c/0"})])
+        assert_equal(sorted(id_ for (id_, ) in metadata.bind.execute(
+            select([jobs.c.id], jobs.c.key.in_(node_job_keys(["b"]))))),
+            ["1.host", "2.host"])
@@ -2,12 +2,15 @@ from nose.tools import raises, assert_equal
 
 from mock import Mock, patch
 
+from sqlalchemy.sql import select
+
 from testsuite import BaseTester
 
 from datetime import datetime, timedelta
 
 from cbank.model.entities import (
     User, Project, Resource, Allocation, Hold, Job, Charge, Refund)
+from cbank.model.database import metadata, charges
 from cbank.model.queries import Session
 
 
@@ -189,3 +192,45 @@ class TestChargeMapper (MapperTester):
         Session.close()
         charge = Session.query(Charge).one()
         assert_equal(charge._refund_sum, 3)
+
+
+class TestJobMapper (MapperTester):
+
+    def setup (self):
+        MapperTester.setup(self)
+        job = Job("1.host")
+        job.exec_host = "host1/0"
+        job.resource_list = {'nodes':"1:ppn=8", 'walltime':timedelta(hours=1)}
+        job.resources_used = {'mem':"1024kb", 'ncpus':8, 'cput':1.5}
+        Session.add(job)
+        Session.commit()
+        Session.close()
+
+    def test_details_deferred (self):
+        job = Session.query(Job).one()
+        for key in ("exec_host", "resource_list", "resources_used"):
+            assert key not in job.__dict__
+        assert_equal(job.exec_host, "host1/0")
+        assert "resources_used" in job.__dict__
+
+    def test_ctime_loaded (self):
+        job = Session.query(Job).one()
+        assert "ctime" in job.__dict__
+
+    def test_resources (self):
+        job = Session.query(Job).one()
+        assert_equal(job.resource_list,
+                     {'nodes':"1:ppn=8", 'walltime':timedelta(hours=1)})
+        assert_equal(job.resources_used,
+                     {'mem':"1024kb", 'ncpus':8, 'cput':1.5})
+
+    def test_key (self):
+        job = Session.query(Job).filter_by(id="1.host").one()
+        assert_equal(job.key, 1)
+        charge = Charge(Allocation(Project.cached("1"), Resource.cached("1"),
+            0, datetime(2000, 1, 1), datetime(2001, 1, 1)), 0)
+        charge.job = job
+        Session.add(charge)
+        Session.commit()
+        assert_equal(metadata.bind.execute(
+            select([charges.c.job_key])).scalar(), job.key)
@@ -0,0 +1,311 @@
+from nose.tools import assert_equal
+
+from datetime import datetime, date
+
+from sqlalchemy import MetaData, Table, Column, ForeignKey
+from sqlalchemy.sql import select
+from sqlalchemy.types import Integer, String, DateTime, Boolean, Text, Date
+from sqlalchemy.engine.reflection import Inspector
+
+from testsuite import BaseTester
+
+from cbank.model.database import (
+    metadata, allocations, holds, jobs, charges, refunds,
+    import_checkpoints, schema_versions, allocation_balances, daily_usage,
+    ledger_closes, allocation_checkpoints, ledger_archives,
+    archived_jobs, archived_holds, archived_charges, archived_refunds,
+    resource_values, archived_resource_values,
+    job_nodes, archived_job_nodes)
+from cbank.model.migrations import (
+    migrations, schema_version, pending_migrations, migrate)
+
+
+ledger_tables = [allocations, holds, jobs, charges, refunds]
+archive_tables = [archived_jobs, archived_holds, archived_charges,
+                  archived_refunds]
+
+
+def index_names (table):
+    inspector = Inspector.from_engine(metadata.bind)
+    return set(index['name'] for index in inspector.get_indexes(table.name))
+
+
+class TestMigrate (BaseTester):
+
+    def setup (self):
+        self.setup_database()
+
+    def teardown (self):
+        self.teardown_database()
+
+    def downgrade (self):
+        """Drop what the migrations add, as in a 1.2 database."""
+        schema_versions.drop(metadata.bind)
+        allocation_balances.drop(metadata.bind)
+        daily_usage.drop(metadata.bind)
+        allocation_checkpoints.drop(metadata.bind)
+        ledger_closes.drop(metadata.bind)
+        import_checkpoints.drop(metadata.bind)
+        ledger_archives.drop(metadata.bind)
+        resource_values.drop(metadata.bind)
+        archived_resource_values.drop(metadata.bind)
+        job_nodes.drop(metadata.bind)
+        archived_job_nodes.drop(metadata.bind)
+        for table in archive_tables:
+            table.drop(metadata.bind)
+        for table in ledger_tables:
+            for index in table.indexes:
+                index.drop(metadata.bind)
+
+    def unkey_jobs (self):
+        """Replace the ledger with one keyed by job id, as before 1.3."""
+        for table in (refunds, charges, holds, jobs):
+            table.drop(metadata.bind)
+        old = MetaData()
+        Table("jobs", old,
+            Column("id", String(255), primary_key=True, autoincrement=False),
+            *[column.copy() for column in jobs.c
+              if column.name not in ("key", "id")])
+        Table("holds", old,
+            Column("id", Integer, primary_key=True),
+            Column("allocation_id", Integer, nullable=False),
+            Column("datetime", DateTime, nullable=False),
+            Column("amount", Integer, nullable=False),
+            Column("comment", Text),
+            Column("active", Boolean, nullable=False),
+            Column("job_id", None, ForeignKey("jobs.id")))
+        Table("charges", old,
+            Column("id", Integer, primary_key=True),
+            Column("allocation_id", Integer, nullable=False),
+            Column("datetime", DateTime, nullable=False),
+            Column("amount", Integer, nullable=False),
+            Column("comment", Text),
+            Column("job_id", None, ForeignKey("jobs.id")))
+        Table("refunds", old,
+            Column("id", Integer, primary_key=True),
+            Column("charge_id", None, ForeignKey("charges.id")),
+            Column("datetime", DateTime, nullable=False),
+            Column("amount", Integer, nullable=False),
+            Column("comment", Text))
+        old.create_all(metadata.bind)
+        return old
+
+    def test_unversioned (self):
+        assert_equal(schema_version(), 0)
+        assert_equal(pending_migrations(),
+                     list(enumerate(migrations, 1)))
+
+    def test_current_schema (self):
+        applied = migrate()
+        assert_equal(applied, list(enumerate(migrations, 1)))
+        assert_equal(schema_version(), len(migrations))
+        assert_equal(pending_migrations(), [])
+
+    def test_old_schema (self):
+        self.downgrade()
+        assert_equal(index_names(charges), set())
+        migrate()
+        assert import_checkpoints.exists(metadata.bind)
+        assert allocation_balances.exists(metadata.bind)
+        assert daily_usage.exists(metadata.bind)
+        assert ledger_closes.exists(metadata.bind)
+        assert allocation_checkpoints.exists(metadata.bind)
+        assert ledger_archives.exists(metadata.bind)
+        assert resource_values.exists(metadata.bind)
+        assert archived_resource_values.exists(metadata.bind)
+        assert job_nodes.exists(metadata.bind)
+        assert archived_job_nodes.exists(metadata.bind)
+        for table in archive_tables:
+            assert table.exists(metadata.bind)
+        for table in ledger_tables:
+            assert_equal(index_names(table),
+                         set(index.name for index in table.indexes))
+        assert_equal(schema_version(), len(migrations))
+
+    def test_unkeyed_jobs (self):
+        self.downgrade()
+        old = self.unkey_jobs()
+        now = datetime(2000, 1, 1)
+        metadata.bind.execute(allocations.insert(), [{
+            'id':1, 'project_id':"1", 'resource_id':"1", 'datetime':now,
+            'amount':10, 'start':now, 'end':now}])
+        metadata.bind.execute(old.tables['jobs'].insert(), [
+            {'id':"2.host", 'user_id':"2"}, {'id':"1.host", 'user_id':"1"}])
+        metadata.bind.execute(old.tables['holds'].insert(), [
+            {'id':3, 'allocation_id':1, 'datetime':now, 'amount':1,
+             'active':True, 'job_id':"2.host"}])
+        metadata.bind.execute(old.tables['charges'].insert(), [
+            {'id':4, 'allocation_id':1, 'datetime':now, 'amount':2,
+             'job_id':"2.host"},
+            {'id':5, 'allocation_id':1, 'datetime':now, 'amount':3,
+             'job_id':None}])
+        metadata.bind.execute(old.tables['refunds'].insert(), [
+            {'id':6, 'charge_id':4, 'datetime':now, 'amount':1}])
+        migrate()
+        assert_equal(
+            [tuple(row) for row in metadata.bind.execute(select(
+                [jobs.c.key, jobs.c.id, jobs.c.user_id, jobs.c.resource_id]
+                ).order_by(jobs.c.key))],
+            [(1, "1.host", "1", None), (2, "2.host", "2", "1")])
+        assert_equal(
+            [tuple(row) for row in metadata.bind.execute(select(
+                [holds.c.id, holds.c.job_key]))],
+            [(3, 2)])
+        assert_equal(
+            [tuple(row) for row in metadata.bind.execute(select(
+                [charges.c.id, charges.c.job_key]).order_by(charges.c.id))],
+            [(4, 2), (5, None)])
+        assert_equal(
+            [tuple(row) for row in metadata.bind.execute(select(
+                [refunds.c.id, refunds.c.charge_id]))],
+            [(6, 4)])
+        for table in (jobs, holds, charges, refunds):
+            assert_equal(index_names(table),
+                         set(index.name for index in table.indexes))
+        assert_equal(schema_version(), len(migrations))
+
+    def test_job_resources (self):
+        now = datetime(2000, 1, 1)
+        metadata.bind.execute(allocations.insert(), [
+            {'id':1, 'project_id':"1", 'resource_id':"2", 'datetime':now,
+             'amount':10, 'start':now, 'end':now},
+            {'id':2, 'project_id':"1", 'resource_id':"1", 'datetime':now,
+             'amount':10, 'start':now, 'end':now}])
+        metadata.bind.execute(jobs.insert(), [{'key':1, 'id':"1.host"}])
+        metadata.bind.execute(archived_jobs.insert(), [{'id':"2.host"}])
+        # charged to both resources, the lower resource charged last
+        metadata.bind.execute(charges.insert(), [
+            {'id':1, 'allocation_id':1, 'datetime':now, 'amount':1,
+             'job_key':1},
+            {'id':2, 'allocation_id':2, 'datetime':now, 'amount':1,
+             'job_key':1}])
+        metadata.bind.execute(archived_charges.insert(), [
+            {'id':3, 'allocation_id':1, 'datetime':now, 'amount':1,
+             'job_id':"2.host"},
+            {'id':4, 'allocation_id':2, 'datetime':now, 'amount':1,
+             'job_id':"2.host"}])
+        migrate()
+        for table in (jobs, archived_jobs):
+            assert_equal(
+                [row.resource_id for row in metadata.bind.execute(
+                    table.select())],
+                ["2"])
+
+    def test_page_indexes (self):
+        for index in jobs.indexes | charges.indexes | holds.indexes:
+            if index.name in ("ix_jobs_ctime_key", "ix_charges_datetime_id",
+                              "ix_holds_datetime_id"):
+                index.drop(metadata.bind)
+        metadata.bind.execute("CREATE INDEX ix_jobs_ctime ON jobs (ctime)")
+        metadata.bind.execute(
+            "CREATE INDEX ix_charges_datetime ON charges (datetime)")
+        migrate()
+        for table in (holds, jobs, charges):
+            assert_equal(index_names(table),
+                         set(index.name for index in table.indexes))
+
+    def test_daily_usage_key (self):
+        daily_usage.drop(metadata.bind)
+        old = MetaData()
+        Table("daily_usage", old,
+            Column("id", Integer, primary_key=True),
+            Column("day", Date, nullable=False),
+            Column("user_id", String(255), nullable=True),
+            Column("project_id", String(255), nullable=False),
+            Column("resource_id", String(255), nullable=False),
+            Column("charge_sum", Integer, nullable=False),
+            Column("refund_sum", Integer, nullable=False))
+        old.create_all(metadata.bind)
+        now = datetime(2000, 1, 1)
+        metadata.bind.execute(allocations.insert(), [{
+            'id':1, 'project_id':"1", 'resource_id':"1", 'datetime':now,
+            'amount':10, 'start':now, 'end':now}])
+        metadata.bind.execute(charges.insert(), [
+            {'id':1, 'allocation_id':1, 'datetime':now, 'amount':3}])
+        # the same key, stored twice by concurrent transactions
+        metadata.bind.execute(old.tables['daily_usage'].insert(), [
+            {'day':now.date(), 'user_id':None, 'project_id':"1",
+             'resource_id':"1", 'charge_sum':3, 'refund_sum':0}] * 2)
+        migrate()
+        assert_equal(
+            [tuple(row) for row in metadata.bind.execute(select([
+                daily_usage.c.day, daily_usage.c.user_id,
+                daily_usage.c.charge_sum, daily_usage.c.refund_sum]))],
+            [(date(2000, 1, 1), "", 3, 0)])
+        assert_equal(index_names(daily_usage),
+                     set(index.name for index in daily_usage.indexes))
+
+    def test_resource_values_key (self):
+        resource_values.drop(metadata.bind)
+        archived_resource_values.drop(metadata.bind)
+        old = MetaData()
+        Table("resource_values", old,
+            Column("job_id", String(255), primary_key=True),
+            Column("attribute", String(32), primary_key=True),
+            Column("name", String(255), primary_key=True),
+            Column("value", Integer, nullable=False))
+        old.create_all(metadata.bind)
+        metadata.bind.execute(jobs.insert(), [
+            {'key':1, 'id':"1.host", 'resources_used':{'ncpus':8}}])
+        metadata.bind.execute(archived_jobs.insert(), [
+            {'id':"2.host", 'resources_used':{'ncpus':4}}])
+        metadata.bind.execute(old.tables['resource_values'].insert(), [
+            {'job_id':"1.host", 'attribute':"resources_used",
+             'name':"ncpus", 'value':8}])
+        migrate()
+        assert_equal(
+            [tuple(row) for row in metadata.bind.execute(
+                resource_values.select())],
+            [(1, "resources_used", "ncpus", 8)])
+        assert_equal(
+            [tuple(row) for row in metadata.bind.execute(
+                archived_resource_values.select())],
+            [("2.host", "resources_used", "ncpus", 4)])
+        assert_equal(index_names(resource_values),
+                     set(index.name for index in resource_values.indexes))
+
+    def test_job_nodes_key (self):
+        job_nodes.drop(metadata.bind)
+        archived_job_nodes.drop(metadata.bind)
+        old = MetaData()
+        Table("job_nodes", old,
+            Column("job_id", String(255), primary_key=True),
+            Column("node", String(255), primary_key=True))
+        old.create_all(metadata.bind)
+        metadata.bind.execute(jobs.insert(), [
+            {'key':1, 'id':"1.host", 'exec_host':"a/0+b/0"}])
+        metadata.bind.execute(archived_jobs.insert(), [
+            {'id':"2.host", 'exec_host':"c/0"}])
+        metadata.bind.execute(old.tables['job_nodes'].insert(), [
+            {'job_id':"1.host", 'node':"a"}])
+        migrate()
+        assert_equal(
+            sorted(tuple(row) for row in metadata.bind.execute(
+                job_nodes.select())),
+            [(1, "a"), (1, "b")])
+        assert_equal(
+            [tuple(row) for row in metadata.bind.execute(
+                archived_job_nodes.select())],
+            [("2.host", "c")])
+        assert_equal(index_names(job_nodes),
+                     set(index.name for index in job_nodes.indexes))
+
+    def test_up_to_date (self):
+        migrate()
+        assert_equal(migrate(), [])
+
+    def test_version (self):
+        self.downgrade()
+        assert_equal(len(migrate(version=1)), 1)
+        assert_equal(schema_version(), 1)
+        assert import_checkpoints.exists(metadata.bind)
+        assert_equal(index_names(charges), set())
+
+    def test_recorded (self):
+        migrate()
+        versions = metadata.bind.execute(schema_versions.select().order_by(
+            schema_versions.c.version)).fetchall()
+        assert_equal([row.version for row in versions],
+                     range(1, len(migrations) + 1))
+        assert_equal(versions[0].description,
+                     "Create the import_checkpoints table.")
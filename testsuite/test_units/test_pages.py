@@ -0,0 +1,108 @@
+from nose.tools import raises, assert_equal
+
+from testsuite import BaseTester
+
+from datetime import datetime
+
+from cbank.model.database import metadata
+from cbank.model.entities import Project, Resource, Allocation, Job, Charge
+from cbank.model.queries import Session, charge_summary
+from cbank.model.pages import (
+    hold_keys, charge_keys, job_keys, page, entry_cursor)
+
+
+class TestPages (BaseTester):
+
+    def setup (self):
+        self.setup_database()
+        allocation = Allocation(Project.cached("1"), Resource.cached("1"),
+            100, datetime(2000, 1, 1), datetime(2001, 1, 1))
+        self.charges = []
+        for day in (3, 1, 2, 2, 1):
+            charge = Charge(allocation, day)
+            charge.datetime = datetime(2000, 1, day, 0, 0, 0, 500)
+            self.charges.append(charge)
+        Session.add(allocation)
+        Session.flush()
+        self.charges.sort(key=lambda charge: (charge.datetime, charge.id))
+
+    def teardown (self):
+        Session.remove()
+        self.teardown_database()
+
+    def pages (self, query, keys, limit):
+        pages = []
+        cursor = None
+        while True:
+            entries = list(page(query, keys, cursor, limit))
+            if not entries:
+                return pages
+            pages.append(entries)
+            cursor = entry_cursor(keys, entries[-1])
+
+    def query_plan (self, query):
+        """The steps of the SQLite query plan of a query."""
+        compiled = query.statement.compile(bind=metadata.bind)
+        params = [compiled.params[name] for name in compiled.positiontup]
+        return [row[len(row) - 1] for row in metadata.bind.execute(
+            "EXPLAIN QUERY PLAN %s" % compiled, *params)]
+
+    def test_first_page (self):
+        assert_equal(list(page(Session.query(Charge), charge_keys, limit=2)),
+                     self.charges[:2])
+
+    def test_pages (self):
+        assert_equal(self.pages(Session.query(Charge), charge_keys, 2),
+                     [self.charges[:2], self.charges[2:4], self.charges[4:]])
+
+    def test_summary (self):
+        cursor = entry_cursor(charge_keys, self.charges[1])
+        assert_equal(list(charge_summary(cursor=cursor, limit=2)),
+                     self.charges[2:4])
+
+    def test_null_keys (self):
+        jobs = [Job("%i.host" % index) for index in range(4)]
+        jobs[1].ctime = datetime(2000, 1, 2)
+        jobs[3].ctime = datetime(2000, 1, 1)
+        Session.add_all(jobs)
+        Session.flush()
+        assert_equal(self.pages(Session.query(Job), job_keys, 3),
+                     [[jobs[0], jobs[2], jobs[3]], [jobs[1]]])
+
+    def test_null_key_cursor (self):
+        jobs = [Job("%i.host" % index) for index in range(3)]
+        jobs[1].ctime = datetime(2000, 1, 1)
+        Session.add_all(jobs)
+        Session.flush()
+        assert_equal(self.pages(Session.query(Job), job_keys, 1),
+                     [[jobs[0]], [jobs[2]], [jobs[1]]])
+
+    def test_index_seek (self):
+        charge = self.charges[1]
+        (job, null_job) = (Job("1.host"), Job("2.host"))
+        job.ctime = datetime(2000, 1, 1)
+        Session.add_all([job, null_job])
+        Session.flush()
+        for (query, keys, entry, index) in (
+                (Session.query(Charge), charge_keys, charge,
+                 "ix_charges_datetime_id"),
+                (Session.query(Job), job_keys, job, "ix_jobs_ctime_key"),
+                (Session.query(Job), job_keys, null_job,
+                 "ix_jobs_ctime_key")):
+            cursor = entry_cursor(keys, entry)
+            plan = self.query_plan(page(query, keys, cursor, 2))
+            table = keys[0].table.name
+            searches = [step for step in plan if table in step.split()]
+            assert searches, plan
+            for step in searches:
+                assert step.startswith("SEARCH %s USING INDEX %s ("
+                                       % (table, index)), plan
+
+    @raises(ValueError)
+    def test_invalid_cursor (self):
+        page(Session.query(Charge), charge_keys, "not a cursor")
+
+    @raises(ValueError)
+    def test_other_list (self):
+        cursor = entry_cursor(charge_keys, self.charges[0])
+        page(Session.query(Charge), hold_keys, cursor)
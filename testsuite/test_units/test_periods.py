@@ -0,0 +1,116 @@
+from nose.tools import raises, assert_equal
+
+from testsuite import BaseTester
+
+from datetime import datetime
+
+from cbank.model.entities import Allocation, Charge, Refund
+from cbank.model.database import metadata, allocation_checkpoints
+from cbank.model.queries import Session
+from cbank.model.periods import closed_before, close_period, balances_as_of
+
+
+def dated (entry, datetime_):
+    entry.datetime = datetime_
+    return entry
+
+
+class TestClosedPeriods (BaseTester):
+
+    def setup (self):
+        self.setup_database()
+        self.allocation = Allocation(None, None, 100,
+            datetime(2000, 1, 1), datetime(2001, 1, 1))
+        self.allocation.project_id = "project"
+        self.allocation.resource_id = "resource"
+        self.charge_1 = dated(Charge(self.allocation, 10),
+                              datetime(2000, 1, 1))
+        self.charge_2 = dated(Charge(self.allocation, 20),
+                              datetime(2000, 2, 1))
+        self.refund = dated(Refund(self.charge_1, 4), datetime(2000, 3, 1))
+        Session.add(self.allocation)
+        Session.commit()
+
+    def teardown (self):
+        Session.remove()
+        self.teardown_database()
+
+    def test_not_closed (self):
+        assert_equal(closed_before(metadata.bind), None)
+        assert_equal(balances_as_of(metadata.bind, datetime(2000, 2, 15)),
+                     {self.allocation.id:(30, 0)})
+
+    def test_close (self):
+        assert_equal(close_period(Session(), datetime(2000, 2, 15)), 1)
+        Session.commit()
+        assert_equal(closed_before(metadata.bind), datetime(2000, 2, 15))
+        assert_equal(
+            [tuple(row) for row in metadata.bind.execute(
+                allocation_checkpoints.select())],
+            [(1, self.allocation.id, 30, 0)])
+
+    def test_balances_as_of (self):
+        close_period(Session(), datetime(2000, 1, 15))
+        Session.commit()
+        # the stored sums are not summed again
+        metadata.bind.execute(allocation_checkpoints.update(
+            values={'charged':11}))
+        assert_equal(balances_as_of(metadata.bind, datetime(2000, 1, 20)),
+                     {self.allocation.id:(11, 0)})
+        assert_equal(balances_as_of(metadata.bind, datetime(2000, 4, 1)),
+                     {self.allocation.id:(31, 4)})
+        assert_equal(balances_as_of(metadata.bind, datetime(2000, 1, 10)),
+                     {self.allocation.id:(10, 0)})
+
+    def test_incremental_close (self):
+        close_period(Session(), datetime(2000, 1, 15))
+        close_period(Session(), datetime(2000, 4, 1))
+        Session.commit()
+        assert_equal(balances_as_of(metadata.bind, datetime(2000, 4, 1)),
+                     {self.allocation.id:(30, 4)})
+
+    @raises(ValueError)
+    def test_already_closed (self):
+        close_period(Session(), datetime(2000, 2, 15))
+        close_period(Session(), datetime(2000, 2, 1))
+
+    @raises(ValueError)
+    def test_future (self):
+        close_period(Session(), datetime(2100, 1, 1))
+
+    @raises(ValueError)
+    def test_backdated_charge (self):
+        close_period(Session(), datetime(2000, 2, 15))
+        Session.add(dated(Charge(self.allocation, 1), datetime(2000, 2, 1)))
+        Session.flush()
+
+    @raises(ValueError)
+    def test_backdated_refund (self):
+        close_period(Session(), datetime(2000, 2, 15))
+        Session.add(dated(Refund(self.charge_2, 1), datetime(2000, 2, 1)))
+        Session.flush()
+
+    @raises(ValueError)
+    def test_closed_charge_changed (self):
+        close_period(Session(), datetime(2000, 2, 15))
+        self.charge_1.amount = 5
+        Session.flush()
+
+    @raises(ValueError)
+    def test_closed_charge_deleted (self):
+        close_period(Session(), datetime(2000, 2, 15))
+        Session.delete(self.charge_1)
+        Session.flush()
+
+    @raises(ValueError)
+    def test_charge_moved_into_closed_period (self):
+        close_period(Session(), datetime(2000, 2, 15))
+        self.refund.datetime = datetime(2000, 2, 1)
+        Session.flush()
+
+    def test_open_period (self):
+        close_period(Session(), datetime(2000, 2, 15))
+        Session.add(dated(Refund(self.charge_1, 1), datetime(2000, 3, 1)))
+        self.charge_2.comment = "comment"
+        self.refund.amount = 3
+        Session.flush()
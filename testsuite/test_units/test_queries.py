@@ -4,13 +4,15 @@ from mock import Mock, patch
 
 from testsuite import BaseTester
 
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
 
 from cbank.model.entities import (
     User, Project, Resource, Allocation, Hold, Job, Charge, Refund)
 from cbank.model.queries import (
-    Session, get_projects, get_users,
+    Session, get_projects, get_users, import_jobs, coalesce_jobs,
+    get_import_checkpoint, set_import_checkpoint, split_days,
     user_summary, project_summary, allocation_summary)
+from cbank.model.usage import verify_usage
 
 
 class QueryTester (BaseTester):
@@ -118,6 +120,115 @@ class TestGetUsers (QueryTester):
             [User.cached("1")])
 
 
+class TestImportJobs (QueryTester):
+
+    def test_empty (self):
+        assert_equal(import_jobs([]), (0, 0))
+        assert_equal(Session.query(Job).count(), 0)
+
+    def test_insert (self):
+        counts = import_jobs([
+            ("1", {'queue':"shared", 'resource_list':{'ncpus':8}}),
+            ("2", {'queue':"exclusive"})])
+        assert_equal(counts, (2, 0))
+        job_1, job_2 = Session.query(Job).order_by(Job.id)
+        assert_equal(job_1.queue, "shared")
+        assert_equal(job_1.resource_list, {'ncpus':8})
+        assert_equal(job_2.queue, "exclusive")
+
+    def test_update (self):
+        job = Job("1")
+        job.queue = "shared"
+        job.name = "myjob"
+        Session.add(job)
+        Session.commit()
+        counts = import_jobs([("1", {'queue':"exclusive"})])
+        assert_equal(counts, (0, 1))
+        Session.expire_all()
+        job = Session.query(Job).one()
+        assert_equal(job.queue, "exclusive")
+        assert_equal(job.name, "myjob")
+
+    def test_repeated (self):
+        counts = import_jobs([
+            ("1", {'queue':"shared", 'name':"myjob"}),
+            ("1", {'queue':"exclusive"})])
+        assert_equal(counts, (1, 0))
+        job = Session.query(Job).one()
+        assert_equal(job.queue, "exclusive")
+        assert_equal(job.name, "myjob")
+
+    def test_user_usage (self):
+        start = datetime(2000, 1, 1)
+        allocation = Allocation(Project.cached("1"), Resource.cached("1"),
+            100, start, start + timedelta(weeks=1))
+        charge = Charge(allocation, 10)
+        charge.datetime = start
+        charge.job = Job("1.pbs")
+        Refund(charge, 4)
+        Session.add(charge)
+        Session.commit()
+        import_jobs([("1.pbs", {'user_id':"alice"})])
+        Session.commit()
+        user = User.cached("alice")
+        assert_equal(list(user_summary([user])), [("alice", 1, 6)])
+        assert_equal(
+            list(user_summary([user], after=start,
+                              before=start + timedelta(days=2))),
+            [("alice", 0, 6)])
+        assert_equal(verify_usage(Session()), [])
+
+    @patch("cbank.model.queries.job_upsert", Mock(return_value=None))
+    def test_insert_without_upsert (self):
+        self.test_insert()
+
+    @patch("cbank.model.queries.job_upsert", Mock(return_value=None))
+    def test_update_without_upsert (self):
+        self.test_update()
+
+    @patch("cbank.model.queries.job_upsert", Mock(return_value=None))
+    def test_repeated_without_upsert (self):
+        self.test_repeated()
+
+    @patch("cbank.model.queries.job_upsert", Mock(return_value=None))
+    def test_user_usage_without_upsert (self):
+        self.test_user_usage()
+
+
+class TestCoalesceJobs (object):
+
+    def test_coalesce (self):
+        values = {'queue':"shared", 'name':"myjob"}
+        records = coalesce_jobs([
+            ("1", values),
+            ("2", {'queue':"shared"}),
+            ("1", {'queue':"exclusive", 'exit_status':0})])
+        assert_equal(records, [
+            ("1", {'queue':"exclusive", 'name':"myjob", 'exit_status':0}),
+            ("2", {'queue':"shared"})])
+        assert_equal(values, {'queue':"shared", 'name':"myjob"})
+
+
+class TestImportCheckpoints (QueryTester):
+
+    def test_missing (self):
+        assert_equal(get_import_checkpoint("/var/log/20080418"), None)
+
+    def test_set (self):
+        set_import_checkpoint("/var/log/20080418", 1, 100, "abc", 50)
+        checkpoint = get_import_checkpoint("/var/log/20080418")
+        assert_equal(
+            (checkpoint.inode, checkpoint.size, checkpoint.head,
+             checkpoint.offset),
+            (1, 100, "abc", 50))
+
+    def test_update (self):
+        set_import_checkpoint("/var/log/20080418", 1, 100, "abc", 50)
+        set_import_checkpoint("/var/log/20080418", 1, 200, "abc", 150)
+        checkpoint = get_import_checkpoint("/var/log/20080418")
+        assert_equal((checkpoint.size, checkpoint.offset), (200, 150))
+
+
 class TestPositiveAmountConstraints (QueryTester):
 
     @raises(ValueError)
@@ -311,6 +422,36 @@ class TestUserSummary (QueryTester):
             list(user_summary(users, resources=resources)),
             [("1", 0, 0), ("2", 2, 5)])
     
+    def test_users_filter (self):
+        start = datetime(2000, 1, 1)
+        allocation = Allocation(Project.cached("1"), Resource.cached("1"),
+            0, start, start + timedelta(weeks=1))
+        for (id_, user_id, amount) in (("1", "1", 1), ("2", "2", 2),
+                                       ("3", "2", 4)):
+            job = Job(id_)
+            job.user_id = user_id
+            job.charges = [Charge(allocation, amount)]
+            job.charges[0].datetime = start
+        Session.add(allocation)
+        assert_equal(list(user_summary([User.cached("2")])), [("2", 2, 6)])
+        assert_equal(
+            list(user_summary([User.cached("2")],
+                              after=start + timedelta(hours=12))),
+            [("2", 0, 0)])
+    
+    def test_resources_uncharged (self):
+        job_1 = Job("1")
+        job_2 = Job("2")
+        job_1.user_id = "1"
+        job_2.user_id = "1"
+        job_1.resource = Resource.cached("1")
+        job_2.resource = Resource.cached("2")
+        Session.add_all([job_1, job_2])
+        assert_equal(
+            list(user_summary([User.cached("1")],
+                              resources=[Resource.cached("1")])),
+            [("1", 1, 0)])
+    
     def test_after_filter (self):
         user_1 = User.cached("1")
         user_2 = User.cached("2")
@@ -405,6 +546,68 @@ class TestUserSummary (QueryTester):
             list(user_summary(users, before=datetime(2000, 1, 3))),
             [("1", 1, 0), ("2", 1, 0)])
 
+    def test_partial_days (self):
+        project = Project.cached("1")
+        resource = Resource.cached("1")
+        start = datetime(2000, 1, 1)
+        allocation = Allocation(project, resource, 0,
+                                start, start + timedelta(weeks=1))
+        for (index, hour) in enumerate([6, 18, 30, 42, 54, 66]):
+            job = Job(str(index))
+            job.user_id = "1"
+            job.charges = [Charge(allocation, 2 ** index)]
+            job.charges[0].datetime = start + timedelta(hours=hour)
+        Session.add(allocation)
+        users = [User.cached("1")]
+        assert_equal(
+            list(user_summary(users,
+                after=datetime(2000, 1, 1, 12),
+                before=datetime(2000, 1, 3, 12))),
+            [("1", 0, 2 + 4 + 8 + 16)])
+        assert_equal(
+            list(user_summary(users,
+                after=datetime(2000, 1, 2, 12),
+                before=datetime(2000, 1, 2, 20))),
+            [("1", 0, 8)])
+        assert_equal(
+            list(project_summary([project],
+                after=datetime(2000, 1, 1, 12),
+                before=datetime(2000, 1, 3, 12))),
+            [("1", 0, 2 + 4 + 8 + 16, 0)])
+
+
+class TestSplitDays (object):
+
+    def test_unbounded (self):
+        assert_equal(split_days(), ((None, None), []))
+
+    def test_whole_days (self):
+        assert_equal(
+            split_days(datetime(2000, 1, 1), datetime(2000, 1, 3)),
+            ((date(2000, 1, 1), date(2000, 1, 3)), []))
+
+    def test_partial_days (self):
+        assert_equal(
+            split_days(datetime(2000, 1, 1, 12), datetime(2000, 1, 3, 12)),
+            ((date(2000, 1, 2), date(2000, 1, 3)),
+             [(datetime(2000, 1, 1, 12), datetime(2000, 1, 2)),
+              (datetime(2000, 1, 3), datetime(2000, 1, 3, 12))]))
+
+    def test_after (self):
+        assert_equal(split_days(after=datetime(2000, 1, 1, 12)),
+            ((date(2000, 1, 2), None),
+             [(datetime(2000, 1, 1, 12), datetime(2000, 1, 2))]))
+
+    def test_before (self):
+        assert_equal(split_days(before=datetime(2000, 1, 1, 12)),
+            ((None, date(2000, 1, 1)),
+             [(datetime(2000, 1, 1), datetime(2000, 1, 1, 12))]))
+
+    def test_no_whole_day (self):
+        assert_equal(
+            split_days(datetime(2000, 1, 1, 12), datetime(2000, 1, 2, 6)),
+            (None, [(datetime(2000, 1, 1, 12), datetime(2000, 1, 2, 6))]))
+
 
 class TestProjectSummary (QueryTester):
 
@@ -565,6 +768,12 @@ class TestProjectSummary (QueryTester):
         Session.add_all([allocation_1, allocation_2, allocation_3, allocation_4])
         assert_equal(list(project_summary([project_1, project_2])),
                      [("1", 3, 30, 0), ("2", 2, 17, 48)])
+        # only the selected projects are summed
+        assert_equal(list(project_summary([project_2])),
+                     [("2", 2, 17, 48)])
+        assert_equal(list(project_summary([project_1],
+                                          after=datetime(2000, 1, 1, 12))),
+                     [("1", 0, 30, 0)])
     
     @patch("cbank.model.queries.datetime", datetime_mock)
     def test_expired_charges (self):
@@ -831,6 +1040,30 @@ class TestAllocationSummary (QueryTester):
         assert_equal(list(allocation_summary([allocation])),
                      [(allocation, 0, 20, 0)])
 
+    @patch("cbank.model.queries.datetime", datetime_mock)
+    def test_query (self):
+        start = datetime(2000, 1, 1)
+        end = start + timedelta(weeks=1)
+        allocation_1 = Allocation(
+            Project.cached("1"), Resource.cached("1"), 10, start, end)
+        allocation_2 = Allocation(
+            Project.cached("2"), Resource.cached("1"), 20, start, end)
+        Charge(allocation_1, 4)
+        Session.add_all([allocation_1, allocation_2])
+        Session.flush()
+        assert_equal(
+            list(allocation_summary(Session.query(Allocation).filter(
+                Allocation.project_id == "1"))),
+            [(allocation_1, 0, 4, 6)])
+        assert_equal(
+            list(allocation_summary(Session.query(Allocation))),
+            [(allocation_1, 0, 4, 6), (allocation_2, 0, 0, 20)])
+        # a query that selects by a join
+        assert_equal(
+            list(allocation_summary(Session.query(Allocation).join(
+                Allocation.charges).filter(Charge.amount == 4))),
+            [(allocation_1, 0, 4, 6)])
+
     @patch("cbank.model.queries.datetime", datetime_mock)
     def test_expired (self):
         project_1 = Project.cached("1")
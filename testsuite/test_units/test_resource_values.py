@@ -0,0 +1,170 @@
+from nose.tools import assert_equal
+
+from testsuite import BaseTester, clear_config
+
+from datetime import datetime, timedelta
+
+import cbank
+from cbank.model.entities import Project, Job
+from sqlalchemy.sql import select
+
+from cbank.model.database import (
+    metadata, jobs, resource_values, archived_resource_values)
+from cbank.model.queries import Session, import_jobs
+from cbank.model.periods import close_period
+from cbank.model.archive import archive_ledger
+from cbank.model.resource_values import (
+    configured_resources, numeric_value, rebuild_resource_values,
+    resource_summary)
+
+
+def stored_values ():
+    return sorted(tuple(row) for row in metadata.bind.execute(select(
+        [jobs.c.id, resource_values.c.attribute, resource_values.c.name,
+         resource_values.c.value], resource_values.c.job_key == jobs.c.key)))
+
+
+def archived_values ():
+    return sorted(tuple(row) for row in metadata.bind.execute(
+        archived_resource_values.select()))
+
+
+class TestNumericValue (object):
+
+    def test_int (self):
+        assert_equal(numeric_value(4), 4)
+
+    def test_timedelta (self):
+        assert_equal(numeric_value(timedelta(days=1, hours=1, seconds=2)),
+                     90002)
+
+    def test_size (self):
+        assert_equal(numeric_value("2kb"), 2048)
+        assert_equal(numeric_value("3GB"), 3 * 1024 ** 3)
+        assert_equal(numeric_value("1mw"), 8 * 1024 ** 2)
+
+    def test_string (self):
+        assert_equal(numeric_value("host1"), None)
+        assert_equal(numeric_value(None), None)
+
+
+class TestConfiguredResources (object):
+
+    def teardown (self):
+        clear_config()
+
+    def test_default (self):
+        assert_equal(configured_resources(),
+                     ["walltime", "ncpus", "nodect", "mem"])
+
+    def test_configured (self):
+        cbank.config.add_section("jobs")
+        cbank.config.set("jobs", "resources", "ncpus, vmem")
+        assert_equal(configured_resources(), ["ncpus", "vmem"])
+
+
+class TestResourceValues (BaseTester):
+
+    def setup (self):
+        self.setup_database()
+
+    def teardown (self):
+        Session.remove()
+        self.teardown_database()
+        clear_config()
+
+    def test_import (self):
+        import_jobs([("1.host", {
+            'resource_list':{'walltime':timedelta(hours=1), 'arch':"x86"},
+            'resources_used':{'mem':"1kb", 'ncpus':8}})])
+        assert_equal(stored_values(), [
+            ("1.host", "resource_list", "walltime", 3600),
+            ("1.host", "resources_used", "mem", 1024),
+            ("1.host", "resources_used", "ncpus", 8)])
+
+    def test_import_update (self):
+        import_jobs([("1.host", {'resources_used':{'ncpus':8}})])
+        import_jobs([("1.host", {'resources_used':{'ncpus':4}}),
+                     ("1.host", {'queue':"batch"})])
+        assert_equal(stored_values(),
+                     [("1.host", "resources_used", "ncpus", 4)])
+
+    def test_flush (self):
+        job = Job("1.host")
+        job.resources_used = {'nodect':2}
+        Session.add(job)
+        Session.flush()
+        assert_equal(stored_values(),
+                     [("1.host", "resources_used", "nodect", 2)])
+        job.resources_used = {'nodect':3}
+        Session.flush()
+        assert_equal(stored_values(),
+                     [("1.host", "resources_used", "nodect", 3)])
+        Session.delete(job)
+        Session.flush()
+        assert_equal(stored_values(), [])
+
+    def test_rebuild (self):
+        import_jobs([("%i.host" % index, {'resources_used':{
+            'ncpus':index, 'vmem':"1kb"}}) for index in range(5)])
+        metadata.bind.execute(resource_values.delete())
+        cbank.config.add_section("jobs")
+        cbank.config.set("jobs", "resources", "ncpus,vmem")
+        assert_equal(rebuild_resource_values(metadata.bind, batch_size=2), 10)
+        assert_equal(len(stored_values()), 10)
+
+    def test_rebuild_archived (self):
+        import_jobs([
+            ("1.host", {'end':datetime(2000, 1, 2),
+                        'resources_used':{'ncpus':8}}),
+            ("2.host", {'end':datetime(2000, 3, 1),
+                        'resources_used':{'ncpus':4}})])
+        close_period(Session(), datetime(2000, 2, 1))
+        archive_ledger(Session(), datetime(2000, 2, 1))
+        Session.commit()
+        metadata.bind.execute(resource_values.delete())
+        metadata.bind.execute(archived_resource_values.delete())
+        assert_equal(rebuild_resource_values(metadata.bind), 2)
+        assert_equal(stored_values(),
+                     [("2.host", "resources_used", "ncpus", 4)])
+        assert_equal(archived_values(),
+                     [("1.host", "resources_used", "ncpus", 8)])
+
+    def test_summary (self):
+        project_1 = Project.cached("1")
+        import_jobs([
+            ("1.host", {'account_id':"1", 'end':datetime(2000, 1, 2),
+                        'resources_used':{'ncpus':8, 'nodect':1}}),
+            ("2.host", {'account_id':"1", 'end':datetime(2000, 1, 3),
+                        'resources_used':{'ncpus':4}}),
+            ("3.host", {'account_id':"2", 'end':datetime(2000, 1, 3),
+                        'resources_used':{'ncpus':2}})])
+        assert_equal(resource_summary(metadata.bind, ["ncpus", "nodect"]),
+                     [("1", "ncpus", 12), ("1", "nodect", 1),
+                      ("2", "ncpus", 2)])
+        assert_equal(
+            resource_summary(metadata.bind, ["ncpus"],
+                projects=[project_1], after=datetime(2000, 1, 2, 12)),
+            [("1", "ncpus", 4)])
+
+    def test_archived_summary (self):
+        import_jobs([
+            ("1.host", {'account_id':"1", 'end':datetime(2000, 1, 2),
+                        'resources_used':{'ncpus':8}}),
+            ("2.host", {'account_id':"1", 'end':datetime(2000, 3, 1),
+                        'resources_used':{'ncpus':4}})])
+        close_period(Session(), datetime(2000, 2, 1))
+        archive_ledger(Session(), datetime(2000, 2, 1))
+        Session.commit()
+        assert_equal([row.id for row in metadata.bind.execute(
+            jobs.select())], ["2.host"])
+        assert_equal(stored_values(),
+                     [("2.host", "resources_used", "ncpus", 4)])
+        assert_equal(archived_values(),
+                     [("1.host", "resources_used", "ncpus", 8)])
+        assert_equal(resource_summary(metadata.bind, ["ncpus"]),
+                     [("1", "ncpus", 12)])
+        assert_equal(
+            resource_summary(metadata.bind, ["ncpus"],
+                projects=[Project.cached("1")], after=datetime(2000, 1, 1)),
+            [("1", "ncpus", 12)])
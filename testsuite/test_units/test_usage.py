@@ -0,0 +1,185 @@
+from nose.tools import assert_equal, assert_raises
+
+from testsuite import BaseTester
+
+from datetime import datetime, date
+
+from sqlalchemy.exceptions import IntegrityError
+from sqlalchemy.engine.default import DefaultDialect
+
+from cbank.model.entities import Allocation, Job, Charge, Refund
+from cbank.model.database import metadata, daily_usage
+from cbank.model.queries import Session
+from cbank.model.usage import (
+    computed_usage, verify_usage, rebuild_usage, add_usage)
+
+
+def new_charge (allocation, amount, user_id, datetime_):
+    charge = Charge(allocation, amount)
+    charge.datetime = datetime_
+    if user_id is not None:
+        charge.job = Job("%s.%s" % (user_id, datetime_.isoformat()))
+        charge.job.user_id = user_id
+    return charge
+
+
+def stored ():
+    return sorted(
+        ((row.day, row.user_id, row.project_id, row.resource_id),
+         (row.charge_sum, row.refund_sum))
+        for row in metadata.bind.execute(daily_usage.select())
+        if row.charge_sum or row.refund_sum)
+
+
+class RacingConnection (object):
+
+    """A connection on which another transaction inserts a key first.
+
+    The connection has no native upsert, and the key is inserted just
+    after the update that looks for it.
+    """
+
+    dialect = DefaultDialect()
+
+    def __init__ (self, connection, row):
+        self.connection = connection
+        self.row = row
+
+    def execute (self, statement, *args, **kwargs):
+        result = self.connection.execute(statement, *args, **kwargs)
+        if self.row is not None:
+            self.connection.execute(daily_usage.insert(), self.row)
+            self.row = None
+        return result
+
+
+class TestDailyUsage (BaseTester):
+
+    def setup (self):
+        self.setup_database()
+        self.allocation = Allocation(None, None, 100,
+            datetime(2000, 1, 1), datetime(2001, 1, 1))
+        self.allocation.project_id = "project"
+        self.allocation.resource_id = "resource"
+        Session.add(self.allocation)
+        Session.commit()
+
+    def teardown (self):
+        Session.remove()
+        self.teardown_database()
+
+    def test_charges (self):
+        Session.add_all([
+            new_charge(self.allocation, 1, "user1", datetime(2000, 1, 1, 1)),
+            new_charge(self.allocation, 2, "user1", datetime(2000, 1, 1, 23)),
+            new_charge(self.allocation, 4, "user2", datetime(2000, 1, 1, 2)),
+            new_charge(self.allocation, 8, "user1", datetime(2000, 1, 2)),
+            new_charge(self.allocation, 16, None, datetime(2000, 1, 2))])
+        Session.commit()
+        assert_equal(stored(), [
+            ((date(2000, 1, 1), "user1", "project", "resource"), (3, 0)),
+            ((date(2000, 1, 1), "user2", "project", "resource"), (4, 0)),
+            ((date(2000, 1, 2), "", "project", "resource"), (16, 0)),
+            ((date(2000, 1, 2), "user1", "project", "resource"), (8, 0))])
+
+    def test_refunds (self):
+        charge = new_charge(self.allocation, 10, "user1", datetime(2000, 1, 1))
+        Session.add(charge)
+        Session.commit()
+        refund = Refund(charge, 4)
+        refund.datetime = datetime(2000, 2, 1)
+        Session.add(refund)
+        Session.commit()
+        assert_equal(stored(), [
+            ((date(2000, 1, 1), "user1", "project", "resource"), (10, 4))])
+        refund.amount = 3
+        Session.commit()
+        Session.delete(charge)
+        Session.commit()
+        assert_equal(stored(), [])
+
+    def test_offsetting_changes (self):
+        charge = new_charge(self.allocation, 10, "user1", datetime(2000, 1, 1))
+        refund = Refund(charge, 4)
+        Session.add(charge)
+        Session.commit()
+        refund.amount = 3
+        Refund(charge, 1)
+        Session.commit()
+        assert_equal(stored(), [
+            ((date(2000, 1, 1), "user1", "project", "resource"), (10, 4))])
+
+    def test_moved_charge (self):
+        charge = new_charge(self.allocation, 10, "user1", datetime(2000, 1, 1))
+        Refund(charge, 4)
+        Session.add(charge)
+        Session.commit()
+        charge.datetime = datetime(2000, 1, 5)
+        Session.commit()
+        assert_equal(stored(), [
+            ((date(2000, 1, 5), "user1", "project", "resource"), (10, 4))])
+
+    def test_job_user (self):
+        charge = new_charge(self.allocation, 10, None, datetime(2000, 1, 1))
+        charge.job = Job("1")
+        Refund(charge, 4)
+        Session.add(charge)
+        Session.commit()
+        charge.job.user_id = "user1"
+        Session.commit()
+        assert_equal(stored(), [
+            ((date(2000, 1, 1), "user1", "project", "resource"), (10, 4))])
+        # with the charge changed in the same flush
+        charge.job.user_id = "user2"
+        charge.amount = 12
+        Session.commit()
+        assert_equal(stored(), [
+            ((date(2000, 1, 1), "user2", "project", "resource"), (12, 4))])
+        assert_equal(verify_usage(metadata.bind), [])
+
+    def test_verify_and_rebuild (self):
+        Session.add(new_charge(
+            self.allocation, 10, "user1", datetime(2000, 1, 1)))
+        Session.commit()
+        assert_equal(verify_usage(metadata.bind), [])
+        metadata.bind.execute(daily_usage.delete())
+        key = (date(2000, 1, 1), "user1", "project", "resource")
+        assert_equal(verify_usage(metadata.bind), [(key, None, (10, 0))])
+        assert_equal(rebuild_usage(metadata.bind), 1)
+        assert_equal(verify_usage(metadata.bind), [])
+
+    def test_computed_usage (self):
+        Session.add_all([
+            new_charge(self.allocation, 1, "user1", datetime(2000, 1, 1)),
+            new_charge(self.allocation, 2, "user2", datetime(2000, 1, 1))])
+        Session.commit()
+        key = (date(2000, 1, 1), "user2", "project", "resource")
+        assert_equal(computed_usage(metadata.bind, [key]), {key:(2, 0)})
+
+    def test_unique_key (self):
+        row = {'day':date(2000, 1, 1), 'user_id':"", 'project_id':"project",
+               'resource_id':"resource", 'charge_sum':1}
+        metadata.bind.execute(daily_usage.insert(), row)
+        assert_raises(IntegrityError,
+                      metadata.bind.execute, daily_usage.insert(), row)
+        assert_equal(stored(), [
+            ((date(2000, 1, 1), "", "project", "resource"), (1, 0))])
+
+    def test_add_usage (self):
+        key = (date(2000, 1, 1), "user1", "project", "resource")
+        connection = metadata.bind.connect()
+        for connection_ in (connection, RacingConnection(connection, None)):
+            add_usage(connection_, key, {'charge_sum':2, 'refund_sum':1})
+        connection.close()
+        assert_equal(stored(), [(key, (4, 2))])
+
+    def test_concurrent_insert (self):
+        key = (date(2000, 1, 1), "user1", "project", "resource")
+        connection = metadata.bind.connect()
+        racing = RacingConnection(connection, {
+            'day':key[0], 'user_id':key[1], 'project_id':key[2],
+            'resource_id':key[3], 'charge_sum':1})
+        assert_raises(IntegrityError, add_usage,
+                      racing, key, {'charge_sum':2, 'refund_sum':0})
+        connection.close()
+        assert_equal(stored(), [(key, (1, 0))])